@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""
+Measures resident memory of DataLoader workers for the Panda datasets, with
+samples stored as:
+  - "lists": Python lists of small per-sample tensors (the old layout,
+    emulated by copying each sample out of the dataset)
+  - "shared": a few large shared tensors + integer index tables
+
+Reports the total RSS, PSS, and private (unshared) memory of all worker
+processes after iterating over a fixed number of batches. Linux only; reads
+`/proc/<pid>/smaps_rollup`.
+"""
+
+import argparse
+import os
+import time
+
+import torch
+
+from lib import panda_datasets, utility
+
+# Parse args
+parser = argparse.ArgumentParser()
+parser.add_argument("--path", type=str, default="data/gentle_push_1000.hdf5")
+parser.add_argument("--num_workers", type=int, default=16)
+parser.add_argument("--batch_size", type=int, default=32)
+parser.add_argument("--batches", type=int, default=200)
+args = parser.parse_args()
+
+
+class ListDataset(torch.utils.data.Dataset):
+    """
+    Emulates the old dataset layout: every sample copied into its own tensors.
+    """
+
+    def __init__(self, dataset):
+        self.samples = [
+            utility.map_nested(lambda x: x.clone(), dataset[i])
+            for i in range(len(dataset))
+        ]
+
+    def __getitem__(self, index):
+        return self.samples[index]
+
+    def __len__(self):
+        return len(self.samples)
+
+
+def child_pids():
+    pids = []
+    for tid in os.listdir("/proc/self/task"):
+        with open(f"/proc/self/task/{tid}/children") as f:
+            pids.extend(int(pid) for pid in f.read().split())
+    return pids
+
+
+def memory_kib(pid):
+    """Returns (rss, pss, private) memory of a process, in KiB."""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    private = fields["Private_Clean"] + fields["Private_Dirty"]
+    return fields["Rss"], fields["Pss"], private
+
+
+def benchmark(name, dataset):
+    start_time = time.perf_counter()
+    dataloader = torch.utils.data.DataLoader(
+        dataset, batch_size=args.batch_size, shuffle=True,
+        num_workers=args.num_workers)
+    iterator = iter(dataloader)
+    next(iterator)
+    startup_time = time.perf_counter() - start_time
+
+    for _ in range(args.batches - 1):
+        next(iterator)
+
+    totals = [0, 0, 0]
+    for pid in child_pids():
+        for i, value in enumerate(memory_kib(pid)):
+            totals[i] += value
+    del iterator
+
+    print(f"[{name}] {len(dataset)} samples")
+    print(f"  Time to first batch: {startup_time:.2f} s")
+    print(f"  Worker RSS: {totals[0] / 2**10:.1f} MiB")
+    print(f"  Worker PSS: {totals[1] / 2**10:.1f} MiB")
+    print(f"  Worker private: {totals[2] / 2**10:.1f} MiB")
+
+
+print(f"Workers: {args.num_workers}, batch size: {args.batch_size}, "
+      f"batches: {args.batches}")
+for dataset_type in (
+        panda_datasets.PandaDynamicsDataset,
+        panda_datasets.PandaParticleFilterDataset):
+    print(dataset_type.__name__)
+    dataset = dataset_type(args.path)
+    benchmark("lists", ListDataset(dataset))
+    benchmark("shared", dataset)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""
+Compares the per-step cost of EKF dynamics Jacobian backends:
+  - "autograd": reverse-mode autodiff over `state_dim` copies of each input
+  - "jacfwd": forward-mode autodiff, vectorized with `torch.func`
+
+Times `KalmanFilterNetwork.forward` and `KalmanFusionModel.forward`, both for
+inference and for training (forward + backward through a BPTT window).
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from lib.ekf import KalmanFilterNetwork
+from lib.fusion import CrossModalWeights, KalmanFusionModel
+from lib.panda_models import PandaDynamicsModel, PandaEKFMeasurementModel2GAP
+
+# Parse args
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch_size", type=int, default=32)
+parser.add_argument("--timesteps", type=int, default=16)
+parser.add_argument("--hidden_units", type=int, default=64)
+parser.add_argument("--trials", type=int, default=5)
+args = parser.parse_args()
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def make_ekf(jacobian_method, missing_modalities):
+    return KalmanFilterNetwork(
+        PandaDynamicsModel(use_particles=False),
+        PandaEKFMeasurementModel2GAP(
+            missing_modalities=missing_modalities, units=args.hidden_units),
+        jacobian_method=jacobian_method)
+
+
+def make_model(model_type, jacobian_method):
+    torch.manual_seed(0)
+    if model_type == "ekf":
+        model = make_ekf(jacobian_method, missing_modalities=None)
+    elif model_type == "fusion":
+        model = KalmanFusionModel(
+            make_ekf(jacobian_method, missing_modalities=['gripper_sensors']),
+            make_ekf(jacobian_method, missing_modalities=['image']),
+            CrossModalWeights(state_dim=2),
+            fusion_type="cross")
+    else:
+        assert False, "Invalid model type!"
+    return model.to(device)
+
+
+def make_batch():
+    N, T = args.batch_size, args.timesteps
+    observations = {
+        'image': torch.randn((N, T, 32, 32), device=device),
+        'gripper_pos': torch.randn((N, T, 3), device=device),
+        'gripper_sensors': torch.randn((N, T, 7), device=device),
+    }
+    controls = torch.randn((N, T, 7), device=device)
+    states = torch.randn((N, T, 2), device=device)
+    return states, observations, controls
+
+
+def run_window(model, batch, train):
+    states_label, observations, controls = batch
+    N, T, state_dim = states_label.shape
+
+    states = states_label[:, 0]
+    sigmas = torch.eye(state_dim, device=device).repeat(N, 1, 1) * 0.1
+
+    losses = []
+    for t in range(1, T):
+        estimates = model.forward(
+            states,
+            sigmas,
+            {key: value[:, t] for key, value in observations.items()},
+            controls[:, t],
+        )
+        states, sigmas = estimates[:2]
+        if not train:
+            states, sigmas = states.detach(), sigmas.detach()
+        losses.append(torch.mean((states - states_label[:, t]) ** 2))
+
+    if train:
+        loss = torch.mean(torch.stack(losses))
+        loss.backward()
+
+
+def benchmark(model_type, jacobian_method, train):
+    model = make_model(model_type, jacobian_method)
+    model.train(train)
+    batch = make_batch()
+
+    # Warm up
+    run_window(model, batch, train)
+    model.zero_grad()
+
+    durations = []
+    for _ in range(args.trials):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+
+        run_window(model, batch, train)
+        model.zero_grad()
+
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        durations.append(time.perf_counter() - start_time)
+
+    # Per-step cost
+    durations = np.array(durations) / (args.timesteps - 1)
+    mode = "training" if train else "inference"
+    print(f"[{model_type}, {mode}, {jacobian_method}] "
+          f"{np.mean(durations) * 1000:.2f} ms/step "
+          f"(+/- {np.std(durations) * 1000:.2f})")
+
+
+print(f"Device: {device}, batch size: {args.batch_size}, "
+      f"timesteps: {args.timesteps}")
+for model_type in ("ekf", "fusion"):
+    for train in (False, True):
+        for jacobian_method in ("autograd", "jacfwd"):
+            benchmark(model_type, jacobian_method, train)
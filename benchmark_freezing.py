@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+"""
+Compares memory use & runtime of frozen submodels in the particle fusion model,
+with freezing implemented via:
+  - "detach": running the submodel with autograd on and detaching its outputs
+    (the old implementation, emulated with wrapper modules)
+  - "no_grad": running the submodel with autograd off
+
+Uses the setup of the "E2E joint" phase of `train_dpf_fusion.py`: both
+sub-filters frozen, weight model trained through a BPTT window.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from lib import fusion, fusion_pf, panda_models
+
+# Parse args
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch_size", type=int, default=32)
+parser.add_argument("--particles", type=int, default=100)
+parser.add_argument("--timesteps", type=int, default=16)
+parser.add_argument("--hidden_units", type=int, default=64)
+parser.add_argument("--trials", type=int, default=5)
+args = parser.parse_args()
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+class DetachedFilter(nn.Module):
+    """
+    Emulates the old freezing implementation: run a sub-filter with autograd
+    on, then detach the particles & weights it outputs.
+    """
+
+    def __init__(self, pf_model):
+        super().__init__()
+        self.pf_model = pf_model
+
+    def encode(self, observations):
+        return self.pf_model.encode(observations)
+
+    def forward(self, *args, **kwargs):
+        state_estimates, states_pred, log_weights_pred = self.pf_model(
+            *args, **kwargs)
+        return state_estimates, states_pred.detach(), log_weights_pred.detach()
+
+
+def make_model(freezing):
+    image_model = panda_models.PandaParticleFilterNetwork(
+        panda_models.PandaDynamicsModel(),
+        panda_models.PandaMeasurementModel(
+            units=args.hidden_units, missing_modalities=['gripper_sensors'])
+    )
+    force_model = panda_models.PandaParticleFilterNetwork(
+        panda_models.PandaDynamicsModel(),
+        panda_models.PandaMeasurementModel(
+            units=args.hidden_units, missing_modalities=['image']),
+    )
+    weight_model = fusion.CrossModalWeights(
+        state_dim=1, use_softmax=True, use_log_softmax=True)
+
+    if freezing == "detach":
+        model = fusion_pf.ParticleFusionModel(
+            DetachedFilter(image_model), DetachedFilter(force_model),
+            weight_model)
+        model.freeze_image_model = False
+        model.freeze_force_model = False
+    elif freezing == "no_grad":
+        model = fusion_pf.ParticleFusionModel(
+            image_model, force_model, weight_model)
+        model.freeze_image_model = True
+        model.freeze_force_model = True
+    else:
+        assert False, "Invalid freezing method!"
+
+    return model.to(device)
+
+
+def make_batch():
+    N, T = args.batch_size, args.timesteps
+    observations = {
+        'image': torch.randn((N, T, 32, 32), device=device),
+        'gripper_pos': torch.randn((N, T, 3), device=device),
+        'gripper_sensors': torch.randn((N, T, 7), device=device),
+    }
+    controls = torch.randn((N, T, 7), device=device)
+    states = torch.randn((N, T, 2), device=device)
+    return states, observations, controls
+
+
+def run_window(model, batch):
+    """
+    Runs one BPTT window. Returns the number of bytes saved for backward.
+    """
+    states_label, observations, controls = batch
+    N, T, state_dim = states_label.shape
+    M = args.particles
+
+    # Tally tensors saved by autograd
+    saved_bytes = [0]
+
+    def pack(tensor):
+        saved_bytes[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    def unpack(tensor):
+        return tensor
+
+    states = states_label[:, 0, np.newaxis, :].expand(N, M, state_dim)
+    log_weights = torch.zeros((N, M), device=device) - np.log(M)
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, unpack):
+        losses = []
+        for t in range(1, T):
+            state_estimates, states, log_weights = model.forward(
+                states,
+                log_weights,
+                {key: value[:, t] for key, value in observations.items()},
+                controls[:, t],
+            )
+            losses.append(torch.mean(
+                (state_estimates - states_label[:, t]) ** 2))
+        loss = torch.mean(torch.stack(losses))
+
+    loss.backward()
+    return saved_bytes[0]
+
+
+def benchmark(freezing):
+    torch.manual_seed(0)
+    model = make_model(freezing)
+    batch = make_batch()
+
+    # Warm up
+    run_window(model, batch)
+    model.zero_grad()
+
+    saved_bytes = []
+    peak_bytes = []
+    durations = []
+    for _ in range(args.trials):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start_time = time.perf_counter()
+
+        saved_bytes.append(run_window(model, batch))
+        model.zero_grad()
+
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+            peak_bytes.append(torch.cuda.max_memory_allocated())
+        durations.append(time.perf_counter() - start_time)
+
+    print(f"[{freezing}]")
+    print(f"  Saved for backward: {np.mean(saved_bytes) / 2**20:.1f} MiB")
+    if peak_bytes:
+        print(f"  Peak CUDA memory: {np.mean(peak_bytes) / 2**20:.1f} MiB")
+    print(f"  Time per window: {np.mean(durations) * 1000:.1f} ms "
+          f"(+/- {np.std(durations) * 1000:.1f})")
+
+
+print(f"Device: {device}, batch size: {args.batch_size}, "
+      f"particles: {args.particles}, timesteps: {args.timesteps}")
+for freezing in ("detach", "no_grad"):
+    benchmark(freezing)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""
+Compares Panda trajectory loading times:
+  - "loop": the per-timestep image sub-sampling & blackout loop that
+    `panda_datasets.load_trajectories` used to run
+  - "vectorized": one index gather + one random mask per trajectory
+Also times full `load_trajectories()` calls, with and without the
+trajectory cache, and compares the in-memory size of observations with eager
+and lazy (batch-time) observation masks. With `--shards`, also times cold
+(empty cache) loads of several files, serially and in parallel.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from fannypack import utils
+from lib import panda_datasets
+
+# Parse args
+parser = argparse.ArgumentParser()
+parser.add_argument("--path", type=str, default="data/gentle_push_1000.hdf5")
+parser.add_argument("--vision_interval", type=int, default=2)
+parser.add_argument("--blackout", type=float, default=0.0)
+parser.add_argument("--sequential_image", type=int, default=1)
+parser.add_argument("--use_depth", action="store_true")
+parser.add_argument("--shards", type=str, nargs="*", default=[])
+args = parser.parse_args()
+
+
+def process_loop(trajectory):
+    image = np.zeros_like(trajectory['image'])
+    for i in range(len(image)):
+        index = (i // args.vision_interval) * args.vision_interval
+        index = min(index, len(image))
+        blackout_chance = np.random.uniform()
+        if args.blackout == 0 and i % args.sequential_image == 0:
+            image[i] = trajectory['image'][index]
+        if blackout_chance > args.blackout and args.sequential_image == 1:
+            image[i] = trajectory['image'][index]
+
+    depth = np.zeros_like(trajectory['depth'])
+    if args.use_depth:
+        for i in range(len(depth)):
+            index = (i // args.vision_interval) * args.vision_interval
+            index = min(index, len(depth))
+            depth[i] = trajectory['depth'][index]
+    return image, depth
+
+
+def process_vectorized(trajectory):
+    timesteps = len(trajectory['image'])
+    frame_indices = panda_datasets._frame_indices(
+        timesteps, args.vision_interval)
+    image_mask = panda_datasets._image_mask(
+        timesteps, args.blackout, args.sequential_image)
+    image = trajectory['image'][frame_indices] * \
+        image_mask.reshape((timesteps,) + (1,) * (trajectory['image'].ndim - 1))
+
+    if args.use_depth:
+        depth = trajectory['depth'][frame_indices]
+    else:
+        depth = np.zeros_like(trajectory['depth'])
+    return image, depth
+
+
+def in_memory_bytes(trajectories):
+    """Bytes of observations held in memory, excluding memory-mapped arrays
+    & zero-stride placeholders."""
+    total = 0
+    for _, observations, _ in trajectories:
+        for value in observations.values():
+            if isinstance(value, np.memmap) or 0 in value.strides:
+                continue
+            total += value.nbytes
+    return total
+
+
+def timed(name, fn):
+    start_time = time.perf_counter()
+    output = fn()
+    print(f"{name}: {time.perf_counter() - start_time:.3f} s")
+    return output
+
+
+# Read raw trajectories once, so we can time image processing on its own
+with utils.TrajectoriesFile(args.path) as f:
+    raw_trajectories = [
+        {key: trajectory[key] for key in ('image', 'depth')}
+        for trajectory in f
+    ]
+print(f"Loaded {len(raw_trajectories)} trajectories from {args.path}")
+
+# Check that both implementations agree
+np.random.seed(0)
+loop_outputs = timed(
+    "Image processing (loop)",
+    lambda: [process_loop(t) for t in raw_trajectories])
+np.random.seed(0)
+vectorized_outputs = timed(
+    "Image processing (vectorized)",
+    lambda: [process_vectorized(t) for t in raw_trajectories])
+for (image_a, depth_a), (image_b, depth_b) in zip(
+        loop_outputs, vectorized_outputs):
+    assert np.array_equal(image_a, image_b)
+    assert np.array_equal(depth_a, depth_b)
+print("Outputs match")
+
+dataset_args = {
+    'vision_interval': args.vision_interval,
+    'image_blackout_ratio': args.blackout,
+    'sequential_image_rate': args.sequential_image,
+    'use_depth': args.use_depth,
+}
+timed(
+    "load_trajectories (no cache)",
+    lambda: panda_datasets.load_trajectories(
+        args.path, use_cache=False, **dataset_args))
+timed(
+    "load_trajectories (cache, first load)",
+    lambda: panda_datasets.load_trajectories(
+        args.path, use_cache=True, **dataset_args))
+timed(
+    "load_trajectories (cache, repeated load)",
+    lambda: panda_datasets.load_trajectories(
+        args.path, use_cache=True, **dataset_args))
+for lazy_masks in (False, True):
+    trajectories = timed(
+        f"load_trajectories (cache, lazy_masks={lazy_masks})",
+        lambda: panda_datasets.load_trajectories(
+            args.path, use_cache=True, lazy_masks=lazy_masks,
+            **dataset_args))
+    print(f"  Observations in memory: "
+          f"{in_memory_bytes(trajectories) / 2**20:.1f} MiB")
+
+if args.shards:
+    print(f"Cold loads of {len(args.shards)} files")
+    for load_workers in (1, None):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            os.environ["TRAJECTORY_CACHE_DIR"] = cache_dir
+            timed(
+                f"load_trajectories (empty cache, load_workers={load_workers})",
+                lambda: panda_datasets.load_trajectories(
+                    *args.shards, use_cache=True, load_workers=load_workers,
+                    **dataset_args))
+    del os.environ["TRAJECTORY_CACHE_DIR"]
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""
+Compares the per-step inference cost of Kalman fusion rollouts when camera
+frames are only captured every `vision_interval` timesteps:
+  - "every step": image features are recomputed at every timestep
+  - "cached": image features are reused until a new frame arrives; estimates
+    should match "every step" exactly
+  - "multirate": image sub-filter is also skipped until a new frame arrives
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from lib import utility
+from lib.ekf import KalmanFilterNetwork
+from lib.fusion import CrossModalWeights, KalmanFusionModel
+from lib.panda_models import PandaDynamicsModel, PandaEKFMeasurementModel
+
+# Parse args
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch_size", type=int, default=32)
+parser.add_argument("--timesteps", type=int, default=100)
+parser.add_argument("--vision_interval", type=int, default=10)
+parser.add_argument("--hidden_units", type=int, default=64)
+parser.add_argument("--trials", type=int, default=5)
+args = parser.parse_args()
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def make_ekf(missing_modalities):
+    return KalmanFilterNetwork(
+        PandaDynamicsModel(use_particles=False),
+        PandaEKFMeasurementModel(
+            missing_modalities=missing_modalities, units=args.hidden_units))
+
+
+def make_model(multirate):
+    torch.manual_seed(0)
+    model = KalmanFusionModel(
+        make_ekf(missing_modalities=['gripper_sensors']),
+        make_ekf(missing_modalities=['image']),
+        CrossModalWeights(state_dim=2),
+        fusion_type="cross",
+        multirate=multirate)
+    return model.to(device).eval()
+
+
+def make_batch():
+    N, T = args.batch_size, args.timesteps
+
+    # Frames are held for `vision_interval` timesteps
+    frame_indices = (np.arange(T) // args.vision_interval) \
+        * args.vision_interval
+    images = torch.randn((N, T, 32, 32), device=device)[:, frame_indices]
+
+    observations = {
+        'image': images,
+        'gripper_pos': torch.randn((N, T, 3), device=device),
+        'gripper_sensors': torch.randn((N, T, 7), device=device),
+    }
+    controls = torch.randn((N, T, 7), device=device)
+    return observations, controls, utility.fresh_flags(images)
+
+
+def run_rollout(model, batch, use_flags):
+    observations, controls, image_fresh = batch
+    N, T = image_fresh.shape
+
+    utility.clear_feature_caches(model)
+    states = torch.zeros((N, 2), device=device)
+    sigmas = torch.eye(2, device=device).repeat(N, 1, 1) * 0.1
+
+    estimates = []
+    for t in range(T):
+        observations_t = {
+            key: value[:, t] for key, value in observations.items()}
+        if use_flags:
+            observations_t['image_fresh'] = image_fresh[:, t]
+        states, sigmas = model.forward(
+            states, sigmas, observations_t, controls[:, t])[:2]
+        estimates.append(states)
+    return torch.stack(estimates, dim=1)
+
+
+def benchmark(name, multirate, use_flags, reference=None):
+    model = make_model(multirate)
+    batch = make_batch()
+
+    with torch.no_grad():
+        # Warm up
+        estimates = run_rollout(model, batch, use_flags)
+
+        durations = []
+        for _ in range(args.trials):
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start_time = time.perf_counter()
+
+            run_rollout(model, batch, use_flags)
+
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            durations.append(time.perf_counter() - start_time)
+
+    # Per-step cost
+    durations = np.array(durations) / args.timesteps
+    message = f"[{name}] {np.mean(durations) * 1000:.2f} ms/step " \
+        f"(+/- {np.std(durations) * 1000:.2f})"
+    if reference is not None:
+        error = torch.max(torch.abs(estimates - reference)).item()
+        message += f", max deviation: {error:.2e}"
+    print(message)
+    return estimates
+
+
+print(f"Device: {device}, batch size: {args.batch_size}, "
+      f"timesteps: {args.timesteps}, vision interval: {args.vision_interval}")
+reference = benchmark("every step", multirate=False, use_flags=False)
+benchmark("cached", multirate=False, use_flags=True, reference=reference)
+benchmark("multirate", multirate=True, use_flags=True, reference=reference)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""
+Measures how the per-step cost of `ParticleFusionModel.forward` grows with the
+number of fused expert filters, K, for each scoring mode:
+  - "separate": each expert scores its own particles
+  - "batched": experts with identical measurement model architectures score
+    their particles in a single vmapped pass
+
+Experts past the first two are extra force filters, registered through
+`extra_models`. Particles from every expert are resampled in one draw.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from lib import fusion, fusion_pf, panda_models
+
+# Parse args
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch_size", type=int, default=32)
+parser.add_argument("--particles", type=int, default=100)
+parser.add_argument("--timesteps", type=int, default=16)
+parser.add_argument("--hidden_units", type=int, default=64)
+parser.add_argument("--max_experts", type=int, default=4)
+parser.add_argument("--trials", type=int, default=5)
+args = parser.parse_args()
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def make_pf(missing_modalities):
+    return panda_models.PandaParticleFilterNetwork(
+        panda_models.PandaDynamicsModel(),
+        panda_models.PandaMeasurementModel(
+            units=args.hidden_units, missing_modalities=missing_modalities))
+
+
+def make_model(expert_count, scoring_mode):
+    torch.manual_seed(0)
+    model = fusion_pf.ParticleFusionModel(
+        make_pf(missing_modalities=['gripper_sensors']),
+        make_pf(missing_modalities=['image']),
+        fusion.CrossModalWeights(
+            state_dim=1, use_softmax=True, use_log_softmax=True,
+            modality_count=expert_count),
+        scoring_mode=scoring_mode,
+        extra_models={
+            f"force{i}": make_pf(missing_modalities=['image'])
+            for i in range(expert_count - 2)
+        })
+    for modality in model.modalities:
+        setattr(model, "freeze_" + modality + "_model", False)
+    return model.to(device)
+
+
+def make_batch():
+    N, T = args.batch_size, args.timesteps
+    observations = {
+        'image': torch.randn((N, T, 32, 32), device=device),
+        'gripper_pos': torch.randn((N, T, 3), device=device),
+        'gripper_sensors': torch.randn((N, T, 7), device=device),
+    }
+    controls = torch.randn((N, T, 7), device=device)
+    states = torch.randn((N, T, 2), device=device)
+    return states, observations, controls
+
+
+def run_window(model, batch, train):
+    states_label, observations, controls = batch
+    N, T, state_dim = states_label.shape
+    M = args.particles
+
+    states = states_label[:, 0, np.newaxis, :].expand(N, M, state_dim)
+    log_weights = torch.zeros((N, M), device=device) - np.log(M)
+
+    losses = []
+    for t in range(1, T):
+        estimates, states, log_weights = model.forward(
+            states,
+            log_weights,
+            {key: value[:, t] for key, value in observations.items()},
+            controls[:, t],
+        )
+        if not train:
+            states, log_weights = states.detach(), log_weights.detach()
+        losses.append(torch.mean((estimates - states_label[:, t]) ** 2))
+
+    if train:
+        loss = torch.mean(torch.stack(losses))
+        loss.backward()
+
+
+def benchmark(expert_count, scoring_mode, train):
+    model = make_model(expert_count, scoring_mode)
+    model.train(train)
+    batch = make_batch()
+
+    with torch.set_grad_enabled(train):
+        # Warm up
+        run_window(model, batch, train)
+        model.zero_grad()
+
+        durations = []
+        for _ in range(args.trials):
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start_time = time.perf_counter()
+
+            run_window(model, batch, train)
+            model.zero_grad()
+
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            durations.append(time.perf_counter() - start_time)
+
+    # Per-step cost
+    durations = np.array(durations) / (args.timesteps - 1)
+    mode = "training" if train else "inference"
+    print(f"[K={expert_count}, {mode}, {scoring_mode}] "
+          f"{np.mean(durations) * 1000:.2f} ms/step "
+          f"(+/- {np.std(durations) * 1000:.2f})")
+
+
+print(f"Device: {device}, batch size: {args.batch_size}, "
+      f"particles: {args.particles}, timesteps: {args.timesteps}")
+for train in (False, True):
+    for expert_count in range(2, args.max_experts + 1):
+        for scoring_mode in ("separate", "batched"):
+            benchmark(expert_count, scoring_mode, train)
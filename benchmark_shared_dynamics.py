@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+Compares the per-step cost of fusion models' dynamics modes:
+  - "separate": each sub-filter runs its own dynamics model
+  - "shared": one dynamics pass feeds both sub-filters
+  - "batched": both dynamics models run in a single vmapped pass
+
+Times `ParticleFusionModel.forward` and `KalmanFusionModel.forward`, both for
+inference and for training (forward + backward through a BPTT window).
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from lib import fusion, fusion_pf, panda_models
+from lib.ekf import KalmanFilterNetwork
+
+# Parse args
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch_size", type=int, default=32)
+parser.add_argument("--particles", type=int, default=100)
+parser.add_argument("--timesteps", type=int, default=16)
+parser.add_argument("--hidden_units", type=int, default=64)
+parser.add_argument("--trials", type=int, default=5)
+args = parser.parse_args()
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def make_model(model_type, dynamics_mode):
+    torch.manual_seed(0)
+    if model_type == "pf":
+        model = fusion_pf.ParticleFusionModel(
+            panda_models.PandaParticleFilterNetwork(
+                panda_models.PandaDynamicsModel(),
+                panda_models.PandaMeasurementModel(
+                    units=args.hidden_units,
+                    missing_modalities=['gripper_sensors'])),
+            panda_models.PandaParticleFilterNetwork(
+                panda_models.PandaDynamicsModel(),
+                panda_models.PandaMeasurementModel(
+                    units=args.hidden_units, missing_modalities=['image'])),
+            fusion.CrossModalWeights(
+                state_dim=1, use_softmax=True, use_log_softmax=True),
+            dynamics_mode=dynamics_mode)
+        model.freeze_image_model = False
+        model.freeze_force_model = False
+    elif model_type == "kf":
+        model = fusion.KalmanFusionModel(
+            KalmanFilterNetwork(
+                panda_models.PandaDynamicsModel(use_particles=False),
+                panda_models.PandaEKFMeasurementModel(
+                    units=args.hidden_units,
+                    missing_modalities=['gripper_sensors']),
+                jacobian_method="jacfwd"),
+            KalmanFilterNetwork(
+                panda_models.PandaDynamicsModel(use_particles=False),
+                panda_models.PandaEKFMeasurementModel(
+                    units=args.hidden_units, missing_modalities=['image']),
+                jacobian_method="jacfwd"),
+            fusion.CrossModalWeights(state_dim=2),
+            fusion_type="cross",
+            dynamics_mode=dynamics_mode)
+    else:
+        assert False, "Invalid model type!"
+    return model.to(device)
+
+
+def make_batch():
+    N, T = args.batch_size, args.timesteps
+    observations = {
+        'image': torch.randn((N, T, 32, 32), device=device),
+        'gripper_pos': torch.randn((N, T, 3), device=device),
+        'gripper_sensors': torch.randn((N, T, 7), device=device),
+    }
+    controls = torch.randn((N, T, 7), device=device)
+    states = torch.randn((N, T, 2), device=device)
+    return states, observations, controls
+
+
+def run_window(model_type, model, batch, train):
+    states_label, observations, controls = batch
+    N, T, state_dim = states_label.shape
+    M = args.particles
+
+    if model_type == "pf":
+        states = states_label[:, 0, np.newaxis, :].expand(N, M, state_dim)
+        uncertainties = torch.zeros((N, M), device=device) - np.log(M)
+    else:
+        states = states_label[:, 0]
+        uncertainties = torch.eye(state_dim, device=device).repeat(
+            N, 1, 1) * 0.1
+
+    losses = []
+    for t in range(1, T):
+        outputs = model.forward(
+            states,
+            uncertainties,
+            {key: value[:, t] for key, value in observations.items()},
+            controls[:, t],
+        )
+        if model_type == "pf":
+            estimates, states, uncertainties = outputs
+        else:
+            estimates = outputs[0]
+            states, uncertainties = outputs[:2]
+        if not train:
+            states, uncertainties = states.detach(), uncertainties.detach()
+        losses.append(torch.mean((estimates - states_label[:, t]) ** 2))
+
+    if train:
+        loss = torch.mean(torch.stack(losses))
+        loss.backward()
+
+
+def benchmark(model_type, dynamics_mode, train):
+    model = make_model(model_type, dynamics_mode)
+    model.train(train)
+    batch = make_batch()
+
+    with torch.set_grad_enabled(train):
+        # Warm up
+        run_window(model_type, model, batch, train)
+        model.zero_grad()
+
+        durations = []
+        for _ in range(args.trials):
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start_time = time.perf_counter()
+
+            run_window(model_type, model, batch, train)
+            model.zero_grad()
+
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            durations.append(time.perf_counter() - start_time)
+
+    # Per-step cost
+    durations = np.array(durations) / (args.timesteps - 1)
+    mode = "training" if train else "inference"
+    print(f"[{model_type}, {mode}, {dynamics_mode}] "
+          f"{np.mean(durations) * 1000:.2f} ms/step "
+          f"(+/- {np.std(durations) * 1000:.2f})")
+
+
+print(f"Device: {device}, batch size: {args.batch_size}, "
+      f"particles: {args.particles}, timesteps: {args.timesteps}")
+for model_type in ("pf", "kf"):
+    for train in (False, True):
+        for dynamics_mode in ("separate", "shared", "batched"):
+            benchmark(model_type, dynamics_mode, train)
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
 import argparse
+import os
+import sys
 import numpy as np
 import enum
 from scipy.spatial.transform import Rotation as R
@@ -12,6 +14,10 @@ import re
 
 import fannypack
 
+# Shared image encoding helpers live in the top-level `lib` package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from lib import panda_datasets, utility
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
@@ -37,6 +43,10 @@ if __name__ == "__main__":
         "--visualize_observations",
         action="store_true",
         help="Visualize the each saved camera image via matplotlib.")
+    parser.add_argument(
+        "--uint8_images",
+        action="store_true",
+        help="Save images as compact uint8 codes instead of floats.")
     parser.add_argument(
         "--reset-count",
         type=int,
@@ -179,6 +189,9 @@ if __name__ == "__main__":
                 obs['raw_image'] = obs['image']
                 image = np.mean(obs['image'], axis=2) / 127.5 - 1.
                 image = image[20:20+32,20:20+32]
+                if args.uint8_images:
+                    image = utility.quantize_images(
+                        image, panda_datasets.image_range)
                 obs['image'] = image
                 obs['depth'] = obs['depth'][20:20+32,20:20+32]
 
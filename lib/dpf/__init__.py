@@ -1,3 +1,4 @@
 from ._dpf_datasets import *
 from ._dpf_models import *
 from ._dpf_losses import *
+from ._dpf_resampling import *
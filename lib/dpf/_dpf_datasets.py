@@ -11,7 +11,8 @@ class SubsequenceDataset(torch.utils.data.Dataset):
     """
     default_subsequence_length = 20
 
-    def __init__(self, trajectories, subsequence_length=None, **unused):
+    def __init__(self, trajectories, subsequence_length=None,
+                 subsequence_stride=None, **unused):
         """ Initialize the dataset. We chop our list of trajectories into a set
         of subsequences.
 
@@ -19,6 +20,8 @@ class SubsequenceDataset(torch.utils.data.Dataset):
           trajectories: list of trajectories, where each is a tuple of
               (states, observations, controls)
           subsequence_length: length of each subsequence
+          subsequence_stride: # of timesteps between the starts of
+              consecutive subsequences; defaults to `subsequence_length`
         """
 
         state_dim = len(trajectories[0][0][0])
@@ -27,9 +30,9 @@ class SubsequenceDataset(torch.utils.data.Dataset):
         if subsequence_length is None:
             subsequence_length = self.default_subsequence_length
 
-        # Split trajectory into overlapping subsequences
-        self.subsequences = _split_trajectories(
-            trajectories, subsequence_length)
+        # Index windows over our trajectories
+        self.subsequences = SubsequenceIndex(
+            trajectories, subsequence_length, subsequence_stride)
 
     def __getitem__(self, index):
         """ Get a subsequence from our dataset.
@@ -53,7 +56,8 @@ class ParticleFilterDataset(torch.utils.data.Dataset):
     default_particle_count = 100
 
     def __init__(self, trajectories, subsequence_length=None,
-                 particle_count=None, particle_stddev=None, **unused):
+                 subsequence_stride=None, particle_count=None,
+                 particle_stddev=None, sample_particles=True, **unused):
         """ Initialize the dataset. We chop our list of trajectories into a set
         of subsequences.
 
@@ -61,10 +65,16 @@ class ParticleFilterDataset(torch.utils.data.Dataset):
           trajectories: list of trajectories, where each is a tuple of
               (states, observations, controls)
           subsequence_length: length of each subsequence
+          subsequence_stride: # of timesteps between the starts of
+              consecutive subsequences; defaults to `subsequence_length`
           particle_count: # of initial particles to generate for each sampled
             trajectory
           particle_stddev: how far to place our initial particle population
             from the ground-truth initial state.
+          sample_particles: if unset, initial particles aren't generated
+            here; items are (states, observations, controls) subsequences,
+            and particles can be drawn per batch with
+            `sample_initial_particles()`.
         """
 
         state_dim = len(trajectories[0][0][0])
@@ -90,10 +100,11 @@ class ParticleFilterDataset(torch.utils.data.Dataset):
         # Set properties
         self.particle_stddev = particle_stddev
         self.particle_count = particle_count
+        self.sample_particles = sample_particles
 
-        # Split trajectory into overlapping subsequences
-        self.subsequences = _split_trajectories(
-            trajectories, subsequence_length)
+        # Index windows over our trajectories
+        self.subsequences = SubsequenceIndex(
+            trajectories, subsequence_length, subsequence_stride)
 
     def __getitem__(self, index):
         """ Get a set of intiial particles + associated  subsequence from our
@@ -101,6 +112,8 @@ class ParticleFilterDataset(torch.utils.data.Dataset):
         """
 
         states, observation, controls = self.subsequences[index]
+        if not self.sample_particles:
+            return states, observation, controls
 
         trajectory_length, state_dim = states.shape
         initial_state = states[0]
@@ -133,51 +146,178 @@ class ParticleFilterDataset(torch.utils.data.Dataset):
         return len(self.subsequences)
 
 
-def _split_trajectories(trajectories, subsequence_length):
-    """Split a set of a trajectories into overlapping subsequences.
+def sample_initial_particles(initial_states, particle_count,
+                             particle_stddev, generator=None):
+    """Draw initial particle sets for a batch of trajectories, from the same
+    distribution as `ParticleFilterDataset`: each set is centered at a random
+    offset from its ground-truth initial state.
+
+    Args:
+        initial_states (torch.Tensor): (N, state_dim) ground-truth states.
+        particle_count (int): # of particles per set, M.
+        particle_stddev (array): (state_dim,) standard deviation of particles
+            around their set's center.
+        generator (torch.Generator, optional): random number generator; must
+            be on the same device as `initial_states`.
+    Returns:
+        torch.Tensor: (N, M, state_dim) particles.
+    """
+    N, state_dim = initial_states.shape
+    device = initial_states.device
+    stddev = torch.as_tensor(
+        particle_stddev, dtype=initial_states.dtype, device=device)
+    assert stddev.shape == (state_dim,)
+
+    # Sample a centroid for each set, then particles around the centroids
+    centers = torch.randn(
+        (N, 1, state_dim), generator=generator, device=device,
+        dtype=initial_states.dtype) * (stddev / 2)
+    offsets = torch.randn(
+        (N, particle_count, state_dim), generator=generator, device=device,
+        dtype=initial_states.dtype) * stddev
+
+    particles = initial_states[:, np.newaxis, :] + centers + offsets
+    assert particles.shape == (N, particle_count, state_dim)
+    return particles
+
+
+class SubsequenceIndex:
+    """Fixed-length windows over a set of trajectories.
+
+    Each field is stored as one contiguous (sum(T), *) array. When the input
+    trajectories are consecutive views into a shared buffer (e.g. memory-maps
+    from `trajectory_cache`), that buffer is used directly; otherwise, arrays
+    are concatenated once, into shared memory. Windows are described by a
+    (trajectory, start) index table, and indexing returns (states,
+    observations, controls) tensor views.
+
+    Since data lives in a handful of large buffers rather than many small
+    Python objects, DataLoader workers can share it without copies.
 
     Args:
         trajectories (list): a list of trajectories, which are each tuples of
             the form (states, observations, controls).
-        subsequence_length (int): # of timesteps per output subsequence
-    Returns:
-        subsequences (list): a list of (states, observations, controls)
-            tuples; the length of each is determined by subsequence_length
+        subsequence_length (int): # of timesteps per window.
+        stride (int, optional): # of timesteps between the starts of
+            consecutive windows. Defaults to `subsequence_length`, for
+            non-overlapping windows.
     """
-    # Chop up each trajectory into overlapping subsequences
-    subsequences = []
-    for trajectory in trajectories:
-        assert len(trajectory) == 3
-        states, observation, controls = trajectory
-        observation = observation
-
-        assert len(states) == len(controls)
-        trajectory_length = len(states)
-
-        sections = trajectory_length // subsequence_length
-
-        def split(x):
-            if type(x) == np.ndarray:
-                new_length = (len(x) // subsequence_length) * \
-                    subsequence_length
-                x = x[:new_length]
-                return np.split(x[:new_length], sections)
-            elif type(x) == dict:
-                output = {}
-                for key, value in x.items():
-                    output[key] = split(value)
-                return utils.DictIterator(output)
-            else:
-                assert False
 
-        for s, o, c in zip(split(states), split(observation),
-                           split(controls)):
-            # Numpy => Torch
-            s = utils.to_torch(s)
-            o = utils.to_torch(o)
-            c = utils.to_torch(c)
+    def __init__(self, trajectories, subsequence_length, stride=None):
+        if stride is None:
+            stride = subsequence_length
+        assert subsequence_length > 0 and stride > 0
+
+        lengths = []
+        table = []
+        for i, trajectory in enumerate(trajectories):
+            assert len(trajectory) == 3
+            states, observation, controls = trajectory
+            assert len(states) == len(controls)
+
+            lengths.append(len(states))
+            for start in range(
+                    0, len(states) - subsequence_length + 1, stride):
+                table.append((i, start))
+
+        # (N + 1,) trajectory boundaries in the contiguous arrays
+        self.offsets = np.cumsum([0] + lengths)
+
+        # (K, 2) table of (trajectory, start) pairs
+        self.table = np.array(table, dtype=np.int64).reshape((-1, 2))
+        self.subsequence_length = subsequence_length
+
+        # Contiguous (sum(T), *) tensors
+        self.states = _to_shared_tensor(
+            _concatenate([s for s, _, _ in trajectories]))
+        self.observations = {
+            key: _to_shared_tensor(
+                _concatenate([o[key] for _, o, _ in trajectories]))
+            for key in trajectories[0][1].keys()
+        }
+        self.controls = _to_shared_tensor(
+            _concatenate([c for _, _, c in trajectories]))
+
+    def starts(self):
+        """Start of each window in the contiguous arrays, as a (K,) array.
+        """
+        return self.offsets[self.table[:, 0]] + self.table[:, 1]
+
+    def select(self, indices):
+        """Create an index over a subset of windows. Arrays are shared.
+
+        Args:
+            indices (array): window indices to keep, in order.
+        Returns:
+            SubsequenceIndex: new index.
+        """
+        output = object.__new__(SubsequenceIndex)
+        output.__dict__.update(self.__dict__)
+        output.table = self.table[np.asarray(indices, dtype=np.int64)] \
+            .reshape((-1, 2))
+        return output
+
+    def __getitem__(self, index):
+        start = int(self.offsets[self.table[index, 0]] + self.table[index, 1])
+        window = slice(start, start + self.subsequence_length)
+        return (
+            self.states[window],
+            {key: value[window] for key, value in self.observations.items()},
+            self.controls[window],
+        )
+
+    def __len__(self):
+        return len(self.table)
+
+
+def _concatenate(arrays):
+    """Concatenate arrays along their first axis, without copying if they're
+    consecutive views into the same buffer.
+    """
+    first = arrays[0]
+    total = sum(len(x) for x in arrays)
+    shape = (total,) + first.shape[1:]
+
+    root = _root_array(first)
+    if all(_root_array(x) is root and x.dtype == first.dtype
+           and x.shape[1:] == first.shape[1:] for x in arrays):
+        # Constant placeholders: zero stride along the first axis
+        if all(x.strides[0] == 0 and x.strides == first.strides
+               for x in arrays):
+            return np.broadcast_to(first[:1], shape)
+
+        # Consecutive C-contiguous views
+        consecutive = all(x.flags['C_CONTIGUOUS'] for x in arrays)
+        for prev, x in zip(arrays[:-1], arrays[1:]):
+            consecutive = consecutive and \
+                _address(x) == _address(prev) + prev.nbytes
+        if consecutive:
+            return np.lib.stride_tricks.as_strided(
+                first, shape=shape, strides=first.strides, writeable=False)
+
+    return np.concatenate(arrays)
+
+
+def _to_shared_tensor(array):
+    """Convert an array to a tensor. Tensors that wrap an array's memory
+    (memory-maps, placeholders) are left in place; anything else, including
+    arrays copied during conversion (e.g. float64 -> float32), is moved to
+    shared memory.
+    """
+    tensor = utils.to_torch(array)
+    if array.flags['OWNDATA'] or tensor.data_ptr() != _address(array):
+        tensor.share_memory_()
+    return tensor
+
+
+def _root_array(x):
+    """Find the array that owns the memory behind a (possibly nested) view.
+    """
+    while isinstance(x.base, np.ndarray):
+        x = x.base
+    return x
 
-            # Add to subsequences
-            subsequences.append((s, o, c))
 
-    return subsequences
+def _address(x):
+    """Address of the first element of an array."""
+    return x.__array_interface__['data'][0]
@@ -3,6 +3,9 @@ import torch
 import torch.nn as nn
 import abc
 
+from ._dpf_resampling import resample_indices, gather_particles, \
+    resampling_methods, effective_sample_size, kld_particle_counts
+
 
 class MeasurementModel(abc.ABC, nn.Module):
 
@@ -13,6 +16,20 @@ class MeasurementModel(abc.ABC, nn.Module):
         """
         pass
 
+    def encode(self, observations):
+        """
+        Computes the particle-independent part of the measurement model. By
+        default, this just passes the observations through.
+        """
+        return observations
+
+    def score(self, observation_features, states):
+        """
+        For each state, computes a likelihood given the output of
+        `encode()`.
+        """
+        return self.forward(observation_features, states)
+
 
 class DynamicsModel(abc.ABC, nn.Module):
 
@@ -34,7 +51,9 @@ class DynamicsModel(abc.ABC, nn.Module):
 class ParticleFilterNetwork(nn.Module):
 
     def __init__(self, dynamics_model, measurement_model,
-                 soft_resample_alpha=1.0):
+                 soft_resample_alpha=1.0, resample_method="multinomial",
+                 kld_bin_size=0.1, kld_epsilon=0.05, kld_z=2.326,
+                 kld_min_particles=10):
         super().__init__()
 
         self.dynamics_model = dynamics_model
@@ -43,13 +62,33 @@ class ParticleFilterNetwork(nn.Module):
         assert(soft_resample_alpha >= 0. and soft_resample_alpha <= 1.)
         self.soft_resample_alpha = soft_resample_alpha
 
+        assert resample_method in resampling_methods
+        self.resample_method = resample_method
+
+        # KLD-sampling parameters; see `kld_particle_counts()`
+        self.kld_bin_size = kld_bin_size
+        self.kld_epsilon = kld_epsilon
+        self.kld_z = kld_z
+        self.kld_min_particles = kld_min_particles
+
         self.freeze_dynamics_model = False
         self.freeze_measurement_model = False
 
+    def encode(self, observations):
+        """
+        Encodes observations for the measurement model; the output can be
+        passed back into `forward()` as `observation_features`.
+        """
+        with torch.set_grad_enabled(
+                torch.is_grad_enabled() and not self.freeze_measurement_model):
+            return self.measurement_model.encode(observations)
+
     def forward(self, states_prev, log_weights_prev, observations, controls,
                 resample=True, output_particles=None,
                 state_estimation_method="weighted_average",
-                noisy_dynamics=True):
+                noisy_dynamics=True, ess_threshold=None, return_ess=False,
+                kld_sampling=False, observation_features=None,
+                states_pred=None, observation_log_likelihoods=None):
         # states_prev: (N, M, *)
         # log_weights_prev: (N, M)
         # observations: (N, *)
@@ -57,45 +96,77 @@ class ParticleFilterNetwork(nn.Module):
         #
         # N := distinct trajectory count
         # M := particle count
+        #
+        # If `ess_threshold` is set, we only resample the trajectories whose
+        # effective sample size drops below `ess_threshold * M`; the rest
+        # carry their weights forward
+        #
+        # If `kld_sampling` is set, each trajectory resamples as many
+        # particles as its posterior spread requires, up to
+        # `output_particles`. Particle sets are padded to the largest count
+        # in the batch, and padding particles have log-weights of -inf
+        #
+        # `observation_features` can be used to pass in the output of
+        # `encode()`, to avoid re-encoding observations
+        #
+        # `states_pred` can be used to pass in (N, M, *) particles that have
+        # already been propagated through a dynamics model; the dynamics
+        # update is then skipped
+        #
+        # `observation_log_likelihoods` can similarly be used to pass in
+        # (N, M) scores of `states_pred` from the measurement model; only
+        # valid without particle contraction
 
         N, M, state_dim = states_prev.shape
         device = states_prev.device
         assert log_weights_prev.shape == (N, M)
         if output_particles is None:
             output_particles = M
+        if ess_threshold is not None:
+            assert resample and output_particles == M, \
+                "ESS-triggered resampling can't resize particle sets!"
+        if kld_sampling:
+            assert resample and ess_threshold is None, \
+                "KLD sampling requires resampling every trajectory!"
 
         # Expand or contract particle set if we're not resampling
         if not resample and output_particles != M:
-            resized_states = torch.zeros((N, output_particles, state_dim), device=device)
-            resized_log_weights = torch.zeros((N, output_particles), device=device)
-
-            for i in range(N):
-                # Randomly sample some particles from our input
-                # We sample with replacement only if necessary
-                indices = torch.multinomial(
-                    torch.ones_like(log_weights_prev[i], device=device),
-                    num_samples=output_particles,
-                    replacement=(output_particles > M))
-
-                resized_states[i] = states_prev[i][indices]
-                resized_log_weights[i] = log_weights_prev[i][indices]
-
-            states_prev = resized_states
-            log_weights_prev = resized_log_weights
+            # Randomly sample some particles from our input
+            # We sample with replacement only if necessary
+            indices = torch.multinomial(
+                torch.ones_like(log_weights_prev),
+                num_samples=output_particles,
+                replacement=(output_particles > M))
+            assert indices.shape == (N, output_particles)
+
+            states_prev = gather_particles(states_prev, indices)
+            log_weights_prev = gather_particles(log_weights_prev, indices)
+            if states_pred is not None:
+                states_pred = gather_particles(states_pred, indices)
 
         # Dynamics update
-        states_pred = self.dynamics_model(
-            states_prev, controls, noisy=noisy_dynamics)
-        if self.freeze_dynamics_model:
-            # Don't backprop through frozen models
-            states_pred = states_pred.detach()
+        # Frozen models are run without autograd, so we never build graphs
+        # that we can't backprop through
+        if states_pred is None:
+            with torch.set_grad_enabled(
+                    torch.is_grad_enabled()
+                    and not self.freeze_dynamics_model):
+                states_pred = self.dynamics_model(
+                    states_prev, controls, noisy=noisy_dynamics)
 
         # Re-weight particles using observations
-        observation_log_likelihoods = self.measurement_model(
-            observations, states_pred)
-        if self.freeze_measurement_model:
-            # Don't backprop through frozen models
-            observation_log_likelihoods = observation_log_likelihoods.detach()
+        if observation_log_likelihoods is not None:
+            assert observation_log_likelihoods.shape == \
+                log_weights_prev.shape
+        else:
+            with torch.set_grad_enabled(
+                    torch.is_grad_enabled()
+                    and not self.freeze_measurement_model):
+                if observation_features is None:
+                    observation_features = self.measurement_model.encode(
+                        observations)
+                observation_log_likelihoods = self.measurement_model.score(
+                    observation_features, states_pred)
         log_weights_pred = log_weights_prev + observation_log_likelihoods
 
         # Find best particle
@@ -111,8 +182,60 @@ class ParticleFilterNetwork(nn.Module):
         else:
             assert False, "Invalid state estimation method!"
 
+        # Per-trajectory weight degeneracy
+        ess = effective_sample_size(log_weights_pred.detach())
+        assert ess.shape == (N,)
+
         # Re-sampling
-        if resample:
+        if kld_sampling:
+            # Draw a full set of candidates, in random order so that every
+            # prefix is a representative sample of the posterior
+            state_indices = resample_indices(
+                log_weights_pred,
+                num_samples=output_particles,
+                method=self.resample_method)
+            shuffle = torch.argsort(
+                torch.rand(state_indices.shape, device=device), dim=1)
+            state_indices = torch.gather(state_indices, dim=1, index=shuffle)
+            states = gather_particles(states_pred, state_indices)
+
+            # Keep as many candidates as each posterior needs
+            particle_counts = kld_particle_counts(
+                states,
+                bin_size=self.kld_bin_size,
+                epsilon=self.kld_epsilon,
+                z=self.kld_z,
+                min_particles=min(self.kld_min_particles, output_particles))
+            output_particles = int(torch.max(particle_counts))
+            states = states[:, :output_particles]
+
+            # Uniform weights over active particles, -inf for padding
+            active = torch.arange(output_particles, device=device)[
+                np.newaxis, :] < particle_counts[:, np.newaxis]
+            log_weights = torch.where(
+                active,
+                -torch.log(particle_counts.float())[:, np.newaxis].expand(
+                    N, output_particles),
+                torch.full((N, output_particles), -np.inf, device=device))
+        elif resample and ess_threshold is not None:
+            # Only resample degenerate particle sets
+            resample_mask = ess < ess_threshold * M
+
+            states = states_pred
+            log_weights = log_weights_pred
+            if torch.any(resample_mask):
+                state_indices = resample_indices(
+                    log_weights_pred[resample_mask],
+                    num_samples=M,
+                    method=self.resample_method)
+
+                states = states.clone()
+                states[resample_mask] = gather_particles(
+                    states_pred[resample_mask], state_indices)
+
+                log_weights = log_weights.clone()
+                log_weights[resample_mask] = -np.log(M)
+        elif resample:
             if self.soft_resample_alpha < 1.0:
                 # TODO: This still needs to be re-adapted for the new minibatch
                 # shape
@@ -139,22 +262,13 @@ class ParticleFilterNetwork(nn.Module):
                 # Standard particle filter re-sampling -- this kills gradients
                 # :(
                 assert log_weights_pred.shape == (N, M)
-                distribution = torch.distributions.Categorical(
-                    logits=log_weights_pred)
-                state_indices = distribution.sample((output_particles, )).T
+                state_indices = resample_indices(
+                    log_weights_pred,
+                    num_samples=output_particles,
+                    method=self.resample_method)
                 assert state_indices.shape == (N, output_particles)
 
-                states = torch.zeros_like(states_pred, device=device)
-                for i in range(N):
-                    states[i] = states_pred[i][state_indices[i]]
-
-                # states = torch.zeros_like(states_pred)
-                # for i in range(N):
-                #     indices = torch.multinomial(
-                #         torch.exp(log_weights_pred[i]),
-                #         num_samples=output_particles,
-                #         replacement=True)
-                #     states[i] = states_pred[i][indices]
+                states = gather_particles(states_pred, state_indices)
 
                 # Uniform weights
                 log_weights = torch.zeros(
@@ -171,4 +285,6 @@ class ParticleFilterNetwork(nn.Module):
         assert states.shape == (N, output_particles, state_dim)
         assert log_weights.shape == (N, output_particles)
 
+        if return_ess:
+            return state_estimates, states, log_weights, ess
         return state_estimates, states, log_weights
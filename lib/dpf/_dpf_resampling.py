@@ -0,0 +1,192 @@
+import numpy as np
+import torch
+
+
+resampling_methods = ("multinomial", "systematic", "stratified", "residual")
+
+
+def resample_indices(log_weights, num_samples, method="multinomial"):
+    """Draw particle indices for a batch of particle sets at once.
+
+    Args:
+        log_weights (torch.Tensor): (N, M) particle log-weights. These don't
+            need to be normalized.
+        num_samples (int): # of particles to draw for each of the N sets.
+        method (str): one of `resampling_methods`.
+    Returns:
+        indices (torch.Tensor): (N, num_samples) long tensor of particle
+            indices, in [0, M).
+    """
+    N, M = log_weights.shape
+    device = log_weights.device
+    assert method in resampling_methods, "Invalid resampling method!"
+
+    # Normalized weights; detached because index sampling isn't differentiable
+    weights = torch.exp(
+        log_weights - torch.logsumexp(log_weights, dim=1, keepdim=True)
+    ).detach()
+    assert weights.shape == (N, M)
+
+    if method == "multinomial":
+        indices = torch.multinomial(
+            weights, num_samples=num_samples, replacement=True)
+
+    elif method in ("systematic", "stratified"):
+        # Systematic: one uniform offset per particle set
+        # Stratified: one uniform offset per output particle
+        if method == "systematic":
+            offsets = torch.rand((N, 1), device=device)
+        else:
+            offsets = torch.rand((N, num_samples), device=device)
+        positions = (torch.arange(
+            num_samples, device=device, dtype=weights.dtype)[np.newaxis, :]
+            + offsets) / num_samples
+        indices = _search_cumulative(weights, positions)
+
+    elif method == "residual":
+        # Deterministically copy floor(num_samples * w) of each particle...
+        expected_counts = weights * num_samples
+        counts = torch.floor(expected_counts)
+        copied = counts.sum(dim=1, keepdim=True)
+        assert copied.shape == (N, 1)
+
+        # (N, num_samples) output slots; slot j holds the particle whose
+        # cumulative copy count first exceeds j
+        slots = torch.arange(
+            num_samples, device=device, dtype=weights.dtype)[np.newaxis, :]
+        deterministic_indices = _search_cumulative(counts, slots)
+
+        # ...and fill the remaining slots by sampling from the residuals
+        residuals = expected_counts - counts
+        residual_totals = residuals.sum(dim=1, keepdim=True)
+        residuals = torch.where(
+            residual_totals > 0,
+            residuals,
+            torch.ones_like(residuals))
+        residual_indices = torch.multinomial(
+            residuals, num_samples=num_samples, replacement=True)
+
+        indices = torch.where(
+            slots < copied, deterministic_indices, residual_indices)
+
+    assert indices.shape == (N, num_samples)
+    return indices
+
+
+def gather_particles(particles, indices):
+    """Select particles from a batch of particle sets.
+
+    Args:
+        particles (torch.Tensor): (N, M, *) particles, or (N, M) log-weights.
+        indices (torch.Tensor): (N, K) particle indices.
+    Returns:
+        torch.Tensor: (N, K, *) selected particles.
+    """
+    N, K = indices.shape
+    assert particles.shape[0] == N
+
+    trailing_shape = particles.shape[2:]
+    expanded_indices = indices.reshape(
+        (N, K) + (1,) * len(trailing_shape)
+    ).expand((N, K) + trailing_shape)
+    return torch.gather(particles, dim=1, index=expanded_indices)
+
+
+def kld_particle_counts(particles, bin_size, epsilon=0.05, z=2.326,
+                        min_particles=1):
+    """KLD-sampling particle counts (Fox, 2003) for a batch of particle sets.
+
+    Treats each row of `particles` as a sequence of samples from the
+    posterior, and finds the shortest prefix that's long enough to bound the
+    KL divergence between the sample-based and true posterior by `epsilon`
+    with probability `1 - delta`. The bound depends on the number of
+    histogram bins that the samples occupy.
+
+    Args:
+        particles (torch.Tensor): (N, K, state_dim) posterior samples, in
+            random order.
+        bin_size (float or array): histogram bin width, per state dimension.
+        epsilon (float): KL divergence bound.
+        z (float): upper `1 - delta` quantile of the standard normal.
+        min_particles (int): lower bound on the output counts.
+    Returns:
+        counts (torch.Tensor): (N,) long tensor of particle counts, in
+            [min_particles, K].
+    """
+    N, K, state_dim = particles.shape
+    device = particles.device
+
+    # (N, K, state_dim) integer bin coordinates
+    bins = torch.floor(particles.detach() / torch.as_tensor(
+        bin_size, dtype=particles.dtype, device=device)).long()
+
+    # A sample lands in a new bin if no earlier sample shares its bin
+    # > same_bin[n, j, i]: samples j and i of set n share a bin
+    same_bin = torch.all(
+        bins[:, :, np.newaxis, :] == bins[:, np.newaxis, :, :], dim=3)
+    earlier = torch.tril(
+        torch.ones((K, K), dtype=torch.bool, device=device), diagonal=-1)
+    new_bin = ~torch.any(same_bin & earlier, dim=2)
+    assert new_bin.shape == (N, K)
+
+    # (N, K) occupied bin count after each sample
+    k = torch.cumsum(new_bin, dim=1).to(particles.dtype)
+
+    # Required sample count for k occupied bins, via the Wilson-Hilferty
+    # approximation of the chi-square quantile
+    k_minus_1 = torch.clamp(k - 1., min=1.)
+    a = 2. / (9. * k_minus_1)
+    required = k_minus_1 / (2. * epsilon) * \
+        (1. - a + torch.sqrt(a) * z) ** 3
+    required = torch.where(k > 1., required, torch.ones_like(required))
+
+    # Stop at the first prefix that's long enough
+    n = torch.arange(1, K + 1, device=device, dtype=particles.dtype)
+    sufficient = (n >= required) & (n >= min_particles)
+    counts = torch.where(
+        torch.any(sufficient, dim=1),
+        torch.argmax(sufficient.int(), dim=1) + 1,
+        torch.full((N,), K, dtype=torch.long, device=device))
+
+    assert counts.shape == (N,)
+    return counts
+
+
+def _search_cumulative(weights, positions):
+    """For each position, find the first index where the cumulative sum of
+    `weights` exceeds it.
+    """
+    N, M = weights.shape
+    cumulative = torch.cumsum(weights, dim=1)
+
+    # Floating point error can put the last cumulative weight just under a
+    # position -- clamp so we never index past the particle set
+    indices = torch.searchsorted(
+        cumulative.contiguous(), positions.contiguous(), right=True)
+    return torch.clamp(indices, max=M - 1)
+
+
+def effective_sample_size(log_weights):
+    """Compute the effective sample size of each particle set, 1 / sum(w^2).
+
+    Args:
+        log_weights (torch.Tensor): (N, M) particle log-weights. These don't
+            need to be normalized.
+    Returns:
+        torch.Tensor: (N,) effective sample sizes, in [1, M].
+    """
+    log_weights = log_weights - \
+        torch.logsumexp(log_weights, dim=1, keepdim=True)
+    return torch.exp(-torch.logsumexp(2. * log_weights, dim=1))
+
+
+def active_particle_counts(log_weights):
+    """Count the particles in each set that aren't padding.
+
+    Args:
+        log_weights (torch.Tensor): (N, M) particle log-weights; padding
+            particles have log-weights of -inf.
+    Returns:
+        torch.Tensor: (N,) long tensor of particle counts.
+    """
+    return torch.sum(torch.isfinite(log_weights), dim=1)
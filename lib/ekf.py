@@ -18,10 +18,24 @@ class KFMeasurementModel(abc.ABC, nn.Module):
         """
         pass
 
+    def encode(self, observations):
+        """
+        Computes the state-independent part of the measurement model. By
+        default, this just passes the observations through.
+        """
+        return observations
+
+    def score(self, observation_features, states):
+        """
+        For each state, computes z and R given the output of `encode()`.
+        """
+        return self.forward(observation_features, states)
+
 
 class KalmanFilterNetwork(nn.Module):
 
-    def __init__(self, dynamics_model, measurement_model, R=None):
+    def __init__(self, dynamics_model, measurement_model, R=None,
+                 jacobian_method=None):
         super().__init__()
 
         self.dynamics_model = dynamics_model
@@ -33,6 +47,17 @@ class KalmanFilterNetwork(nn.Module):
 
         self.R = R
 
+        # Dynamics Jacobians are computed with either:
+        # - "jacfwd": forward-mode autodiff, vectorized over the batch with
+        #   `torch.func`; requires torch>=2.0
+        # - "autograd": reverse-mode autodiff over `state_dim` copies of
+        #   each input
+        if jacobian_method is None:
+            jacobian_method = "jacfwd" if hasattr(torch, "func") \
+                else "autograd"
+        assert jacobian_method in ("jacfwd", "autograd")
+        self.jacobian_method = jacobian_method
+
         self.dynamics_states = None
         self.measurement_states = None
         self.dynamics_sigma = None
@@ -58,49 +83,164 @@ class KalmanFilterNetwork(nn.Module):
 
         return jac[0]
 
+    def get_dynamics_jacobian(self, states_prev, controls):
+        """
+        Computes dynamics predictions and their Jacobians w.r.t. the previous
+        states, using forward-mode autodiff; see `dynamics_jacobian()`.
+        """
+        return dynamics_jacobian(self.dynamics_model, states_prev, controls)
+
+    def encode(self, observations):
+        """
+        Encodes observations for the measurement model; the output can be
+        passed back into `forward()` as `observation_features`.
+        """
+        return self.measurement_model.encode(observations)
+
     def forward(self, states_prev,
                 states_sigma_prev,
                 observations,
-                controls,):
+                controls,
+                observation_features=None):
         # states_prev: (N, *)
         # states_sigma_prev: (N, *, *)
         # observations: (N, *)
         # controls: (N, *)
+        # observation_features: optional output of `encode()`
         #
         # N := distinct trajectory count
 
-        N, state_dim = states_prev.shape
-        # Dynamics prediction step
-        states_pred = self.dynamics_model(
-            states_prev, controls, noisy=False)
-        states_pred_Q = self.dynamics_model.Q
+        states_pred, states_sigma_pred = self.predict(
+            states_prev, states_sigma_prev, controls)
+        return self.update(
+            states_pred, states_sigma_pred, observations,
+            observation_features=observation_features)
 
-        jac_A = self.get_jacobian(self.dynamics_model, states_prev, state_dim, N, controls)
+    def predict(self, states_prev, states_sigma_prev, controls,
+                linearization=None):
+        """
+        Dynamics prediction step.
+
+        Args:
+            states_prev (torch.Tensor): (N, state_dim) states.
+            states_sigma_prev (torch.Tensor): (N, state_dim, state_dim)
+                covariances.
+            controls (torch.Tensor): (N, control_dim) controls.
+            linearization (tuple, optional): precomputed (states_pred, jac_A)
+                outputs of `get_dynamics_jacobian()`.
+        Returns:
+            states_pred (torch.Tensor): (N, state_dim) predicted states.
+            states_sigma_pred (torch.Tensor): (N, state_dim, state_dim)
+                predicted covariances.
+        """
+        N, state_dim = states_prev.shape
+        if linearization is not None:
+            states_pred, jac_A = linearization
+        elif self.jacobian_method == "jacfwd":
+            states_pred, jac_A = self.get_dynamics_jacobian(
+                states_prev, controls)
+        else:
+            states_pred = self.dynamics_model(
+                states_prev, controls, noisy=False)
+            jac_A = self.get_jacobian(self.dynamics_model, states_prev, state_dim, N, controls)
         assert jac_A.shape == (N, state_dim, state_dim)
+        states_pred_Q = self.dynamics_model.Q
 
         # Calculating the sigma_t+1|t
         states_sigma_pred = torch.bmm(torch.bmm(jac_A, states_sigma_prev), jac_A.transpose(-1, -2))
         states_sigma_pred += states_pred_Q
 
-        z, R = self.measurement_model(observations, states_pred)
+        # SAVING
+        self.dynamics_states = states_pred
+        self.dynamics_sigma = states_pred_Q
+        self.dynamics_jac = jac_A
+
+        return states_pred, states_sigma_pred
+
+    def update(self, states_pred, states_sigma_pred, observations,
+               observation_features=None):
+        """
+        Measurement update step, from the outputs of `predict()`.
+        """
+        N, state_dim = states_pred.shape
+
+        if observation_features is None:
+            observation_features = self.measurement_model.encode(observations)
+        z, R = self.measurement_model.score(observation_features, states_pred)
 
         if self.R is not None:
             R = torch.eye(state_dim).repeat(N, 1, 1).to(z.device) * self.R
 
         # SAVING
-        self.dynamics_states = states_pred
         self.measurement_states = z
-        self.dynamics_sigma = states_pred_Q
         self.measurement_sigma = R
-        self.dynamics_jac = jac_A
 
         #Kalman Gain
-        K_update = torch.bmm(states_sigma_pred, torch.inverse(states_sigma_pred + R))
+        # K = P S^-1, with S = P + R; both P and S are symmetric, so we can
+        # get K^T = S^-1 P from a Cholesky solve instead of inverting S
+        S_cholesky = torch.linalg.cholesky(states_sigma_pred + R)
+        K_update = torch.cholesky_solve(
+            states_sigma_pred, S_cholesky).transpose(-1, -2)
 
         #Updating
         states_update = torch.unsqueeze(states_pred,-1) + torch.bmm(K_update, torch.unsqueeze(z-states_pred,-1))
-        states_update = states_update.squeeze()
-        states_sigma_update = torch.bmm(torch.eye(K_update.shape[-1]).repeat(N, 1, 1).to(K_update.device) - K_update, states_sigma_pred)
-
-        states_sigma_update[:,0,1] = states_sigma_update[:,1, 0]
+        states_update = states_update.squeeze(-1)
+
+        # Joseph-form covariance update: (I - K) P (I - K)^T + K R K^T
+        # This stays symmetric positive definite, even with an imprecise K
+        I_minus_K = torch.eye(state_dim, device=K_update.device) - K_update
+        states_sigma_update = torch.bmm(
+            torch.bmm(I_minus_K, states_sigma_pred),
+            I_minus_K.transpose(-1, -2)
+        ) + torch.bmm(torch.bmm(K_update, R), K_update.transpose(-1, -2))
+
+        # Remove floating point asymmetry
+        states_sigma_update = 0.5 * (
+            states_sigma_update + states_sigma_update.transpose(-1, -2))
         return states_update, states_sigma_update
+
+
+def dynamics_jacobian(dynamics_model, states_prev, controls):
+    """
+    Computes dynamics predictions and their Jacobians w.r.t. the previous
+    states, using forward-mode autodiff.
+
+    Args:
+        dynamics_model (nn.Module): dynamics model; `encode_controls()` and
+            `predict()` are used if it has them.
+        states_prev (torch.Tensor): (N, state_dim) states.
+        controls (torch.Tensor): (N, control_dim) controls.
+    Returns:
+        states_pred (torch.Tensor): (N, state_dim) noise-free predictions.
+        jac_A (torch.Tensor): (N, state_dim, state_dim) Jacobians.
+    """
+    # Control features don't depend on the state, so we only need to
+    # compute them once
+    if hasattr(dynamics_model, "encode_controls"):
+        control_features = dynamics_model.encode_controls(controls)
+        predict = dynamics_model.predict
+    else:
+        control_features = controls
+        predict = lambda states, controls: dynamics_model(
+            states, controls, noisy=False)
+
+    def predict_single(state, control_feature):
+        state_pred = predict(
+            state[np.newaxis], control_feature[np.newaxis])[0]
+        return state_pred, state_pred
+
+    # Like `KalmanFilterNetwork.get_jacobian()`, we don't backprop through the
+    # linearization point; predictions come out of the same pass as an
+    # auxiliary output
+    jac_A, states_pred = torch.func.vmap(
+        torch.func.jacfwd(predict_single, has_aux=True))(
+        states_prev.detach(), control_features)
+
+    # The predictions above were made from detached states, so we add a
+    # zero-valued first-order term to recover their gradients w.r.t.
+    # `states_prev`
+    if states_prev.requires_grad:
+        states_delta = states_prev - states_prev.detach()
+        states_pred = states_pred \
+            + (jac_A @ states_delta[:, :, np.newaxis])[:, :, 0]
+    return states_pred, jac_A
@@ -14,6 +14,7 @@ from lib.panda_models import PandaDynamicsModel, PandaEKFMeasurementModel, Panda
 from lib.fusion import CrossModalWeights
 import lib.panda_kf_training as training
 from lib.fusion import KalmanFusionModel
+from lib import rollouts
 
 from fannypack import utils
 
@@ -35,7 +36,7 @@ def get_actions(trajectories, start_time=0, max_timesteps=300):
 
 def rollout_kf(kf_model, trajectories, start_time=0, max_timesteps=300,
                noisy_dynamics=False, true_initial=False, init_state_noise=0.2,
-               save_data_name=None):
+               save_data_name=None, pre_encode=False, encode_chunk_size=1024):
     # To make things easier, we're going to cut all our trajectories to the
     # same length :)
 
@@ -51,100 +52,21 @@ def rollout_kf(kf_model, trajectories, start_time=0, max_timesteps=300,
     contact_states = [action[start_time: end_time][:, -1]
                       for states, obs, action in trajectories]
 
-    state_dim = len(actual_states[0][0])
-    N = len(trajectories)
-    controls_dim = trajectories[0][2][0].shape
-
     device = next(kf_model.parameters()).device
 
-    initial_states = np.zeros((N, state_dim))
-    initial_sigmas = np.zeros((N, state_dim, state_dim))
-    initial_obs = {}
-
-    if true_initial:
-        for i in range(N):
-            initial_states[i] = trajectories[i][0][0] + np.random.normal(0.0, scale=init_state_noise,
-                                                                         size=initial_states[i].shape)
-            initial_sigmas[i] = np.eye(state_dim) * init_state_noise ** 2
-        (initial_states,
-         initial_sigmas) = utils.to_torch((
-            initial_states,
-            initial_sigmas), device=device)
-    else:
-        # Put into measurement model!
-        dummy_controls = torch.ones((N,) + controls_dim, ).to(device)
-        for i in range(N):
-            utils.DictIterator(initial_obs).append(utils.DictIterator(trajectories[i][1])[0])
-
-        utils.DictIterator(initial_obs).convert_to_numpy()
-
-        (initial_obs,
-         initial_states,
-         initial_sigmas) = utils.to_torch((initial_obs,
-                                           initial_states,
-                                           initial_sigmas), device=device)
-
-        states_tuple = kf_model.forward(
-            initial_states,
-            initial_sigmas,
-            initial_obs,
-            dummy_controls,
-        )
-
-        initial_states = states_tuple[0]
-        initial_sigmas = states_tuple[1]
-        predicted_states = [[utils.to_numpy(initial_states[i])]
-                            for i in range(len(trajectories))]
-
-    states = initial_states
-    sigmas = initial_sigmas
-
-    predicted_states = [[utils.to_numpy(initial_states[i])]
-                        for i in range(len(trajectories))]
-    predicted_sigmas = [[utils.to_numpy(initial_sigmas[i])]
-                        for i in range(len(trajectories))]
-
-    for t in tqdm(range(start_time + 1, end_time)):
-        s = []
-        o = {}
-        c = []
-
-        for i, traj in enumerate(trajectories):
-            s, observations, controls = traj
-
-            o_t = utils.DictIterator(observations)[t]
-            utils.DictIterator(o).append(o_t)
-            c.append(controls[t])
-
-        s = np.array(s)
-        utils.DictIterator(o).convert_to_numpy()
-        c = np.array(c)
-        (s, o, c) = utils.to_torch((s, o, c), device=device)
-
-        estimates = kf_model.forward(
-            states,
-            sigmas,
-            o,
-            c,
-        )
-
-        state_estimates = estimates[0].data
-        sigma_estimates = estimates[1].data
-
-        states = state_estimates
-        sigmas = sigma_estimates
-
-        for i in range(len(trajectories)):
-            predicted_states[i].append(
-                utils.to_numpy(
-                    state_estimates[i]))
-            predicted_sigmas[i].append(
-                utils.to_numpy(
-                    sigma_estimates[i]))
-
-    predicted_states = np.array(predicted_states)
+    batch = rollouts.TrajectoryBatch(trajectories, end_time, device)
+    adapter = rollouts.KalmanFilterAdapter(
+        kf_model,
+        true_initial=true_initial,
+        init_state_noise=init_state_noise,
+        pre_encode=pre_encode,
+        encode_chunk_size=encode_chunk_size)
+    results = rollouts.run_rollout(
+        adapter, batch, start_time, end_time, progress=True)
+
+    predicted_states = results['states']
     actual_states = np.array(actual_states)
-    predicted_sigmas = np.array(predicted_sigmas)
+    predicted_sigmas = results['sigmas']
 
     rmse_x = np.sqrt(np.mean(
         (predicted_states[:, start_time:, 0] - actual_states[:, start_time:, 0]) ** 2))
@@ -173,7 +95,8 @@ def rollout_kf(kf_model, trajectories, start_time=0, max_timesteps=300,
     return predicted_states, actual_states, predicted_sigmas, contact_states
 
 def rollout_kf_full(kf_model, trajectories, start_time=0, max_timesteps=300,
-                    true_initial=False, init_state_noise=0.2,):
+                    true_initial=False, init_state_noise=0.2,
+                    pre_encode=False, encode_chunk_size=1024):
     # To make things easier, we're going to cut all our trajectories to the
     # same length :)
 
@@ -191,143 +114,39 @@ def rollout_kf_full(kf_model, trajectories, start_time=0, max_timesteps=300,
 
     actions = get_actions(trajectories, start_time, max_timesteps)
 
-    state_dim = len(actual_states[0][0])
-    N = len(trajectories)
-    controls_dim = trajectories[0][2][0].shape
-
     device = next(kf_model.parameters()).device
 
-    initial_states = np.zeros((N, state_dim))
-    initial_sigmas = np.zeros((N, state_dim, state_dim))
-    initial_obs = {}
-
-    if true_initial:
-        for i in range(N):
-            initial_states[i] = trajectories[i][0][0] + np.random.normal(0.0, scale=init_state_noise,
-                                                                         size=initial_states[i].shape)
-            initial_sigmas[i] = np.eye(state_dim) * init_state_noise ** 2
-        (initial_states,
-         initial_sigmas) = utils.to_torch((
-            initial_states,
-            initial_sigmas), device=device)
-    else:
+    if not true_initial:
         print("put in measurement model")
-        # Put into measurement model!
-        dummy_controls = torch.ones((N,) + controls_dim, ).to(device)
-        for i in range(N):
-            utils.DictIterator(initial_obs).append(utils.DictIterator(trajectories[i][1])[0])
-
-        utils.DictIterator(initial_obs).convert_to_numpy()
-
-        (initial_obs,
-         initial_states,
-         initial_sigmas) = utils.to_torch((initial_obs,
-                                           initial_states,
-                                           initial_sigmas), device=device)
-
-        state, state_sigma = kf_model.measurement_model.forward(
-            initial_obs, initial_states)
-        initial_states = state
-        initial_sigmas = state_sigma
-        predicted_states = [[utils.to_numpy(initial_states[i])]
-                            for i in range(len(trajectories))]
-
-    states = initial_states
-    sigmas = initial_sigmas
-
-    predicted_states = [[utils.to_numpy(initial_states[i])]
-                        for i in range(len(trajectories))]
-    predicted_sigmas = [[utils.to_numpy(initial_sigmas[i])]
-                        for i in range(len(trajectories))]
-
-    predicted_dyn_states = [[utils.to_numpy(initial_states[i])]
-                        for i in range(len(trajectories))]
-    predicted_dyn_sigmas = [[utils.to_numpy(initial_sigmas[i])]
-                        for i in range(len(trajectories))]
-
-    predicted_meas_states = [[utils.to_numpy(initial_states[i])]
-                        for i in range(len(trajectories))]
-    predicted_meas_sigmas = [[utils.to_numpy(initial_sigmas[i])]
-                        for i in range(len(trajectories))]
 
-    # jacobian is not initialized
-    predicted_jac = [[] for i in range(len(trajectories))]
-
-    for t in tqdm(range(start_time + 1, end_time)):
-        s = []
-        o = {}
-        c = []
-
-        for i, traj in enumerate(trajectories):
-            s, observations, controls = traj
-
-            o_t = utils.DictIterator(observations)[t]
-            utils.DictIterator(o).append(o_t)
-            c.append(controls[t])
-
-        s = np.array(s)
-        utils.DictIterator(o).convert_to_numpy()
-        c = np.array(c)
-        (s, o, c) = utils.to_torch((s, o, c), device=device)
-
-        estimates = kf_model.forward(
-            states,
-            sigmas,
-            o,
-            c,
-        )
-
-        state_estimates = estimates[0].data
-        sigma_estimates = estimates[1].data
-
-        states = state_estimates
-        sigmas = sigma_estimates
-
-        dynamics_states = kf_model.dynamics_states
-        dynamics_sigma = kf_model.dynamics_sigma
-        measurement_states = kf_model.measurement_states
-        measurement_sigma = kf_model.measurement_sigma
-        dynamics_jac = kf_model.dynamics_jac
-
-
-        for i in range(len(trajectories)):
-            predicted_dyn_states[i].append(
-                utils.to_numpy(
-                   dynamics_states[i]))
-            predicted_dyn_sigmas[i].append(
-                utils.to_numpy(
-                    dynamics_sigma))
-            predicted_meas_states[i].append(
-                utils.to_numpy(
-                   measurement_states[i]))
-            predicted_meas_sigmas[i].append(
-                utils.to_numpy(
-                    measurement_sigma[i]))
-            predicted_jac[i].append(
-                utils.to_numpy(
-                    dynamics_jac[i]))
-            predicted_states[i].append(
-                utils.to_numpy(
-                    state_estimates[i]))
-            predicted_sigmas[i].append(
-                utils.to_numpy(
-                    sigma_estimates[i]))
+    batch = rollouts.TrajectoryBatch(trajectories, end_time, device)
+    adapter = rollouts.KalmanFilterAdapter(
+        kf_model,
+        true_initial=true_initial,
+        init_state_noise=init_state_noise,
+        measurement_init=True,
+        pre_encode=pre_encode,
+        encode_chunk_size=encode_chunk_size,
+        record_internals=True)
+    rollout_results = rollouts.run_rollout(
+        adapter, batch, start_time, end_time, progress=True)
 
     results={}
 
-    results['dyn_states'] = np.array(predicted_dyn_states)
-    results['dyn_sigmas'] = np.array(predicted_dyn_sigmas)
-    results['meas_states'] = np.array(predicted_meas_states)
-    results['meas_sigmas'] = np.array(predicted_meas_sigmas)
-    results['dyn_jac'] = np.array(predicted_jac)
-    results['predicted_states'] = np.array(predicted_states)
-    results['predicted_sigmas'] = np.array(predicted_sigmas)
+    results['dyn_states'] = rollout_results['dyn_states']
+    results['dyn_sigmas'] = rollout_results['dyn_sigmas']
+    results['meas_states'] = rollout_results['meas_states']
+    results['meas_sigmas'] = rollout_results['meas_sigmas']
+    # jacobian is not initialized
+    results['dyn_jac'] = rollout_results['dyn_jac'][:, 1:]
+    results['predicted_states'] = rollout_results['states']
+    results['predicted_sigmas'] = rollout_results['sigmas']
     results['actual_states'] = np.array(actual_states)
     results['contact_states'] = np.array(contact_states)
     results['actions'] = np.array(actions)
 
-    predicted_states = np.array(predicted_states)
-    actual_states = np.array(actual_states)
+    predicted_states = results['predicted_states']
+    actual_states = results['actual_states']
 
     rmse_x = np.sqrt(np.mean(
         (predicted_states[:, start_time:, 0] - actual_states[:, start_time:, 0]) ** 2))
@@ -353,135 +172,24 @@ def rollout_fusion(kf_model, trajectories, start_time=0, max_timesteps=300,
 
     contact_states = [action[start_time: end_time][:, -1]
                       for states, obs, action in trajectories]
-    state_dim = len(actual_states[0][0])
-    N = len(trajectories)
-    controls_dim = trajectories[0][2][0].shape
-
     device = next(kf_model.parameters()).device
 
-    initial_states = np.zeros((N, state_dim))
-    initial_sigmas = np.ones((N, state_dim, state_dim)) * init_state_noise ** 2
-    initial_obs = {}
+    batch = rollouts.TrajectoryBatch(trajectories, end_time, device)
+    adapter = rollouts.KalmanFusionAdapter(
+        kf_model,
+        true_initial=true_initial,
+        init_state_noise=init_state_noise)
+    results = rollouts.run_rollout(
+        adapter, batch, start_time, end_time, progress=True)
 
-    kf_model.eval
-
-    if true_initial:
-        for i in range(N):
-            initial_states[i] = trajectories[i][0][0] + np.random.normal(0.0, scale=init_state_noise,
-                                                                         size=initial_states[i].shape)
-        (initial_states,
-         initial_sigmas) = utils.to_torch((
-            initial_states,
-            initial_sigmas), device=device)
-    else:
-        # Put into measurement model!
-        dummy_controls = torch.ones((N,) + controls_dim, ).to(device)
-        for i in range(N):
-            utils.DictIterator(initial_obs).append(utils.DictIterator(trajectories[i][1])[0])
-
-        utils.DictIterator(initial_obs).convert_to_numpy()
-
-        (initial_obs,
-         initial_states,
-         initial_sigmas) = utils.to_torch((initial_obs,
-                                           initial_states,
-                                           initial_sigmas), device=device)
-
-        states_tuple = kf_model.measurement_only(
-            initial_obs,
-            initial_states,
-
-        )
-        initial_states = states_tuple[0]
-        initial_sigmas = states_tuple[1]
-        predicted_states = [[utils.to_numpy(initial_states[i])]
-                            for i in range(len(trajectories))]
-
-    states = initial_states
-    sigmas = initial_sigmas
-
-    predicted_states = [[utils.to_numpy(initial_states[i])]
-                        for i in range(len(trajectories))]
-    predicted_force_states = [[utils.to_numpy(initial_states[i])]
-                              for i in range(len(trajectories))]
-    predicted_image_states = [[utils.to_numpy(initial_states[i])]
-                              for i in range(len(trajectories))]
-
-    predicted_sigmas = [[utils.to_numpy(initial_sigmas[i])]
-                        for i in range(len(trajectories))]
-
-    predicted_force_betas = [[np.zeros(initial_states[0].shape)]
-                             for i in range(len(trajectories))]
-
-    predicted_image_betas = [[np.zeros(initial_states[0].shape)]
-                             for i in range(len(trajectories))]
-
-    predicted_contacts = [[np.zeros(1)]
-                          for i in range(len(trajectories))]
-
-    for t in tqdm(range(start_time + 1, end_time)):
-        s = []
-        o = {}
-        c = []
-
-        for i, traj in enumerate(trajectories):
-            s, observations, controls = traj
-
-            o_t = utils.DictIterator(observations)[t]
-            utils.DictIterator(o).append(o_t)
-            c.append(controls[t])
-
-        s = np.array(s)
-        utils.DictIterator(o).convert_to_numpy()
-
-        c = np.array(c)
-        (s, o_torch, c) = utils.to_torch((s, o, c), device=device)
-
-        estimates = kf_model.forward(
-            states,
-            sigmas,
-            o_torch,
-            c,
-            return_all=True
-        )
-
-        state_estimates = estimates[0].data
-        sigma_estimates = estimates[1].data
-        force_state = estimates[2].data
-        image_state = estimates[3].data
-        force_beta = estimates[4].data
-        image_beta = estimates[5].data
-
-        states = state_estimates
-        sigmas = sigma_estimates
-
-        for i in range(len(trajectories)):
-            predicted_states[i].append(
-                utils.to_numpy(
-                    state_estimates[i]))
-            predicted_sigmas[i].append(
-                utils.to_numpy(
-                    sigma_estimates[i]))
-            predicted_image_betas[i].append(
-                utils.to_numpy(image_beta[i]
-                               ))
-            predicted_force_betas[i].append(
-                utils.to_numpy(force_beta[i]
-                               ))
-            predicted_force_states[i].append(
-                utils.to_numpy(force_state[i]
-                               ))
-            predicted_image_states[i].append(
-                utils.to_numpy(image_state[i]
-                               ))
-    predicted_states = np.array(predicted_states)
+    predicted_states = results['states']
     actual_states = np.array(actual_states)
     contact_states = np.array(contact_states)
-    predicted_sigmas = np.array(predicted_sigmas)
-    predicted_image_betas = np.array(predicted_image_betas)
-    predicted_force_betas = np.array(predicted_force_betas)
-    predicted_force_states = np.array(predicted_force_states)
-    predicted_image_states = np.array(predicted_image_states)
+    predicted_sigmas = results['sigmas']
+    predicted_image_betas = results['image_betas']
+    predicted_force_betas = results['force_betas']
+    predicted_force_states = results['force_states']
+    predicted_image_states = results['image_states']
 
     rmse_x = np.sqrt(np.mean(
         (predicted_states[:, start_time:, 0] - actual_states[:, start_time:, 0]) ** 2))
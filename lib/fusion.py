@@ -8,13 +8,14 @@ from fannypack import utils
 import torch.optim as optim
 import torch.nn.functional as F
 
-from lib import utility
+from lib import ekf, utility
 
 
 class KalmanFusionModel(nn.Module):
 
     def __init__(self, image_model, force_model,
-                 weight_model, fusion_type="cross", know_image_blackout=False):
+                 weight_model, fusion_type="cross", know_image_blackout=False,
+                 multirate=False, dynamics_mode="separate", extra_models=None):
         super().__init__()
 
         self.image_model = image_model
@@ -22,160 +23,389 @@ class KalmanFusionModel(nn.Module):
         self.weight_model = weight_model
         self.fusion_type = fusion_type
 
+        # Sub-filters are fused in this order; additional experts (e.g.
+        # depth) can be passed in as `extra_models`, a name->filter dict, and
+        # are registered as `<name>_model`
+        self.modalities = ["image", "force"]
+        if extra_models is not None:
+            for name, model in extra_models.items():
+                assert name not in self.modalities
+                self.add_module(name + "_model", model)
+                self.modalities.append(name)
+
         self.state_dim = self.image_model.measurement_model.state_dim
 
         self.know_image_blackout = know_image_blackout
 
-        assert self.fusion_type in ["cross", "uni"]
-
-    def measurement_only(self, observations, states_prev):
-        force_state, force_state_sigma = \
-            self.force_model.measurement_model.forward(observations, states_prev)
-        image_state, image_state_sigma = \
-            self.image_model.measurement_model.forward(observations, states_prev)
-
-        state, state_sigma, _ = \
-            self.get_weighted_states(observations,
-                                     force_state,
-                                     force_state_sigma,
-                                     image_state,
-                                     image_state_sigma)
+        # In multi-rate mode, observations with an `image_fresh` flag only
+        # get image measurement updates when a new frame arrives; other
+        # samples use the remaining sub-filters alone, with the image
+        # estimate masked out of the fused covariance. The fused mean drops
+        # it too, except for two-modality "uni" fusion, which keeps its
+        # original inverse-variance weights
+        self.multirate = multirate
+
+        # Means & covariances can be propagated with:
+        # - "separate": each sub-filter's own dynamics model
+        # - "shared": the image sub-filter's dynamics model, run once for
+        #   every sub-filter
+        # - "batched": each sub-filter's own dynamics model, with all
+        #   predictions & Jacobians computed in a single vectorized pass;
+        #   needs the "jacfwd" Jacobian method
+        assert dynamics_mode in ("separate", "shared", "batched")
+        self.dynamics_mode = dynamics_mode
+
+        # Estimates are fused with:
+        # - "cross": learned weights from `weight_model`
+        # - "uni": inverse variances, using only covariance diagonals
+        # - "information": full covariances, in information form
+        assert self.fusion_type in ["cross", "uni", "information"]
+
+    def encode(self, observations):
+        """
+        Encodes observations for each sub-filter and the weight model; the
+        output can be passed back into `forward()` as `observation_features`.
+        """
+        modalities = self._active_modalities(observations)
+
+        observation_features = {
+            modality: self._filter(modality).encode(observations)
+            for modality in modalities
+        }
+        if self.fusion_type == "cross" and len(modalities) > 1:
+            observation_features['weights'] = \
+                self.weight_model.forward(observations)
+        return observation_features
+
+    def measurement_only(self, observations, states_prev,
+                         observation_features=None):
+        if observation_features is None:
+            observation_features = self.encode(observations)
+
+        modalities = [
+            modality for modality in self._active_modalities(observations)
+            if modality in observation_features
+        ]
+        estimates = [
+            self._filter(modality).measurement_model.score(
+                observation_features[modality], states_prev)
+            for modality in modalities
+        ]
+        if len(estimates) == 1:
+            return estimates[0]
+
+        state, state_sigma, _ = self.fuse(
+            observations,
+            modalities,
+            torch.stack([state for state, _ in estimates]),
+            torch.stack([state_sigma for _, state_sigma in estimates]),
+            observation_features.get('weights'))
 
         return state, state_sigma
 
-    def get_weighted_states(self, observations,
-                            force_state,
-                            force_state_sigma,
-                            image_state,
-                            image_state_sigma):
-
-        N, state_dim = force_state.shape
-        device = force_state.device
-        states_pred = torch.stack([image_state, force_state])
-        state_sigma_pred = torch.stack(
-            [image_state_sigma, force_state_sigma])
+    def fuse(self, observations, modalities, states_pred, state_sigma_pred,
+             betas=None):
+        """
+        Fuses estimates from several sub-filters, in one batched operation.
+
+        Args:
+            observations (dict): key->(N, *) observations.
+            modalities (list): names of the K fused modalities, as a subset
+                of `self.modalities`.
+            states_pred (torch.Tensor): (K, N, state_dim) estimates.
+            state_sigma_pred (torch.Tensor): (K, N, state_dim, state_dim)
+                covariances.
+            betas (tuple, optional): output of `weight_model`; only used for
+                "cross" fusion.
+        Returns:
+            state (torch.Tensor): (N, state_dim) fused estimates.
+            state_sigma (torch.Tensor): (N, state_dim, state_dim) fused
+                covariances.
+            weights (torch.Tensor): (K, N, state_dim) weight of each modality.
+        """
+        K, N, state_dim = states_pred.shape
+        assert state_sigma_pred.shape == (K, N, state_dim, state_dim)
+        device = states_pred.device
+
+        # (N,) samples whose image estimates are ignored
+        skip_indices = None
+        if "image" in modalities:
+            image_index = modalities.index("image")
+            skip_indices = self._image_skip_indices(observations, N)
+        if skip_indices is not None:
+            # (K, N, 1) mask of ignored estimates
+            skip_mask = torch.zeros((K, N, 1), dtype=torch.bool, device=device)
+            skip_mask[image_index] = skip_indices[:, np.newaxis]
+            other_mask = skip_indices[np.newaxis, :, np.newaxis] & ~skip_mask
 
         if self.fusion_type == "cross":
-            force_beta, image_beta = self.weight_model.forward(observations)
-
-            if self.know_image_blackout:
-                blackout_indices = torch.sum(torch.abs(
-                    observations['image'].reshape((N, -1))), dim=1) < 1e-3
-
-                mask_shape = (N, 1)
-                mask = torch.ones(mask_shape, device=device)
-                mask[blackout_indices] = 0
-
-                image_beta_new = torch.zeros(mask_shape, device=device)
-
-                image_beta_new[blackout_indices] = 1e-9
-                image_beta = image_beta_new + mask * image_beta
-
-                force_beta_new = torch.zeros(mask_shape, device=device)
-                force_beta_new[blackout_indices] = 1. - 1e-9
-                force_beta = force_beta_new + mask * force_beta
-
-            weights = torch.stack([image_beta[:, 0:state_dim],
-                                   force_beta[:, 0:state_dim]])
-
-            # weights for sigma
-            weights_for_sigma = [torch.diag_embed(1./(image_beta[:, 0:state_dim]+1e-9), offset=0, dim1=-2, dim2=-1),
-                                 torch.diag_embed(1./(force_beta[:, 0:state_dim]+1e-9), offset=0, dim1=-2, dim2=-1)]
-
-            # todo: this only works for state dim =2, can use lower triangle for more dim?
-            # setting diagonals
-            weights_for_sigma[0][:, 0, 1] = image_beta[:, -1]
-            weights_for_sigma[0][:, 1, 0] = image_beta[:, -1]
-
-            weights_for_sigma[1][:, 0, 1] = force_beta[:, -1]
-            weights_for_sigma[1][:, 1, 0] = force_beta[:, -1]
-
-            weights_for_sigma = torch.stack(weights_for_sigma)
+            if betas is None:
+                betas = self.weight_model.forward(observations)
+
+            # (K, N, state_dim + 1); the last column weights off-diagonals
+            betas = self._stack_betas(betas)[
+                [self.modalities.index(modality) for modality in modalities]]
+
+            if skip_indices is not None:
+                # Ignored images get a weight of ~0, and the other modalities
+                # split the rest
+                betas = torch.where(skip_mask, torch.full_like(betas, 1e-9),
+                                    betas)
+                betas = torch.where(
+                    other_mask,
+                    torch.full_like(betas, (1. - 1e-9) / (K - 1)),
+                    betas)
+
+            weights = betas[:, :, 0:state_dim]
+
+            # weights for sigma: inverse weights on the diagonals, and the
+            # last beta on every off-diagonal
+            weights_for_sigma = torch.diag_embed(
+                1. / (weights + 1e-9), offset=0, dim1=-2, dim2=-1)
+            off_diagonals = ~torch.eye(
+                state_dim, dtype=torch.bool, device=device)
+            weights_for_sigma = torch.where(
+                off_diagonals,
+                betas[:, :, -1, np.newaxis, np.newaxis],
+                weights_for_sigma)
 
             state = self.weighted_average(states_pred, weights)
             state_sigma = self.weighted_average(
                 state_sigma_pred, weights_for_sigma)
 
-        else:
+        elif self.fusion_type == "uni":
             #todo: is it necessary to blackout diagonals for new sigma?
 
-            image_mat = image_state_sigma.clone()
-            image_mat[:, 1, 0] = 0
-            image_mat[:, 0, 1] = 0
-            image_weight = 1.0 / (utility.diag_to_vector(image_mat) + 1e-9)
-
-            force_mat = force_state_sigma.clone()
-            force_mat[:, 1, 0] = 0
-            force_mat[:, 0, 1] = 0
-            force_weight = 1.0 / (utility.diag_to_vector(force_mat) + 1e-9)
-
-            try:
-                state_sigma = torch.inverse(
-                    torch.inverse(image_mat) +
-                    torch.inverse(force_mat))
-            except:
-                print("need safety")
-                safety = 1e-6
-                state_sigma = torch.inverse(
-                    torch.inverse(image_mat + safety) +
-                    torch.inverse(force_mat + safety) + safety)
-
-            if self.know_image_blackout:
-                blackout_indices = torch.sum(torch.abs(
-                    observations['image'].reshape((N, -1))), dim=1) < 1e-3
-
-                mask_shape = (N, 1)
-                mask = torch.ones(mask_shape, device=device)
-                mask[blackout_indices] = 0
-
-                image_mat_new = torch.zeros(mask_shape, device=device)
-                image_mat_new[blackout_indices] = 1e-9
-
-                force_beta_new = torch.zeros(mask_shape, device=device)
-                force_beta_new[blackout_indices] = 1. - 1e-9
-                force_weight = force_beta_new + mask * force_weight
-
-                state_sigma[blackout_indices] = force_state_sigma[blackout_indices]
-
-            weights = torch.stack([image_weight, force_weight])
+            # Only the diagonals are used, so each weight is an inverse
+            # variance and the fused covariance is diagonal
+            #
+            # (K, N, state_dim)
+            variances = torch.diagonal(state_sigma_pred, dim1=-2, dim2=-1)
+            weights = 1.0 / (variances + 1e-9)
+
+            # Information fusion: (sum of sigma_k^-1)^-1
+            state_sigma = torch.diag_embed(1.0 / torch.sum(weights, dim=0))
+
+            if skip_indices is not None:
+                # Fall back to the other modalities' covariances
+                if K == 2:
+                    other_sigma = state_sigma_pred[1 - image_index]
+                else:
+                    other_sigma = torch.diag_embed(1.0 / torch.sum(
+                        weights.masked_fill(skip_mask, 0.), dim=0))
+                state_sigma = torch.where(
+                    skip_indices[:, np.newaxis, np.newaxis],
+                    other_sigma,
+                    state_sigma)
+
+                # With more than two modalities, ignored images get a weight
+                # of ~0 in the mean too, so that it stays consistent with the
+                # covariance. Two-modality fusion keeps its original weights.
+                if K > 2:
+                    weights = weights.masked_fill(skip_mask, 1e-9)
+                weights = torch.where(
+                    other_mask,
+                    torch.full_like(weights, (1. - 1e-9) / (K - 1)),
+                    weights)
+
             state = self.weighted_average(states_pred, weights)
 
+        else:
+            # Product of Gaussians: the fused information matrix is the sum
+            # of each modality's, and the fused information vector is the
+            # sum of sigma_k^-1 mu_k
+            #
+            # (K, N, state_dim, state_dim)
+            information = torch.cholesky_inverse(
+                torch.linalg.cholesky(state_sigma_pred))
+            if skip_indices is not None:
+                information = information.masked_fill(
+                    skip_mask[..., np.newaxis], 0.)
+
+            information_sum = torch.sum(information, dim=0)
+            information_vector = torch.sum(
+                information @ states_pred[..., np.newaxis], dim=0)
+
+            information_cholesky = torch.linalg.cholesky(information_sum)
+            state_sigma = torch.cholesky_inverse(information_cholesky)
+            state = torch.cholesky_solve(
+                information_vector, information_cholesky)[..., 0]
+
+            # Report precisions as weights
+            weights = torch.diagonal(information, dim1=-2, dim2=-1)
+
         return state, state_sigma, weights
 
     def forward(self, states_prev,
                 state_sigma_prev,
                 observations,
                 controls,
-                return_all=False):
+                return_all=False,
+                observation_features=None):
 
             N, state_dim = states_prev.shape
 
+            if observation_features is None:
+                observation_features = self.encode(observations)
+
             assert state_sigma_prev is not None
-            image_state, image_state_sigma = self.image_model.forward(
-                states_prev,
-                state_sigma_prev,
+
+            # Dynamics predictions for each sub-filter
+            predictions = self._predict(
+                states_prev, state_sigma_prev, controls)
+
+            # In multi-rate mode, the image sub-filter is skipped entirely
+            # when no sample has a new frame
+            modalities = self._active_modalities(observations)
+            estimates = [
+                self._filter_step(
+                    self._filter(modality),
+                    predictions[self.modalities.index(modality)],
+                    states_prev,
+                    state_sigma_prev,
+                    observations,
+                    controls,
+                    observation_features[modality],
+                )
+                for modality in modalities
+            ]
+            force_index = modalities.index("force")
+            force_state, force_state_sigma = estimates[force_index]
+
+            if len(estimates) == 1:
+                if return_all:
+                    return force_state, force_state_sigma, force_state, \
+                        force_state, torch.ones_like(force_state), \
+                        torch.zeros_like(force_state)
+                return force_state, force_state_sigma, force_state, force_state
+
+            state, state_sigma, weights = self.fuse(
                 observations,
-                controls,
-            )
+                modalities,
+                torch.stack([state for state, _ in estimates]),
+                torch.stack([state_sigma for _, state_sigma in estimates]),
+                observation_features.get('weights'))
+
+            if "image" in modalities:
+                image_index = modalities.index("image")
+                image_state = estimates[image_index][0]
+                image_weights = weights[image_index]
+            else:
+                image_state = force_state
+                image_weights = torch.zeros_like(force_state)
 
-            force_state, force_state_sigma = self.force_model.forward(
+            if return_all:
+                return state, state_sigma, force_state, image_state, \
+                    weights[force_index], image_weights
+
+            return state, state_sigma, force_state, image_state
+
+    def _filter(self, modality):
+        """
+        Sub-filter for a modality.
+        """
+        return getattr(self, modality + "_model")
+
+    def _active_modalities(self, observations):
+        """
+        Modalities to run for a timestep: all of them, except for images in
+        multi-rate mode when no sample has a new frame.
+        """
+        if self._images_stale(observations):
+            return [
+                modality for modality in self.modalities
+                if modality != "image"
+            ]
+        return list(self.modalities)
+
+    def _stack_betas(self, betas):
+        """
+        Stack the outputs of `weight_model` into a (K, N, state_dim + 1)
+        tensor, in the order of `self.modalities`.
+        """
+        # Weight models output (image, force, ...) betas, but the original
+        # two-modality fusion used the first for the force sub-filter and
+        # the second for the image sub-filter; we swap them to keep trained
+        # models working
+        betas = list(betas)
+        assert len(betas) == len(self.modalities)
+        return torch.stack([betas[1], betas[0]] + betas[2:])
+
+    def _predict(self, states_prev, state_sigma_prev, controls):
+        """
+        Dynamics prediction step for each sub-filter, according to
+        `dynamics_mode`. Returns a list of (states_pred, states_sigma_pred)
+        tuples, in the order of `self.modalities`; entries are None if each
+        sub-filter should run its own prediction step.
+        """
+        K = len(self.modalities)
+        if self.dynamics_mode == "separate":
+            return [None] * K
+
+        if self.dynamics_mode == "shared":
+            prediction = self.image_model.predict(
+                states_prev, state_sigma_prev, controls)
+            return [prediction] * K
+
+        # Batched: vmap over every dynamics model's weights
+        filters = [self._filter(modality) for modality in self.modalities]
+        assert all(f.jacobian_method == "jacfwd" for f in filters), \
+            "Batched dynamics require the jacfwd Jacobian method!"
+
+        # (K, N, state_dim), (K, N, state_dim, state_dim)
+        states_pred, jac_A = utility.vmap_modules(
+            [f.dynamics_model for f in filters],
+            ekf.dynamics_jacobian,
+            states_prev,
+            controls)
+        return [
+            f.predict(states_prev, state_sigma_prev, controls,
+                      linearization=(states_pred[i], jac_A[i]))
+            for i, f in enumerate(filters)
+        ]
+
+    def _filter_step(self, model, prediction, states_prev, state_sigma_prev,
+                     observations, controls, observation_features):
+        """
+        Run a sub-filter, from an optional output of `_predict()`.
+        """
+        if prediction is None:
+            return model.forward(
                 states_prev,
                 state_sigma_prev,
                 observations,
                 controls,
+                observation_features=observation_features,
             )
-
-            state, state_sigma, weights = \
-                self.get_weighted_states(observations,
-                                         force_state,
-                                         force_state_sigma,
-                                         image_state,
-                                         image_state_sigma,)
-
-            if return_all:
-                return state, state_sigma, force_state, image_state, weights[1], weights[0]
-
-            return state, state_sigma, force_state, image_state
+        return model.update(
+            *prediction, observations,
+            observation_features=observation_features)
+
+    def _images_stale(self, observations):
+        """
+        In multi-rate mode, whether no sample in the batch has a new frame.
+        """
+        return self.multirate and 'image_fresh' in observations \
+            and not torch.any(observations['image_fresh'] > 0)
+
+    def _image_skip_indices(self, observations, N):
+        """
+        (N,) mask of samples whose image estimates should be ignored: blacked
+        out images if `know_image_blackout` is set, and stale frames in
+        multi-rate mode. None if neither applies. `fuse()` gives these
+        estimates ~0 weight, or no information, in every fusion type.
+        """
+        skip_indices = None
+        if self.know_image_blackout:
+            skip_indices = torch.sum(torch.abs(
+                observations['image'].reshape((N, -1))), dim=1) < 1e-3
+        if self.multirate and 'image_fresh' in observations:
+            stale_indices = observations['image_fresh'].reshape(N) <= 0
+            if skip_indices is None:
+                skip_indices = stale_indices
+            else:
+                skip_indices = skip_indices | stale_indices
+        return skip_indices
 
     def weighted_average(self, predictions, weights):
 
@@ -194,14 +424,17 @@ class KalmanFusionModel(nn.Module):
     #     return mu
 
 class ConstantWeights(nn.Module):
-    def __init__(self, state_dim=2, use_softmax=True, use_log_softmax=True,):
+    def __init__(self, state_dim=2, use_softmax=True, use_log_softmax=True,
+                 modality_count=2):
         super().__init__()
 
         assert use_softmax
         self.use_log_softmax = use_log_softmax
 
         self.state_dim = state_dim
-        self.logits = nn.Parameter(torch.zeros((1, 2, self.state_dim + 1)))
+        self.modality_count = modality_count
+        self.logits = nn.Parameter(
+            torch.zeros((1, modality_count, self.state_dim + 1)))
 
     def forward(self, observations):
         N = observations['image'].shape[0]
@@ -215,22 +448,21 @@ class ConstantWeights(nn.Module):
         softmax = softmax_fn(
             self.logits,
             dim=1
-        ).expand([N, 2, self.state_dim + 1])
-        force_prop_beta = softmax[:, 0, :]
-        image_beta = softmax[:, 1, :]
+        ).expand([N, self.modality_count, self.state_dim + 1])
 
-        return image_beta, force_prop_beta
+        return _split_betas(softmax)
 
 
 class CrossModalWeights(nn.Module):
 
     def __init__(self, state_dim=2, units=32, use_softmax=True,
-                 use_log_softmax=False):
+                 use_log_softmax=False, modality_count=2):
         super().__init__()
 
         obs_pose_dim = 3
         obs_sensors_dim = 7
         self.state_dim = state_dim
+        self.modality_count = modality_count
         self.use_softmax = use_softmax
         self.use_log_softmax = use_log_softmax
 
@@ -268,8 +500,8 @@ class CrossModalWeights(nn.Module):
             resblocks.Linear(units, activation='leaky_relu'),
         )
 
-        # todo: the +1 only works for state dim =2
-        # it should be self.state_dim + (state_dim)(state_dim-1)/2
+        # Each modality gets a weight per state dimension, plus one for all
+        # off-diagonal covariance terms; see `KalmanFusionModel.fuse()`
 
         if self.use_softmax:
             self.shared_layers = nn.Sequential(
@@ -278,9 +510,10 @@ class CrossModalWeights(nn.Module):
                 resblocks.Linear(units, units),
                 resblocks.Linear(units, units),
                 resblocks.Linear(units, units),
-                nn.Linear(units, 2 * (self.state_dim + 1)),
+                nn.Linear(units, modality_count * (self.state_dim + 1)),
             )
         else:
+            assert modality_count == 2
             self.shared_layers = nn.Sequential(
                 nn.Linear(units * 3, units * 3),
                 nn.ReLU(inplace=True),
@@ -312,6 +545,13 @@ class CrossModalWeights(nn.Module):
 
         self.units = units
 
+        # Image features from the last timestep with an `image_fresh` flag
+        self._cached_image_features = None
+
+        # (# of images, # of frames encoded) since the last
+        # `utility.reset_image_dedup_counts()`
+        self.image_dedup_counts = None
+
     def forward(self, observations):
         assert type(observations) == dict
 
@@ -319,11 +559,21 @@ class CrossModalWeights(nn.Module):
 
         N = observations['image'].shape[0]
 
+        # If observations come with an `image_fresh` flag, image features are
+        # only recomputed for new frames
+        fresh = observations.get('image_fresh')
+        image_features = utility.encode_fresh(
+            self._encode_unique_images,
+            observations['image'],
+            fresh,
+            self._cached_image_features)
+        if fresh is not None:
+            self._cached_image_features = image_features
+
         # Construct observations feature vector
         # (N, obs_dim)
         observation_features = torch.cat((
-            self.observation_image_layers(
-                observations['image'][:, np.newaxis, :, :]),
+            image_features,
             self.observation_pose_layers(observations['gripper_pos']),
             self.observation_sensors_layers(
                 observations['gripper_sensors']),
@@ -339,11 +589,11 @@ class CrossModalWeights(nn.Module):
                 softmax_fn = F.softmax
 
             softmax = softmax_fn(
-                shared_features.reshape((N, 2, self.state_dim + 1)),
+                shared_features.reshape(
+                    (N, self.modality_count, self.state_dim + 1)),
                 dim=1
             )
-            force_prop_beta = softmax[:, 0, :]
-            image_beta = softmax[:, 1, :]
+            return _split_betas(softmax)
         else:
             assert shared_features.shape == (N, self.units * 3)
             force_prop_beta = self.force_prop_layer(
@@ -352,3 +602,23 @@ class CrossModalWeights(nn.Module):
                 shared_features[:, self.units + 1:(self.units + 1) * 2])
 
         return image_beta, force_prop_beta
+
+    def _encode_unique_images(self, images):
+        # Repeated frames are only encoded once
+        # (N, 32, 32) => (N, units)
+        features, unique_count = utility.encode_unique(
+            lambda x: self.observation_image_layers(x[:, np.newaxis, :, :]),
+            images)
+        utility.record_image_dedup(self, len(images), unique_count)
+        return features
+
+
+def _split_betas(betas):
+    """
+    Split (N, K, *) weights into a tuple of K (N, *) tensors. The first two
+    are swapped, to match the (image, force) outputs of the original
+    two-modality weight models.
+    """
+    K = betas.shape[1]
+    order = [1, 0] + list(range(2, K))
+    return tuple(betas[:, k] for k in order)
@@ -3,135 +3,548 @@ import torch.nn as nn
 import numpy as np
 import fannypack.utils as utils
 
+from . import dpf, utility
+
 
 class ParticleFusionModel(nn.Module):
-    def __init__(self, image_model, force_model, weight_model):
+    def __init__(self, image_model, force_model, weight_model,
+                 resample_method="multinomial", multirate=False,
+                 dynamics_mode="separate", scoring_mode="separate",
+                 extra_models=None, particle_budgets=None):
         super().__init__()
 
         self.image_model = image_model
         self.force_model = force_model
         self.weight_model = weight_model
 
+        # Sub-filters are fused in this order, which should match the order
+        # of `weight_model` outputs; additional experts (e.g. depth) can be
+        # passed in as `extra_models`, a name->filter dict, and are
+        # registered as `<name>_model`
+        self.modalities = ["image", "force"]
+        if extra_models is not None:
+            for name, model in extra_models.items():
+                assert name not in self.modalities
+                self.add_module(name + "_model", model)
+                self.modalities.append(name)
+
+        # Relative share of particles for each sub-filter, as a name->float
+        # dict; see `_particle_counts()`. Defaults to an even split
+        if particle_budgets is None:
+            particle_budgets = {modality: 1. for modality in self.modalities}
+        assert set(particle_budgets.keys()) == set(self.modalities)
+        assert all(budget > 0. for budget in particle_budgets.values())
+        self.particle_budgets = particle_budgets
+
+        assert resample_method in dpf.resampling_methods
+        self.resample_method = resample_method
+
         weight_model.use_log_softmax = True
 
+        # Each sub-filter has a `freeze_<name>_model` flag
         self.freeze_image_model = True
         self.freeze_force_model = True
+        for modality in self.modalities[2:]:
+            setattr(self, "freeze_" + modality + "_model", True)
         self.freeze_weight_model = False
 
+        # In multi-rate mode, observations with an `image_fresh` flag only
+        # get image measurement updates when a new frame arrives; other
+        # samples use the remaining sub-filters alone
+        self.multirate = multirate
+
+        # Particles can be propagated with:
+        # - "separate": each sub-filter's own dynamics model
+        # - "shared": the image sub-filter's dynamics model, run once for
+        #   every sub-filter
+        # - "batched": each sub-filter's own dynamics model, in a single
+        #   vectorized pass; needs `PandaDynamicsModel`-style dynamics
+        assert dynamics_mode in ("separate", "shared", "batched")
+        self.dynamics_mode = dynamics_mode
+
+        # Particles can be scored with:
+        # - "separate": each sub-filter's own measurement model
+        # - "batched": sub-filters whose measurement models have identical
+        #   architectures and particle counts are scored in a single
+        #   vectorized pass
+        assert scoring_mode in ("separate", "batched")
+        self.scoring_mode = scoring_mode
+
+    def encode(self, observations):
+        """
+        Encodes observations for each sub-filter and the weight model; the
+        output can be passed back into `forward()` as `observation_features`.
+        """
+        modalities = self._active_modalities(observations)
+
+        features = {}
+        for modality in modalities:
+            with self._grad_mode(self._frozen(modality)):
+                features[modality] = \
+                    self._filter(modality).encode(observations)
+        if len(modalities) > 1:
+            with self._grad_mode(self.freeze_weight_model):
+                features['weights'] = self.weight_model(observations)
+        return features
+
     def forward(self, states_prev, log_weights_prev, observations, controls,
-                resample=True, noisy_dynamics=True, know_image_blackout=False):
+                resample=True, noisy_dynamics=True, know_image_blackout=False,
+                observation_features=None):
 
         N, M, state_dim = states_prev.shape
         assert log_weights_prev.shape == (N, M)
 
         device = states_prev.device
 
-        # If we aren't resampling, contract our particles within each
-        # individual particle filter
-        if resample:
-            output_particles = M
-        else:
-            assert M % 2 == 0
-            output_particles = M // 2
-
-        # Propagate particles through each particle filter
-        image_state_estimates, image_states_pred, image_log_weights_pred = self.image_model(
-            states_prev,
-            log_weights_prev,
-            observations,
-            controls,
-            output_particles=output_particles,
-            resample=False
-        )
-        force_state_estimates, force_states_pred, force_log_weights_pred = self.force_model(
-            states_prev,
-            log_weights_prev,
-            observations,
-            controls,
-            output_particles=output_particles,
-            resample=False
-        )
-
-        # Get weights
-        image_log_beta, force_log_beta = self.weight_model(observations)
-        assert image_log_beta.shape == (N, 1)
-        assert force_log_beta.shape == (N, 1)
-
-        self._betas = utils.to_numpy([image_log_beta, force_log_beta])
-
-        # Ignore image if blacked out
-        if know_image_blackout:
-            blackout_indices = torch.sum(torch.abs(
-                observations['image'].reshape((N, -1))), dim=1) < 1e-8
+        # Encode observations once for each particle filter
+        if observation_features is None:
+            observation_features = self.encode(observations)
 
-            ## Masking in-place breaks autograd
-            # image_log_beta[blackout_indices, :] = float('-inf')
-            # force_log_beta[blackout_indices, :] = 0.
+        # In multi-rate mode, the image sub-filter is skipped entirely when
+        # no sample has a new frame
+        modalities = self._active_modalities(observations)
+        if len(modalities) == 1:
+            return self._single_filter(
+                modalities[0], states_prev, log_weights_prev, observations,
+                controls, resample, noisy_dynamics,
+                observation_features[modalities[0]])
 
-            mask_shape = (N, 1)
-            mask = torch.ones(mask_shape, device=device)
-            mask[blackout_indices] = 0
+        # Each particle filter outputs its share of the K * M particles that
+        # we resample from; if we aren't resampling, we contract our
+        # particles within each individual particle filter, to M in total
+        K = len(modalities)
+        particle_counts = self._particle_counts(
+            K * M if resample else M, modalities)
 
-            image_log_beta_new = torch.zeros(mask_shape, device=device)
-            image_log_beta_new[blackout_indices] = np.log(1e-9)
-            image_log_beta = image_log_beta_new + mask * image_log_beta
+        # Propagate particles through each particle filter
+        # Frozen filters are run without autograd
+        states_pred = self._predict_particles(
+            states_prev, controls, noisy_dynamics, modalities)
+        if self.scoring_mode == "batched":
+            outputs = self._batched_filter_steps(
+                modalities, states_prev, log_weights_prev, observations,
+                controls, noisy_dynamics, observation_features,
+                particle_counts, states_pred)
+        else:
+            outputs = []
+            for i, modality in enumerate(modalities):
+                with self._grad_mode(self._frozen(modality)):
+                    outputs.append(self._filter(modality)(
+                        states_prev,
+                        log_weights_prev,
+                        observations,
+                        controls,
+                        output_particles=particle_counts[i],
+                        resample=False,
+                        noisy_dynamics=noisy_dynamics,
+                        observation_features=observation_features[modality],
+                        states_pred=states_pred[i]
+                    ))
+        state_estimates, states_pred, log_weights_pred = zip(*outputs)
 
-            force_log_beta_new = torch.zeros(mask_shape, device=device)
-            force_log_beta_new[blackout_indices] = np.log(1. - 1e-9)
-            force_log_beta = force_log_beta_new + mask * force_log_beta
+        # Get weights: (K, N, 1)
+        log_betas = self._log_betas(
+            observation_features['weights'], observations, modalities, N,
+            know_image_blackout)
 
         # Weight state estimates from each filter
-        state_estimates = torch.exp(image_log_beta) * image_state_estimates \
-            + torch.exp(force_log_beta) * force_state_estimates
-
-        # Model freezing
-        if self.freeze_image_model:
-            image_state_estimates = image_state_estimates.detach()
-            image_states_pred = image_states_pred.detach()
-            image_log_weights_pred = image_log_weights_pred.detach()
-
-        if self.freeze_force_model:
-            force_state_estimates = force_state_estimates.detach()
-            force_states_pred = force_states_pred.detach()
-            force_log_weights_pred = force_log_weights_pred.detach()
-
-        if self.freeze_weight_model:
-            image_log_beta = image_log_beta.detach()
-            force_log_beta = force_log_beta.detach()
+        state_estimates = torch.sum(
+            torch.exp(log_betas) * torch.stack(state_estimates), dim=0)
 
         # Concatenate particles from each filter
-        states_pred = torch.cat([
-            image_states_pred,
-            force_states_pred,
-        ], dim=1)
+        total_particles = sum(particle_counts)
+        states_pred = torch.cat(states_pred, dim=1)
         log_weights_pred = torch.cat([
-            image_log_weights_pred + image_log_beta,
-            force_log_weights_pred + force_log_beta,
+            log_weights + log_beta
+            for log_weights, log_beta in zip(log_weights_pred, log_betas)
         ], dim=1)
+        assert log_weights_pred.shape == (N, total_particles)
+        assert states_pred.shape == (N, total_particles, state_dim)
 
         if resample:
-            assert log_weights_pred.shape == (N, 2 * M)
-            assert states_pred.shape == (N, 2 * M, state_dim)
-
-            # Resample particles
-            distribution = torch.distributions.Categorical(
-                logits=log_weights_pred)
-            state_indices = distribution.sample((M, )).T
+            # Resample particles: a single draw from the mixture of every
+            # filter's particles
+            state_indices = dpf.resample_indices(
+                log_weights_pred,
+                num_samples=M,
+                method=self.resample_method)
             assert state_indices.shape == (N, M)
 
-            states = torch.zeros((N, M, state_dim), device=device)
-            for i in range(N):
-                # We can probably optimize this loop out
-                states[i] = states_pred[i][state_indices[i]]
+            states = dpf.gather_particles(states_pred, state_indices)
 
             # Uniform weights
             log_weights = torch.zeros((N, M), device=device) - np.log(M)
         else:
             states = states_pred
-            log_weights = log_weights_pred
 
             # Normalize predicted weights
             log_weights = log_weights_pred - \
                 torch.logsumexp(log_weights_pred, dim=1)[:, np.newaxis]
 
         return state_estimates, states, log_weights
+
+    def _single_filter(self, modality, states_prev, log_weights_prev,
+                       observations, controls, resample, noisy_dynamics,
+                       features):
+        """
+        Filter update with only one sub-filter, for timesteps where no sample
+        has a new frame and no other sub-filters are left to fuse.
+        """
+        N, M, state_dim = states_prev.shape
+        device = states_prev.device
+
+        states_pred = None
+        if self.dynamics_mode == "shared":
+            states_pred = self._predict_particles(
+                states_prev, controls, noisy_dynamics, [modality])[0]
+
+        with self._grad_mode(self._frozen(modality)):
+            state_estimates, states_pred, log_weights_pred = \
+                self._filter(modality)(
+                    states_prev,
+                    log_weights_prev,
+                    observations,
+                    controls,
+                    resample=False,
+                    noisy_dynamics=noisy_dynamics,
+                    observation_features=features,
+                    states_pred=states_pred
+                )
+
+        self._betas = [
+            np.zeros((N, 1)) if other == modality
+            else np.full((N, 1), np.log(1e-9))
+            for other in self.modalities
+        ]
+
+        if resample:
+            state_indices = dpf.resample_indices(
+                log_weights_pred,
+                num_samples=M,
+                method=self.resample_method)
+            assert state_indices.shape == (N, M)
+
+            states = dpf.gather_particles(states_pred, state_indices)
+            log_weights = torch.zeros((N, M), device=device) - np.log(M)
+        else:
+            states = states_pred
+            log_weights = log_weights_pred
+
+        return state_estimates, states, log_weights
+
+    def _batched_filter_steps(self, modalities, states_prev,
+                              log_weights_prev, observations, controls,
+                              noisy_dynamics, observation_features,
+                              particle_counts, states_pred):
+        """
+        Run a set of sub-filters, scoring particles for all sub-filters that
+        share a measurement model architecture and particle count in one
+        vectorized pass. Returns a list of (state_estimates, states_pred,
+        log_weights_pred) tuples.
+        """
+        M = states_prev.shape[1]
+        K = len(modalities)
+        filters = [self._filter(modality) for modality in modalities]
+
+        # Contract particle sets and run dynamics models outside of the
+        # sub-filters, so that we can score every filter's particles first
+        inputs = []
+        for i, f in enumerate(filters):
+            filter_states_prev = states_prev
+            filter_log_weights_prev = log_weights_prev
+            filter_states_pred = states_pred[i]
+            if particle_counts[i] != M:
+                # Randomly sample some particles from our input
+                # We sample with replacement only if necessary
+                indices = torch.multinomial(
+                    torch.ones_like(log_weights_prev),
+                    num_samples=particle_counts[i],
+                    replacement=(particle_counts[i] > M))
+                filter_states_prev = dpf.gather_particles(
+                    states_prev, indices)
+                filter_log_weights_prev = dpf.gather_particles(
+                    log_weights_prev, indices)
+                if filter_states_pred is not None:
+                    filter_states_pred = dpf.gather_particles(
+                        filter_states_pred, indices)
+
+            if filter_states_pred is None:
+                with self._grad_mode(
+                        self._frozen(modalities[i])
+                        or f.freeze_dynamics_model):
+                    filter_states_pred = f.dynamics_model(
+                        filter_states_prev, controls, noisy=noisy_dynamics)
+
+            inputs.append((
+                filter_states_prev,
+                filter_log_weights_prev,
+                filter_states_pred,
+            ))
+
+        # Group sub-filters that can be scored together
+        groups = {}
+        for i, f in enumerate(filters):
+            key = _scoring_signature(
+                f.measurement_model,
+                observation_features[modalities[i]],
+                particle_counts[i])
+            groups.setdefault(i if key is None else key, []).append(i)
+
+        log_likelihoods = [None] * K
+        for indices in groups.values():
+            measurement_models = [
+                filters[i].measurement_model for i in indices]
+            frozen = [
+                self._frozen(modalities[i])
+                or filters[i].freeze_measurement_model
+                for i in indices
+            ]
+            with self._grad_mode(all(frozen)):
+                if len(indices) == 1:
+                    i = indices[0]
+                    scores = [measurement_models[0].score(
+                        observation_features[modalities[i]], inputs[i][2])]
+                else:
+                    # (len(indices), N, particle_count)
+                    scores = utility.vmap_modules(
+                        measurement_models,
+                        _score,
+                        stacked_args=(
+                            torch.stack([
+                                observation_features[modalities[i]]
+                                for i in indices
+                            ]),
+                            torch.stack([inputs[i][2] for i in indices]),
+                        ))
+
+            for i, scores_i, frozen_i in zip(indices, scores, frozen):
+                log_likelihoods[i] = scores_i.detach() if frozen_i \
+                    else scores_i
+
+        # Weight particles and compute estimates with each sub-filter
+        outputs = []
+        for i, f in enumerate(filters):
+            filter_states_prev, filter_log_weights_prev, filter_states_pred = \
+                inputs[i]
+            with self._grad_mode(self._frozen(modalities[i])):
+                outputs.append(f(
+                    filter_states_prev,
+                    filter_log_weights_prev,
+                    observations,
+                    controls,
+                    resample=False,
+                    states_pred=filter_states_pred,
+                    observation_log_likelihoods=log_likelihoods[i]
+                ))
+        return outputs
+
+    def _log_betas(self, betas, observations, modalities, N,
+                   know_image_blackout):
+        """
+        Convert the outputs of `weight_model` to (K, N, 1) log-weights for a
+        set of sub-filters, in the order of `modalities`.
+        """
+        betas = list(betas)
+        assert len(betas) == len(self.modalities)
+        for log_beta in betas:
+            assert log_beta.shape == (N, 1)
+
+        self._betas = utils.to_numpy(betas)
+
+        K = len(modalities)
+        log_betas = torch.stack([
+            betas[self.modalities.index(modality)]
+            for modality in modalities
+        ])
+
+        if K < len(self.modalities):
+            # Renormalize weights over the sub-filters that we ran
+            log_betas = log_betas - torch.logsumexp(log_betas, dim=0)
+
+        if "image" not in modalities:
+            return log_betas
+
+        # Ignore image if blacked out, or stale in multi-rate mode: image
+        # particles get a weight of ~0, and the other filters split the rest
+        skip_indices = self._image_skip_indices(
+            observations, N, know_image_blackout)
+        if skip_indices is None:
+            return log_betas
+
+        skip_mask = torch.zeros(
+            (K, N, 1), dtype=torch.bool, device=log_betas.device)
+        skip_mask[modalities.index("image")] = skip_indices[:, np.newaxis]
+        other_mask = skip_indices[np.newaxis, :, np.newaxis] & ~skip_mask
+
+        log_betas = torch.where(
+            skip_mask,
+            torch.full_like(log_betas, np.log(1e-9)),
+            log_betas)
+        log_betas = torch.where(
+            other_mask,
+            torch.full_like(log_betas, np.log((1. - 1e-9) / (K - 1))),
+            log_betas)
+        return log_betas
+
+    def _particle_counts(self, total, modalities):
+        """
+        Split `total` particles between a set of sub-filters, in proportion
+        to their `particle_budgets`.
+        """
+        budgets = np.array([
+            self.particle_budgets[modality] for modality in modalities
+        ], dtype=np.float64)
+        exact_counts = total * budgets / np.sum(budgets)
+
+        # Round down, then hand out leftover particles to the largest
+        # remainders
+        counts = np.floor(exact_counts).astype(np.int64)
+        leftover = total - int(np.sum(counts))
+        order = np.argsort(counts - exact_counts, kind="stable")
+        counts[order[:leftover]] += 1
+        assert np.all(counts > 0), "Too few particles for every sub-filter!"
+
+        return [int(count) for count in counts]
+
+    def _predict_particles(self, states_prev, controls, noisy_dynamics,
+                           modalities):
+        """
+        Propagate particles for a set of sub-filters, according to
+        `dynamics_mode`. Returns a list of (N, M, state_dim) predictions, in
+        the order of `modalities`; entries are None if each sub-filter should
+        run its own dynamics model.
+        """
+        if self.dynamics_mode == "separate":
+            return [None] * len(modalities)
+
+        if self.dynamics_mode == "shared":
+            image_frozen = self.freeze_image_model \
+                or self.image_model.freeze_dynamics_model
+            with self._grad_mode(image_frozen):
+                states_pred = self.image_model.dynamics_model(
+                    states_prev, controls, noisy=noisy_dynamics)
+            return [states_pred] * len(modalities)
+
+        # Batched: vmap over every dynamics model's weights
+        dynamics_models = [
+            self._filter(modality).dynamics_model for modality in modalities
+        ]
+        frozen = [
+            self._frozen(modality)
+            or self._filter(modality).freeze_dynamics_model
+            for modality in modalities
+        ]
+        with self._grad_mode(all(frozen)):
+            # (K, N, M, state_dim)
+            states_pred = utility.vmap_modules(
+                dynamics_models, _predict_noise_free, states_prev, controls)
+
+            # Random sampling doesn't work inside vmap, so we add process
+            # noise here: each model's Q is diag(Q_l ** 2)
+            if noisy_dynamics:
+                stddevs = torch.stack([
+                    torch.abs(dynamics_model.Q_l)
+                    for dynamics_model in dynamics_models
+                ])
+                states_pred = states_pred + torch.randn_like(states_pred) \
+                    * stddevs[:, np.newaxis, np.newaxis, :]
+
+        return [
+            prediction.detach() if frozen_k else prediction
+            for prediction, frozen_k in zip(states_pred, frozen)
+        ]
+
+    def _filter(self, modality):
+        """
+        Sub-filter for a modality.
+        """
+        return getattr(self, modality + "_model")
+
+    def _frozen(self, modality):
+        """
+        Whether a sub-filter is frozen.
+        """
+        return getattr(self, "freeze_" + modality + "_model")
+
+    def _active_modalities(self, observations):
+        """
+        Modalities to run for a timestep: all of them, except for images in
+        multi-rate mode when no sample has a new frame.
+        """
+        if self._images_stale(observations):
+            return [
+                modality for modality in self.modalities
+                if modality != "image"
+            ]
+        return list(self.modalities)
+
+    def _images_stale(self, observations):
+        """
+        In multi-rate mode, whether no sample in the batch has a new frame.
+        """
+        return self.multirate and 'image_fresh' in observations \
+            and not torch.any(observations['image_fresh'] > 0)
+
+    def _image_skip_indices(self, observations, N, know_image_blackout):
+        """
+        (N,) mask of samples whose image particles should be ignored: blacked
+        out images if `know_image_blackout` is set, and stale frames in
+        multi-rate mode. None if neither applies.
+        """
+        skip_indices = None
+        if know_image_blackout:
+            skip_indices = torch.sum(torch.abs(
+                observations['image'].reshape((N, -1))), dim=1) < 1e-8
+        if self.multirate and 'image_fresh' in observations:
+            stale_indices = observations['image_fresh'].reshape(N) <= 0
+            if skip_indices is None:
+                skip_indices = stale_indices
+            else:
+                skip_indices = skip_indices | stale_indices
+        return skip_indices
+
+    def _grad_mode(self, frozen):
+        """
+        Context manager for running a submodel: frozen submodels are run
+        without autograd.
+        """
+        return torch.set_grad_enabled(torch.is_grad_enabled() and not frozen)
+
+
+def _predict_noise_free(dynamics_model, states_prev, controls):
+    """
+    Noise-free particle propagation, for `utility.vmap_modules()`.
+    """
+    # (N, control_dim) => (N, M, units)
+    N, M, _ = states_prev.shape
+    control_features = dynamics_model.encode_controls(controls)
+    control_features = control_features[:, np.newaxis, :].expand(N, M, -1)
+    return dynamics_model.predict(states_prev, control_features)
+
+
+def _score(measurement_model, observation_features, states):
+    """
+    Particle scoring, for `utility.vmap_modules()`.
+    """
+    return measurement_model.score(observation_features, states)
+
+
+def _scoring_signature(measurement_model, observation_features,
+                       particle_count):
+    """
+    Key for grouping sub-filters whose particles can be scored in a single
+    vectorized pass: measurement models of the same type, with identical
+    parameter & buffer shapes, tensor features of the same shape, and the
+    same particle count. None if a sub-filter should be scored on its own.
+    """
+    if not isinstance(observation_features, torch.Tensor):
+        return None
+    return (
+        type(measurement_model),
+        tuple((name, tuple(p.shape))
+              for name, p in measurement_model.named_parameters()),
+        tuple((name, tuple(b.shape))
+              for name, b in measurement_model.named_buffers()),
+        tuple(observation_features.shape),
+        particle_count,
+    )
@@ -1,3 +1,5 @@
+import functools
+
 import torch
 import numpy as np
 import scipy.stats
@@ -5,12 +7,25 @@ from tqdm.auto import tqdm
 
 from fannypack import utils
 
-from . import dpf
+from . import dpf, trajectory_cache, utility
+
+
+# Range of image values; also used to decode compact uint8 images
+image_range = (0., 1.)
+
+# State normalization constants, as (mean, std)
+_state_normalization = (
+    np.array([[0.00111589, 0.0021941]]),
+    np.array([[0.06644539, 0.06786165]]),
+)
 
 
 def load_trajectories(*paths, use_vision=True, vision_interval=10,
                       use_proprioception=True, use_haptics=True, 
-                    sequential_image_rate= 1,  **unused):
+                    sequential_image_rate= 1, use_cache=False,
+                    compact_images=False, direction_filter=None,
+                    object_filter=None,
+                    load_workers=None, **unused):
     """
     Loads a list of trajectories from a set of input paths, where each
     trajectory is a tuple containing...
@@ -20,96 +35,68 @@ def load_trajectories(*paths, use_vision=True, vision_interval=10,
 
     Each path can either be a string or a (string, int) tuple, where int
     indicates the maximum number of trajectories to import.
+
+    Trajectories are selected before they're parsed, using a per-file
+    metadata index (see `load_metadata()`): only the first `count` in each
+    file are considered, then filtered by `direction_filter` ('x' or 'y'
+    pushes, along the first or second state dimension) and `object_filter`
+    (a collection of object names, e.g. `('ellip1', 'ellip2', 'ellip3')`).
+
+    Multiple files (e.g. shards) are indexed & parsed in parallel, with up to
+    `load_workers` processes; see `trajectory_cache.map_parallel()`.
+
+    With `use_cache=True`, parsed & normalized trajectories are cached on
+    disk, keyed by the source file; see `trajectory_cache`. Cached arrays are
+    read-only memory maps, so they can't be edited in place.
+
+    With `compact_images=True`, images are stored as uint8 codes over
+    `image_range`, both in the cache and in memory (see
+    `utility.quantize_images()`); datasets decode them to floats at batch
+    time. Pass `image_range` to `rollouts.TrajectoryBatch` when rolling out
+    these trajectories.
     """
     trajectories = []
 
+    # Parse paths
+    file_paths = []
+    counts = []
     for path in paths:
         count = np.float('inf')
         if type(path) == tuple:
             path, count = path
             assert type(count) == int
-
-        with utils.TrajectoriesFile(path) as f:
-            # Iterate over each trajectory
-            for i, trajectory in enumerate(f):
-                if i >= count:
-                    break
-
-                timesteps = len(trajectory['pos'])
-
-                # Dimensions
-                state_dim = 2
-                obs_pos_dim = 3
-                obs_sensors_dim = 7
-
-                # Define our state:  we expect this to be:
-                # (x, z)
-                states = np.full((timesteps, state_dim), np.nan)
-                states[:, 0] = trajectory['pos'][:, 0]
-                states[:, 1] = trajectory['pos'][:, 2]
-
-                # Construct observations
-                #
-                # Note that only the first 3 elements of the F/T (sensors)
-                # vector is populated, because we only have force data
-                observations = {}
-                observations['gripper_pos'] = trajectory['tip']
-                observations['gripper_sensors'] = np.zeros(
-                    (timesteps, obs_sensors_dim))
-                observations['gripper_sensors'][:, :3] = trajectory['force']
-                observations['gripper_sensors'][:, 6] = trajectory['contact']
-                
-                #todo: add blackout/sequential
-                # observations['image'] = np.zeros_like(trajectory['image'])
-                # if use_vision:
-                #     for i in range(len(observations['image'])):
-                #         index = (i // vision_interval) * vision_interval
-                #         index = min(index, len(observations['image']))
-                #         blackout_chance = np.random.uniform()
-                #         # if blackout chance > ratio, then fill image
-                #         # otherwise zero
-                #         if i % sequential_image_rate == 0:
-                #             observations['image'][i] = trajectory['image'][index]
-
-                #         if blackout_chance > image_blackout_ratio:
-                #             observations['image'][i] = trajectory['image'][index]
-
-                # todo: why mean? 
-                observations['image'] = np.mean(trajectory['image'], axis=-1)
-
-                # Construct controls
-                eef_positions = trajectory['tip']
-                eef_positions_shifted = np.roll(eef_positions, shift=-1)
-                eef_positions_shifted[-1] = eef_positions[-1]
-                controls = np.concatenate([
-                    eef_positions_shifted,
-                    eef_positions - eef_positions_shifted,
-                    trajectory['contact'][:, np.newaxis],
-                ], axis=1)
-                assert controls.shape == (timesteps, 7)
-
-                # Normalization
-                observations['gripper_pos'] -= np.array(
-                    [[-0.00399523, 0., 0.00107464]])
-                observations['gripper_pos'] /= np.array(
-                    [[0.07113902, 1., 0.0682641]])
-                observations['gripper_sensors'] -= np.array(
-                    [[-1.88325821e-01, -8.78638581e-02, -1.91555331e-04,
-                      0., 0., 0., 6.49803922e-01]])
-                observations['gripper_sensors'] /= np.array(
-                    [[2.04928469, 2.04916813, 0.00348241, 1., 1., 1.,
-                      0.47703122]])
-                states -= np.array([[0.00111589, 0.0021941]])
-                states /= np.array([[0.06644539, 0.06786165]])
-                controls -= np.array(
-                    [[-3.39131082e-06, 9.89458979e-04, -3.91004959e-03,
-                      -3.99184253e-03, -9.89458979e-04, 4.98469281e-03,
-                      6.49803922e-01]])
-                controls /= np.array(
-                    [[0.01032934, 0.06751064, 0.07186062, 0.07038562,
-                      0.06751064, 0.09715582, 0.47703122]])
-
-                trajectories.append((states, observations, controls))
+        file_paths.append(path)
+        counts.append(count)
+
+    # Pick trajectories from each file's metadata index
+    jobs = []
+    for path, count, metadata in zip(
+            file_paths, counts, trajectory_cache.map_parallel(
+                load_metadata, file_paths, load_workers)):
+        indices = [
+            i for i in range(len(metadata['length']))
+            if i < count
+            and (direction_filter not in ('x', 'y')
+                 or metadata['push_direction'][i] == direction_filter)
+            and (object_filter is None
+                 or metadata['object'][i] in object_filter)
+        ]
+
+        file_kwargs = {
+            'indices': indices,
+            'compact_images': compact_images,
+        }
+        jobs.append((
+            path,
+            "omnipush_datasets",
+            functools.partial(_load_file, path, **file_kwargs),
+            file_kwargs,
+        ))
+
+    # Files are parsed in parallel; results stay in input order
+    for file_trajectories in trajectory_cache.load_all(
+            jobs, load_workers, use_cache=use_cache):
+        trajectories.extend(file_trajectories)
 
     ## Uncomment this line to generate the lines required to normalize data
     # _print_normalization(trajectories)
@@ -117,6 +104,165 @@ def load_trajectories(*paths, use_vision=True, vision_interval=10,
     return trajectories
 
 
+def load_metadata(path):
+    """
+    Load the metadata index of a file; built once, then cached. Contains
+    per-trajectory columns...
+        length: (N,) # of timesteps
+        offsets: (N + 1,) trajectory boundaries in `positions`
+        positions: (sum(T), 2) normalized object positions
+        state_delta: (N, 2) normalized object displacement over each
+            trajectory
+        push_direction: (N,) 'x', 'y', or '' for other pushes
+        contact_fraction: (N,) fraction of timesteps in contact
+        object: (N,) object names
+    """
+    metadata = trajectory_cache.load_metadata(
+        path, "omnipush_datasets", lambda: _build_metadata(path))
+
+    metadata['push_direction'] = np.array(
+        [_push_direction(*delta) for delta in metadata['state_delta']],
+        dtype=str)
+    return metadata
+
+
+def _build_metadata(path):
+    """
+    Build the metadata index of a file, excluding derived columns.
+    """
+    lengths = []
+    positions = [np.zeros((0, 2))]
+    contact_fractions = []
+    objects = []
+    with utils.TrajectoriesFile(path) as f:
+        for trajectory in f:
+            lengths.append(len(trajectory['pos']))
+            positions.append(
+                (trajectory['pos'][:, [0, 2]] - _state_normalization[0])
+                / _state_normalization[1])
+            contact_fractions.append(np.mean(trajectory['contact']))
+            if 'object' in trajectory:
+                objects.append(trajectory['object'][0].decode('utf-8'))
+            else:
+                objects.append('')
+
+    offsets = np.cumsum([0] + lengths)
+    positions = np.concatenate(positions)
+    return {
+        'length': np.array(lengths, dtype=np.int64),
+        'offsets': offsets,
+        'positions': positions,
+        'state_delta': positions[offsets[1:] - 1] - positions[offsets[:-1]],
+        'contact_fraction': np.array(contact_fractions, dtype=np.float64),
+        'object': np.array(objects, dtype=str),
+    }
+
+
+def _push_direction(delta_0, delta_1):
+    """
+    Classify a push from its (normalized) object displacement: 'x' or 'y' if
+    it's mostly along the first or second state dimension, '' otherwise.
+    """
+    if abs(delta_0) > 2. * abs(delta_1):
+        return 'x'
+    if abs(delta_1) > 2. * abs(delta_0):
+        return 'y'
+    return ''
+
+
+def _load_file(path, indices, compact_images=False):
+    """
+    Parses and normalizes the trajectories at `indices` from a single file.
+    """
+    trajectories = []
+
+    with utils.TrajectoriesFile(path) as f:
+        # Iterate over selected trajectories
+        for i in indices:
+            trajectory = f[i]
+
+            timesteps = len(trajectory['pos'])
+
+            # Dimensions
+            state_dim = 2
+            obs_pos_dim = 3
+            obs_sensors_dim = 7
+
+            # Define our state:  we expect this to be:
+            # (x, z)
+            states = np.full((timesteps, state_dim), np.nan)
+            states[:, 0] = trajectory['pos'][:, 0]
+            states[:, 1] = trajectory['pos'][:, 2]
+
+            # Construct observations
+            #
+            # Note that only the first 3 elements of the F/T (sensors)
+            # vector is populated, because we only have force data
+            observations = {}
+            observations['gripper_pos'] = trajectory['tip']
+            observations['gripper_sensors'] = np.zeros(
+                (timesteps, obs_sensors_dim))
+            observations['gripper_sensors'][:, :3] = trajectory['force']
+            observations['gripper_sensors'][:, 6] = trajectory['contact']
+            
+            #todo: add blackout/sequential
+            # observations['image'] = np.zeros_like(trajectory['image'])
+            # if use_vision:
+            #     for i in range(len(observations['image'])):
+            #         index = (i // vision_interval) * vision_interval
+            #         index = min(index, len(observations['image']))
+            #         blackout_chance = np.random.uniform()
+            #         # if blackout chance > ratio, then fill image
+            #         # otherwise zero
+            #         if i % sequential_image_rate == 0:
+            #             observations['image'][i] = trajectory['image'][index]
+
+            #         if blackout_chance > image_blackout_ratio:
+            #             observations['image'][i] = trajectory['image'][index]
+
+            # todo: why mean? 
+            observations['image'] = np.mean(trajectory['image'], axis=-1)
+            if compact_images:
+                observations['image'] = utility.quantize_images(
+                    observations['image'], image_range)
+
+            # Construct controls
+            eef_positions = trajectory['tip']
+            eef_positions_shifted = np.roll(eef_positions, shift=-1)
+            eef_positions_shifted[-1] = eef_positions[-1]
+            controls = np.concatenate([
+                eef_positions_shifted,
+                eef_positions - eef_positions_shifted,
+                trajectory['contact'][:, np.newaxis],
+            ], axis=1)
+            assert controls.shape == (timesteps, 7)
+
+            # Normalization
+            observations['gripper_pos'] -= np.array(
+                [[-0.00399523, 0., 0.00107464]])
+            observations['gripper_pos'] /= np.array(
+                [[0.07113902, 1., 0.0682641]])
+            observations['gripper_sensors'] -= np.array(
+                [[-1.88325821e-01, -8.78638581e-02, -1.91555331e-04,
+                  0., 0., 0., 6.49803922e-01]])
+            observations['gripper_sensors'] /= np.array(
+                [[2.04928469, 2.04916813, 0.00348241, 1., 1., 1.,
+                  0.47703122]])
+            states -= _state_normalization[0]
+            states /= _state_normalization[1]
+            controls -= np.array(
+                [[-3.39131082e-06, 9.89458979e-04, -3.91004959e-03,
+                  -3.99184253e-03, -9.89458979e-04, 4.98469281e-03,
+                  6.49803922e-01]])
+            controls /= np.array(
+                [[0.01032934, 0.06751064, 0.07186062, 0.07038562,
+                  0.06751064, 0.09715582, 0.47703122]])
+
+            trajectories.append((states, observations, controls))
+
+    return trajectories
+
+
 def _print_normalization(trajectories):
     """ Helper for producing code to normalize inputs
     """
@@ -192,7 +338,10 @@ class OmnipushDynamicsDataset(torch.utils.data.Dataset):
         Output:
             sample: (prev_state, observation, control, new_state)
         """
-        return self.dataset[index]
+        prev_state, observation, control, new_state = self.dataset[index]
+        observation = utility.apply_observation_masks(
+            observation, image_range=image_range)
+        return prev_state, observation, control, new_state
 
     def __len__(self):
         """
@@ -247,6 +396,8 @@ class OmnipushMeasurementDataset(torch.utils.data.Dataset):
         """
 
         state, observation = self.dataset[index // self.samples_per_pair]
+        observation = utility.apply_observation_masks(
+            observation, image_range=image_range)
 
         assert self.stddev.shape == state.shape
 
@@ -290,6 +441,13 @@ class OmnipushSubsequenceDataset(dpf.SubsequenceDataset):
         trajectories = load_trajectories(*paths, **kwargs)
         super().__init__(trajectories, **kwargs)
 
+    def __getitem__(self, index):
+        """ Get a subsequence from our dataset, with observations decoded.
+        """
+        states, observation, controls = super().__getitem__(index)
+        return states, utility.apply_observation_masks(
+            observation, image_range=image_range), controls
+
 
 class OmnipushParticleFilterDataset(dpf.ParticleFilterDataset):
     """A data preprocessor for producing overlapping subsequences + initial
@@ -311,3 +469,12 @@ class OmnipushParticleFilterDataset(dpf.ParticleFilterDataset):
 
         trajectories = load_trajectories(*paths, **kwargs)
         super().__init__(trajectories, **kwargs)
+
+    def __getitem__(self, index):
+        """ Get a set of initial particles + associated subsequence from our
+        dataset, with observations decoded.
+        """
+        output = super().__getitem__(index)
+        return output[:-2] + (
+            utility.apply_observation_masks(
+                output[-2], image_range=image_range), output[-1])
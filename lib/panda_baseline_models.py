@@ -100,9 +100,13 @@ class PandaLSTMModel(nn.Module):
     #         # Set hidden state (h0) of layer #1 to our initial states
     #         self.hidden[0][1] = initial_states
 
-    def forward(self, observations, controls):
+    def forward(self, observations, controls, hidden=None,
+                return_hidden=False):
         # Observations: key->value
         # where shape of value is (batch, seq_len, *)
+        #
+        # `hidden` can be used to continue from the LSTM state returned by an
+        # earlier call with `return_hidden=True`
         batch_size = observations['image'].shape[0]
         sequence_length = observations['image'].shape[1]
         assert observations['image'].shape[0] == batch_size
@@ -133,13 +137,16 @@ class PandaLSTMModel(nn.Module):
             batch_size, sequence_length, self.units)
 
         # Forward pass through LSTM layer
-        lstm_out, _unused_hidden = self.lstm(fused_features)
+        lstm_out, hidden = self.lstm(fused_features, hidden)
         assert lstm_out.shape == (
             batch_size, sequence_length, self.lstm_hidden_dim)
 
         predicted_states = self.output_layers(lstm_out)
         assert predicted_states.shape == (
             batch_size, sequence_length, self.state_dim)
+
+        if return_hidden:
+            return predicted_states, hidden
         return predicted_states
 
 
@@ -5,6 +5,8 @@ from tqdm.auto import tqdm
 
 from fannypack import utils
 
+from . import rollouts
+
 
 def train(buddy, model, dataloader, log_interval=10, state_noise_std=0.2):
     losses = []
@@ -56,32 +58,14 @@ def rollout(model, trajectories, max_timesteps=300):
     # same length :)
     timesteps = np.min([len(s) for s, _, _ in trajectories] + [max_timesteps])
 
-    predicted_states = [[states[0]] for states, _, _ in trajectories]
     actual_states = [states[:timesteps] for states, _, _ in trajectories]
-    for t in range(1, timesteps):
-        s = []
-        o = {}
-        c = []
-        for i, traj in enumerate(trajectories):
-            states, observations, controls = traj
-
-            s.append(predicted_states[i][t - 1])
-            o_t = utils.DictIterator(observations)[t]
-            utils.DictIterator(o).append(o_t)
-            c.append(controls[t])
-
-        s = np.array(s)
-        utils.DictIterator(o).convert_to_numpy()
-        c = np.array(c)
-
-        device = next(model.parameters()).device
-        pred = model(*utils.to_torch([s, o, c], device=device))
-        pred = utils.to_numpy(pred)
-        assert pred.shape == (len(trajectories), 2)
-        for i in range(len(trajectories)):
-            predicted_states[i].append(pred[i])
-
-    predicted_states = np.array(predicted_states)
+
+    device = next(model.parameters()).device
+    batch = rollouts.TrajectoryBatch(trajectories, timesteps, device)
+    results = rollouts.run_rollout(
+        rollouts.BaselineAdapter(model), batch, 0, timesteps)
+
+    predicted_states = results['states']
     actual_states = np.array(actual_states)
     return predicted_states, actual_states
 
@@ -89,39 +73,19 @@ def rollout(model, trajectories, max_timesteps=300):
 def rollout_lstm(model, trajectories, max_timesteps=300):
     timesteps = np.min([len(s) for s, _, _ in trajectories] + [max_timesteps])
 
-    trajectory_count = len(trajectories)
-
     state_dim = trajectories[0][0].shape[-1]
-    actual_states = np.zeros((trajectory_count, timesteps, state_dim))
-
-    batched_observations = {}
-    batched_controls = []
-
-    # Trajectories is a list of (states, observations, controls)
-    for i, (states, observations, controls) in enumerate(trajectories):
-
-        observations = utils.DictIterator(observations)[1:timesteps]
-        utils.DictIterator(batched_observations).append(observations)
-        batched_controls.append(controls[1:timesteps])
-
+    actual_states = np.zeros((len(trajectories), timesteps, state_dim))
+    for i, (states, _, _) in enumerate(trajectories):
         assert states.shape == (timesteps, state_dim)
-        actual_states[i] = states[:timesteps]  # * 0 + 0.1
+        actual_states[i] = states[:timesteps]
 
-    utils.DictIterator(batched_observations).convert_to_numpy()
-    batched_controls = np.array(batched_controls)
-
-    # Propagate through model
-    # model.reset_hidden_states(utils.to_torch(actual_states[:, 0, :]))
+    # Step through the LSTM one timestep at a time
     device = next(model.parameters()).device
-    predicted_states = np.concatenate([
-        actual_states[:, 0:1, :],
-        utils.to_numpy(
-            model(
-                utils.to_torch(batched_observations, device),
-                utils.to_torch(batched_controls, device),
-            )
-        ),
-    ], axis=1)
+    batch = rollouts.TrajectoryBatch(trajectories, timesteps, device)
+    results = rollouts.run_rollout(
+        rollouts.LSTMAdapter(model), batch, 0, timesteps)
+
+    predicted_states = results['states']
 
     # Indexing: batch, sequence length, state
     return predicted_states, actual_states
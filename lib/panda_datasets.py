@@ -1,3 +1,5 @@
+import functools
+
 import torch
 import numpy as np
 import scipy.stats
@@ -5,7 +7,7 @@ from tqdm.auto import tqdm
 
 from fannypack import utils
 import fannypack
-from . import dpf
+from . import dpf, trajectory_cache, utility
 
 
 # ['image'
@@ -35,6 +37,41 @@ from . import dpf
 # 'object_z_angle'])
 
 
+# Observation normalization constants, as (mean, std)
+_observation_normalization = {
+    'gripper_pos': (
+        np.array([[0.46806443, -0.0017836, 0.88028437]], dtype=np.float32),
+        np.array([[0.02410769, 0.02341035, 0.04018243]], dtype=np.float32),
+    ),
+    'gripper_sensors': (
+        np.array([[4.9182904e-01, 4.5039989e-02, -3.2791464e+00,
+                   -3.3874984e-03, 1.1552566e-02, -8.4817986e-04,
+                   2.1303751e-01]], dtype=np.float32),
+        np.array([[1.6152629, 1.666905, 1.9186896, 0.14219016, 0.14232528,
+                   0.01675198, 0.40950698]], dtype=np.float32),
+    ),
+}
+
+# State normalization constants, as (mean, std)
+_state_normalization = (
+    np.array([[0.4970164, -0.00916641]]),
+    np.array([[0.0572766, 0.06118315]]),
+)
+
+# Per-timestep values of disabled modalities: zeros, after normalization
+# Range of image values; also used to decode compact uint8 images
+image_range = (-1., 1.)
+
+_absent_values = {
+    'gripper_pos': -(_observation_normalization['gripper_pos'][0] /
+                     _observation_normalization['gripper_pos'][1])[0],
+    'gripper_sensors': -(_observation_normalization['gripper_sensors'][0] /
+                         _observation_normalization['gripper_sensors'][1])[0],
+    'image': np.zeros((32, 32), dtype=np.float32),
+    'depth': np.zeros((32, 32), dtype=np.float32),
+}
+
+
 def load_trajectories(*paths, use_vision=True, vision_interval=10,
                       use_proprioception=True, use_haptics=True,
                       use_mass=False, use_depth=False,
@@ -42,6 +79,10 @@ def load_trajectories(*paths, use_vision=True, vision_interval=10,
                       sequential_image_rate=1,
                       start_timestep=0,
                       direction_filter=None, 
+                      use_cache=False,
+                      lazy_masks=False,
+                      compact_images=False,
+                      load_workers=None,
                       **unused):
     """
     Loads a list of trajectories from a set of input paths, where each
@@ -52,136 +93,116 @@ def load_trajectories(*paths, use_vision=True, vision_interval=10,
 
     Each path can either be a string or a (string, int) tuple, where int
     indicates the maximum number of trajectories to import.
+
+    Trajectories are selected before they're parsed, using a per-file
+    metadata index (see `load_metadata()`): only the first `count` in each
+    file are considered, then filtered by `direction_filter` ('x' or 'y'
+    pushes).
+
+    Multiple files are indexed & parsed in parallel, with up to
+    `load_workers` processes; see `trajectory_cache.map_parallel()`.
+
+    With `use_cache=True`, parsed & normalized trajectories are cached on
+    disk, keyed by the source file and loader arguments; see
+    `trajectory_cache`. Cached arrays are read-only memory maps, so they
+    can't be edited in place. Random image blackout is applied after loading
+    from the cache.
+
+    Disabled modalities aren't stored: they're filled in with constant
+    placeholder views, which are kept as views in both masking modes. By
+    default, image blackout is applied while loading, which copies the
+    images of each trajectory with blacked out frames. With
+    `lazy_masks=True`, observations get an `image_available` (T,) array of
+    per-timestep flags instead, and masks are applied at batch time with
+    `utility.apply_observation_masks()`. Flags can be redrawn without
+    reloading with `mask_images()`.
+
+    With `compact_images=True`, images are stored as uint8 codes in the
+    trajectory cache (see `utility.quantize_images()`). Combined with
+    `lazy_masks=True`, they're also kept as codes in memory, and decoded to
+    floats at batch time. Source files may store images either as floats in
+    [-1, 1] or as uint8 codes.
     """
     trajectories = []
 
     assert 1 > image_blackout_ratio >= 0
     assert image_blackout_ratio == 0 or sequential_image_rate == 1
 
+    # Parse paths
+    file_paths = []
+    counts = []
     for path in paths:
         count = np.float('inf')
         if type(path) == tuple:
             path, count = path
             assert type(count) == int
-
-        with utils.TrajectoriesFile(path) as f:
-            # Iterate over each trajectory
-            for i, trajectory in enumerate(f):
-                if i >= count:
-                    break
-
-                timesteps = len(trajectory['Cylinder0_pos'])
-
-                # Define our state:  we expect this to be:
-                # (x, y, cos theta, sin theta, mass, friction)
-                # TODO: add mass, friction
-                state_dim = 2
-                states = np.full((timesteps, state_dim), np.nan)
-
-                states[:, :2] = trajectory['Cylinder0_pos'][:, :2]  # x, y
-                if use_mass:
-                    states[:, 3] = trajectory['Cylinder0_mass'][:, 0]
-                
-
-
-                # states[:, 2] = np.cos(trajectory['object_z_angle'])
-                # states[:, 3] = np.sin(trajectory['object_z_angle'])
-                # states[:, 5] = trajectory['Cylinder0_friction'][:, 0]
-
-                # Pull out observations
-                ## This is currently consisted of:
-                ## > gripper_pos: end effector position
-                ## > gripper_sensors: F/T, contact sensors
-                ## > image: camera image
-
-                observations = {}
-                observations['gripper_pos'] = trajectory['eef_pos']
-                assert observations['gripper_pos'].shape == (timesteps, 3)
-
-                observations['gripper_sensors'] = np.concatenate((
-                    trajectory['force'],
-                    trajectory['contact'][:, np.newaxis],
-                ), axis=1)
-                assert observations['gripper_sensors'].shape[1] == 7
-
-                if not use_proprioception:
-                    observations['gripper_pos'][:] = 0
-                if not use_haptics:
-                    observations['gripper_sensors'][:] = 0
-
-                if 'raw_image' in trajectory:
-                    observations['raw_image'] = trajectory['raw_image']
-                observations['image'] = np.zeros_like(trajectory['image'])
-                if use_vision:
-                    for i in range(len(observations['image'])):
-                        index = (i // vision_interval) * vision_interval
-                        index = min(index, len(observations['image']))
-                        blackout_chance = np.random.uniform()
-                        # if blackout chance > ratio, then fill image
-                        # otherwise zero
-                        if image_blackout_ratio == 0 and i % sequential_image_rate == 0:
-                            observations['image'][i] = trajectory['image'][index]
-
-                        if blackout_chance > image_blackout_ratio and sequential_image_rate == 1:
-                            observations['image'][i] = trajectory['image'][index]
-
-                observations['depth'] = np.zeros_like(trajectory['depth'])
-                if use_depth:
-                    for i in range(len(observations['depth'])):
-                        index = (i // vision_interval) * vision_interval
-                        index = min(index, len(observations['depth']))
-                        observations['depth'][i] = trajectory['depth'][index]
-
-                # Pull out controls
-                ## This is currently consisted of:
-                ## > previous end effector position
-                ## > end effector position delta
-                ## > binary contact reading
-                eef_positions = trajectory['eef_pos']
-                eef_positions_shifted = np.roll(eef_positions, shift=1, axis=0)
-                eef_positions_shifted[0] = eef_positions[0]
-                controls = np.concatenate([
-                    eef_positions_shifted,
-                    eef_positions - eef_positions_shifted,
-                    trajectory['contact'][:, np.newaxis],
-                ], axis=1)
-                assert controls.shape == (timesteps, 7)
-
-                # Normalization
-
-                observations['gripper_pos'] -= np.array(
-                    [[0.46806443, -0.0017836, 0.88028437]], dtype=np.float32)
-                observations['gripper_pos'] /= np.array(
-                    [[0.02410769, 0.02341035, 0.04018243]], dtype=np.float32)
-                observations['gripper_sensors'] -= np.array(
-                    [[4.9182904e-01, 4.5039989e-02, -3.2791464e+00,
-                      -3.3874984e-03, 1.1552566e-02, -8.4817986e-04,
-                      2.1303751e-01]], dtype=np.float32)
-                observations['gripper_sensors'] /= np.array(
-                    [[1.6152629, 1.666905, 1.9186896, 0.14219016, 0.14232528,
-                      0.01675198, 0.40950698]], dtype=np.float32)
-                states -= np.array([[0.4970164, -0.00916641]])
-                states /= np.array([[0.0572766, 0.06118315]])
-                controls -= np.array([[4.6594709e-01, -2.5247163e-03, 8.8094306e-01, 1.2939950e-04,
-                                       -5.4364675e-05, -6.1112235e-04, 2.2041667e-01]], dtype=np.float32)
-                controls /= np.array([[0.02239027, 0.02356066, 0.0405312, 0.00054858, 0.0005754,
-                                       0.00046352, 0.41451886]], dtype=np.float32)
-
-                x_delta = states[start_timestep, 0] - states[-1, 0]
-                y_delta = states[start_timestep, 1]-states[-1, 1]
-                if direction_filter == 'x':
-                    if not (abs(x_delta) > 0.55 and abs(y_delta) < 0.2):
-                        
-                        continue 
-                if direction_filter == 'y':
-                    if not (abs(x_delta) < 0.20 and abs(y_delta) > 0.55):
-                        continue 
-                
-                trajectories.append((
-                    states[start_timestep:],
-                    utils.DictIterator(observations)[start_timestep:],
-                    controls[start_timestep:]
-                ))
+        file_paths.append(path)
+        counts.append(count)
+
+    # Pick trajectories from each file's metadata index
+    jobs = []
+    for path, count, metadata in zip(
+            file_paths, counts, trajectory_cache.map_parallel(
+                load_metadata, file_paths, load_workers)):
+        indices = _select_trajectories(
+            metadata, count, start_timestep, direction_filter)
+
+        file_kwargs = {
+            'indices': indices,
+            'use_vision': use_vision,
+            'vision_interval': vision_interval,
+            'use_proprioception': use_proprioception,
+            'use_haptics': use_haptics,
+            'use_mass': use_mass,
+            'use_depth': use_depth,
+            'compact_images': compact_images,
+        }
+        jobs.append((
+            path,
+            "panda_datasets",
+            functools.partial(_load_file, path, **file_kwargs),
+            file_kwargs,
+        ))
+
+    used_modalities = {
+        'gripper_pos': use_proprioception,
+        'gripper_sensors': use_haptics,
+        'image': use_vision,
+        'depth': use_depth,
+    }
+
+    # Files are parsed in parallel; results stay in input order
+    for file_trajectories in trajectory_cache.load_all(
+            jobs, load_workers, use_cache=use_cache):
+        for states, observations, controls in file_trajectories:
+            timesteps = len(states)
+            observations = dict(observations)
+
+            # Zero-stride placeholders for modalities that aren't stored
+            for key, value in _absent_values.items():
+                if not used_modalities[key]:
+                    observations[key] = np.broadcast_to(
+                        value, (timesteps,) + value.shape)
+
+            if use_vision:
+                observations['image_available'] = _image_mask(
+                    timesteps, image_blackout_ratio, sequential_image_rate
+                ).astype(np.float32)
+            else:
+                observations['image_available'] = np.zeros(
+                    timesteps, dtype=np.float32)
+            if not lazy_masks:
+                # Placeholders stay zero-stride views, and images are only
+                # copied if some frames are actually blacked out
+                observations = utility.apply_observation_masks(
+                    observations, materialize=False)
+                del observations['image_available']
+
+            trajectories.append((
+                states[start_timestep:],
+                utils.DictIterator(observations)[start_timestep:],
+                controls[start_timestep:]
+            ))
 
     ## Uncomment this line to generate the lines required to normalize data
     # _print_normalization(trajectories)
@@ -189,6 +210,250 @@ def load_trajectories(*paths, use_vision=True, vision_interval=10,
     return trajectories
 
 
+def load_metadata(path):
+    """
+    Load the metadata index of a file; built once, then cached. Contains
+    per-trajectory columns...
+        length: (N,) # of timesteps
+        offsets: (N + 1,) trajectory boundaries in `positions`
+        positions: (sum(T), 2) normalized object positions
+        push_direction: (N,) 'x', 'y', or '' for other pushes
+        contact_fraction: (N,) fraction of timesteps in contact
+    """
+    metadata = trajectory_cache.load_metadata(
+        path, "panda_datasets", lambda: _build_metadata(path))
+
+    positions = metadata['positions']
+    offsets = metadata['offsets']
+    deltas = positions[offsets[:-1]] - positions[offsets[1:] - 1]
+    metadata['push_direction'] = np.array(
+        [_push_direction(*delta) for delta in deltas], dtype=str)
+    return metadata
+
+
+def _build_metadata(path):
+    """
+    Build the metadata index of a file, excluding derived columns.
+    """
+    lengths = []
+    positions = [np.zeros((0, 2))]
+    contact_fractions = []
+    with utils.TrajectoriesFile(path) as f:
+        for trajectory in f:
+            lengths.append(len(trajectory['Cylinder0_pos']))
+            positions.append(
+                (trajectory['Cylinder0_pos'][:, :2] - _state_normalization[0])
+                / _state_normalization[1])
+            contact_fractions.append(np.mean(trajectory['contact']))
+
+    return {
+        'length': np.array(lengths, dtype=np.int64),
+        'offsets': np.cumsum([0] + lengths),
+        'positions': np.concatenate(positions),
+        'contact_fraction': np.array(contact_fractions, dtype=np.float64),
+    }
+
+
+def _push_direction(x_delta, y_delta):
+    """
+    Classify a push from its (normalized) object displacement: 'x', 'y', or
+    '' for neither.
+    """
+    if abs(x_delta) > 0.55 and abs(y_delta) < 0.2:
+        return 'x'
+    if abs(x_delta) < 0.20 and abs(y_delta) > 0.55:
+        return 'y'
+    return ''
+
+
+def _select_trajectories(metadata, count, start_timestep, direction_filter):
+    """
+    Pick trajectories to load from a metadata index. Push directions are
+    measured from `start_timestep`. Returns a list of trajectory indices.
+    """
+    positions = metadata['positions']
+    offsets = metadata['offsets']
+
+    indices = []
+    for i in range(len(metadata['length'])):
+        if i >= count:
+            break
+
+        if direction_filter in ('x', 'y'):
+            delta = positions[offsets[i] + start_timestep] \
+                - positions[offsets[i + 1] - 1]
+            if _push_direction(*delta) != direction_filter:
+                continue
+
+        indices.append(i)
+    return indices
+
+
+def mask_images(trajectories, image_blackout_ratio=0, sequential_image_rate=1):
+    """
+    Redraw the image availability flags of trajectories loaded with
+    `lazy_masks=True`. Useful for sweeping over blackout settings without
+    reloading; arrays are shared with the input trajectories.
+    """
+    assert 1 > image_blackout_ratio >= 0
+    assert image_blackout_ratio == 0 or sequential_image_rate == 1
+
+    output = []
+    for states, observations, controls in trajectories:
+        assert 'image_available' in observations, \
+            "Trajectories must be loaded with lazy_masks=True!"
+        observations = dict(observations)
+        observations['image_available'] = _image_mask(
+            len(states), image_blackout_ratio, sequential_image_rate
+        ).astype(np.float32)
+        output.append((states, observations, controls))
+    return output
+
+
+def _load_file(path, indices, use_vision, vision_interval,
+               use_proprioception, use_haptics, use_mass, use_depth,
+               compact_images):
+    """
+    Parses and normalizes the trajectories at `indices` from a single file.
+    Images are held for `vision_interval` timesteps, but random blackout isn't
+    applied. Disabled modalities are left out.
+    """
+    trajectories = []
+
+    with utils.TrajectoriesFile(path) as f:
+        # Iterate over selected trajectories
+        for i in indices:
+            trajectory = f[i]
+
+            timesteps = len(trajectory['Cylinder0_pos'])
+
+            # Define our state:  we expect this to be:
+            # (x, y, cos theta, sin theta, mass, friction)
+            # TODO: add mass, friction
+            state_dim = 2
+            states = np.full((timesteps, state_dim), np.nan)
+
+            states[:, :2] = trajectory['Cylinder0_pos'][:, :2]  # x, y
+            if use_mass:
+                states[:, 3] = trajectory['Cylinder0_mass'][:, 0]
+            
+
+
+            # states[:, 2] = np.cos(trajectory['object_z_angle'])
+            # states[:, 3] = np.sin(trajectory['object_z_angle'])
+            # states[:, 5] = trajectory['Cylinder0_friction'][:, 0]
+
+            # Pull out observations
+            ## This is currently consisted of:
+            ## > gripper_pos: end effector position
+            ## > gripper_sensors: F/T, contact sensors
+            ## > image: camera image
+
+            observations = {}
+            observations['gripper_pos'] = trajectory['eef_pos']
+            assert observations['gripper_pos'].shape == (timesteps, 3)
+
+            observations['gripper_sensors'] = np.concatenate((
+                trajectory['force'],
+                trajectory['contact'][:, np.newaxis],
+            ), axis=1)
+            assert observations['gripper_sensors'].shape[1] == 7
+
+            if not use_proprioception:
+                observations['gripper_pos'][:] = 0
+            if not use_haptics:
+                observations['gripper_sensors'][:] = 0
+
+            if 'raw_image' in trajectory:
+                observations['raw_image'] = trajectory['raw_image']
+
+            # Each timestep sees the most recent frame captured at
+            # `vision_interval`
+            frame_indices = _frame_indices(timesteps, vision_interval)
+
+            if use_vision:
+                observations['image'] = _convert_images(
+                    trajectory['image'][frame_indices], compact_images)
+            if use_depth:
+                observations['depth'] = trajectory['depth'][frame_indices]
+
+            # Pull out controls
+            ## This is currently consisted of:
+            ## > previous end effector position
+            ## > end effector position delta
+            ## > binary contact reading
+            eef_positions = trajectory['eef_pos']
+            eef_positions_shifted = np.roll(eef_positions, shift=1, axis=0)
+            eef_positions_shifted[0] = eef_positions[0]
+            controls = np.concatenate([
+                eef_positions_shifted,
+                eef_positions - eef_positions_shifted,
+                trajectory['contact'][:, np.newaxis],
+            ], axis=1)
+            assert controls.shape == (timesteps, 7)
+
+            # Normalization
+
+            for key, (mean, std) in _observation_normalization.items():
+                observations[key] -= mean
+                observations[key] /= std
+            states -= _state_normalization[0]
+            states /= _state_normalization[1]
+            controls -= np.array([[4.6594709e-01, -2.5247163e-03, 8.8094306e-01, 1.2939950e-04,
+                                   -5.4364675e-05, -6.1112235e-04, 2.2041667e-01]], dtype=np.float32)
+            controls /= np.array([[0.02239027, 0.02356066, 0.0405312, 0.00054858, 0.0005754,
+                                   0.00046352, 0.41451886]], dtype=np.float32)
+
+            # Disabled modalities are filled back in by `load_trajectories()`
+            if not use_proprioception:
+                del observations['gripper_pos']
+            if not use_haptics:
+                del observations['gripper_sensors']
+
+            trajectories.append((states, observations, controls))
+
+    return trajectories
+
+
+def _convert_images(images, compact_images):
+    """
+    Convert images to uint8 codes if `compact_images` is set, or to floats
+    otherwise.
+    """
+    if compact_images and images.dtype != np.uint8:
+        return utility.quantize_images(images, image_range)
+    elif not compact_images and images.dtype == np.uint8:
+        return utility.dequantize_images(images, image_range)
+    return images
+
+
+def _frame_indices(timesteps, vision_interval):
+    """
+    For each timestep, the index of the most recent frame when images are
+    only captured every `vision_interval` timesteps.
+    """
+    return (np.arange(timesteps) // vision_interval) * vision_interval
+
+
+def _image_mask(timesteps, image_blackout_ratio, sequential_image_rate):
+    """
+    Random per-timestep image availability. Images are either kept every
+    `sequential_image_rate` timesteps, or blacked out independently with
+    probability `image_blackout_ratio`.
+    """
+    # if blackout chance > ratio, then fill image
+    # otherwise zero
+    blackout_chances = np.random.uniform(size=timesteps)
+    indices = np.arange(timesteps)
+    return np.logical_or(
+        np.logical_and(
+            image_blackout_ratio == 0,
+            indices % sequential_image_rate == 0),
+        np.logical_and(
+            blackout_chances > image_blackout_ratio,
+            sequential_image_rate == 1))
+
+
 def _print_normalization(trajectories):
     """ Helper for producing code to normalize inputs
     """
@@ -229,51 +494,41 @@ class PandaDynamicsDataset(torch.utils.data.Dataset):
         """
 
         trajectories = load_trajectories(*paths, **kwargs)
-        active_dataset = []
-        inactive_dataset = []
-        for trajectory in trajectories:
-            assert len(trajectory) == 3
-            states, observations, controls = trajectory
-
-            timesteps = len(states)
-            assert type(observations) == dict
-            assert len(controls) == timesteps
 
-            for t in range(1, timesteps):
-                # Pull out data & labels
-                prev_state = states[t - 1]
-                observation = utils.DictIterator(observations)[t]
-                control = controls[t]
-                new_state = states[t]
+        # Each sample is a window of two timesteps: (t - 1, t)
+        self.pairs = dpf.SubsequenceIndex(
+            trajectories, subsequence_length=2, stride=1)
 
-                # Construct sample, bring to torch, & add to dataset
-                sample = (prev_state, observation, control, new_state)
-                sample = tuple(utils.to_torch(x) for x in sample)
-
-                if np.linalg.norm(new_state - prev_state) > 1e-5:
-                    active_dataset.append(sample)
-                else:
-                    inactive_dataset.append(sample)
+        states = utils.to_numpy(self.pairs.states)
+        starts = self.pairs.starts()
+        active = np.linalg.norm(
+            states[starts + 1] - states[starts], axis=1) > 1e-5
+        active_indices = np.nonzero(active)[0]
+        inactive_indices = np.nonzero(~active)[0]
 
         print("Parsed data: {} active, {} inactive".format(
-            len(active_dataset), len(inactive_dataset)))
-        keep_count = min(len(active_dataset) // 2, len(inactive_dataset))
+            len(active_indices), len(inactive_indices)))
+        keep_count = min(len(active_indices) // 2, len(inactive_indices))
         print("Keeping:", keep_count)
-        np.random.shuffle(inactive_dataset)
-        self.dataset = active_dataset + inactive_dataset[:keep_count]
+        np.random.shuffle(inactive_indices)
+        self.pairs = self.pairs.select(np.concatenate([
+            active_indices, inactive_indices[:keep_count]]))
 
     def __getitem__(self, index):
         """ Get a subsequence from our dataset
         Output:
             sample: (prev_state, observation, control, new_state)
         """
-        return self.dataset[index]
+        states, observations, controls = self.pairs[index]
+        observation = utility.apply_observation_masks(
+            {key: value[1] for key, value in observations.items()})
+        return states[0], observation, controls[1], states[1]
 
     def __len__(self):
         """
         Total number of samples in the dataset
         """
-        return len(self.dataset)
+        return len(self.pairs)
 
 
 class PandaMeasurementDataset(torch.utils.data.Dataset):
@@ -285,10 +540,14 @@ class PandaMeasurementDataset(torch.utils.data.Dataset):
     default_stddev = (1, 1)  # , 0.015, 0.015, 0.015, 0.015)
 
     def __init__(self, *paths, stddev=None, samples_per_pair=20,
-                 ignore_black_images=False, **kwargs):
+                 ignore_black_images=False, grouped=False, **kwargs):
         """
         Args:
           *paths: paths to dataset hdf5 files
+          grouped: if set, each item is a single (state, observation) point,
+              and all `samples_per_pair` noisy states for a point are drawn
+              at batch time by `collate()`. Each observation is then loaded
+              and encoded once, instead of once per noisy state.
         """
 
         trajectories = load_trajectories(*paths, **kwargs)
@@ -297,27 +556,31 @@ class PandaMeasurementDataset(torch.utils.data.Dataset):
             stddev = self.default_stddev
         self.stddev = np.array(stddev)
         self.samples_per_pair = samples_per_pair
-        self.dataset = []
-        for i, trajectory in enumerate(tqdm(trajectories)):
-            assert len(trajectory) == 3
-            states, observations, controls = trajectory
-
-            timesteps = len(states)
-            assert type(observations) == dict
-            assert len(controls) == timesteps
-
-            for t in range(0, timesteps):
-                # Pull out data & labels
-                state = states[t]
-                observation = utils.DictIterator(observations)[t]
-
-                if ignore_black_images and np.sum(
-                        np.abs(observation['image'])) < 1e-8:
-                    continue
-
-                self.dataset.append((state, observation))
-
-        print("Loaded {} points".format(len(self.dataset)))
+        self.grouped = grouped
+
+        # Each sample is a single timestep
+        self.points = dpf.SubsequenceIndex(
+            trajectories, subsequence_length=1, stride=1)
+
+        if ignore_black_images:
+            starts = self.points.starts()
+            image = utils.to_numpy(self.points.observations['image'])
+            chunk_size = 4096
+            image_sums = []
+            for i in range(0, len(starts), chunk_size):
+                # Decodes uint8 images
+                chunk = utility.apply_observation_masks(
+                    {'image': image[starts[i:i + chunk_size]]})['image']
+                image_sums.append(np.sum(
+                    np.abs(chunk).reshape((len(chunk), -1)), axis=1))
+            image_sums = np.concatenate(image_sums)
+            if 'image_available' in self.points.observations:
+                image_sums = image_sums * utils.to_numpy(
+                    self.points.observations['image_available'])[starts]
+            self.points = self.points.select(
+                np.nonzero(image_sums >= 1e-8)[0])
+
+        print("Loaded {} points".format(len(self.points)))
 
     def __getitem__(self, index):
         """ Get a subsequence from our dataset
@@ -326,8 +589,18 @@ class PandaMeasurementDataset(torch.utils.data.Dataset):
             sample: (prev_state, observation, control, new_state)
         """
 
-        state, observation = self.dataset[index // self.samples_per_pair]
+        if self.grouped:
+            states, observations, _ = self.points[index]
+        else:
+            states, observations, _ = \
+                self.points[index // self.samples_per_pair]
+        observation = utility.apply_observation_masks(
+            {key: value[0] for key, value in observations.items()})
+
+        if self.grouped:
+            return states[0], observation
 
+        state = utils.to_numpy(states[0])
         assert self.stddev.shape == state.shape
 
         # Generate half of our samples close to the mean, and the other half
@@ -344,14 +617,56 @@ class PandaMeasurementDataset(torch.utils.data.Dataset):
         log_likelihood = np.asarray(scipy.stats.multivariate_normal.logpdf(
             noisy_state[:2], mean=state[:2], cov=np.diag(self.stddev[:2] ** 2)))
 
-        return utils.to_torch(
-            (noisy_state, observation, log_likelihood, state))
+        noisy_state, log_likelihood, state = utils.to_torch(
+            (noisy_state, log_likelihood, state))
+        return noisy_state, observation, log_likelihood, state
 
     def __len__(self):
         """
         Total number of samples in the dataset
         """
-        return len(self.dataset) * self.samples_per_pair
+        if self.grouped:
+            return len(self.points)
+        return len(self.points) * self.samples_per_pair
+
+    def collate(self, batch):
+        """ Collate function for grouped datasets. Draws `samples_per_pair`
+        noisy states for each point, half close to the true state and half
+        far away, and computes their log-likelihoods in closed form.
+
+        Returns:
+            sample: (noisy_states, observations, log_likelihoods, states),
+                with (N, K, state_dim) noisy states and (N, K) log-likelihoods
+        """
+        assert self.grouped
+        states, observations = torch.utils.data.dataloader.default_collate(
+            batch)
+        N, state_dim = states.shape
+        K = self.samples_per_pair
+
+        stddev = torch.from_numpy(self.stddev).to(states.dtype)
+        assert stddev.shape == (state_dim,)
+
+        # (K, state_dim) sampling scales: near samples first, then far ones
+        scales = torch.where(
+            torch.arange(K) < K * 0.5,
+            torch.ones(K),
+            torch.ones(K) * 10).to(states.dtype)
+        scales = scales[:, np.newaxis] * stddev[np.newaxis, :]
+
+        noisy_states = states[:, np.newaxis, :] + \
+            torch.randn((N, K, state_dim), dtype=states.dtype) * scales
+        assert noisy_states.shape == (N, K, state_dim)
+
+        # Log-likelihoods of the first two state dimensions, under a Gaussian
+        # centered at the true state
+        whitened = (noisy_states[:, :, :2] - states[:, np.newaxis, :2]) \
+            / stddev[:2]
+        log_likelihoods = -0.5 * torch.sum(whitened ** 2, dim=2) \
+            - torch.sum(torch.log(stddev[:2])) - np.log(2 * np.pi)
+        assert log_likelihoods.shape == (N, K)
+
+        return noisy_states, observations, log_likelihoods, states
 
 
 class PandaSubsequenceDataset(dpf.SubsequenceDataset):
@@ -370,6 +685,13 @@ class PandaSubsequenceDataset(dpf.SubsequenceDataset):
         trajectories = load_trajectories(*paths, **kwargs)
         super().__init__(trajectories, **kwargs)
 
+    def __getitem__(self, index):
+        """ Get a subsequence from our dataset, with observation masks
+        applied.
+        """
+        states, observation, controls = super().__getitem__(index)
+        return states, utility.apply_observation_masks(observation), controls
+
 
 class PandaParticleFilterDataset(dpf.ParticleFilterDataset):
     """A data preprocessor for producing overlapping subsequences + initial
@@ -396,25 +718,29 @@ class PandaParticleFilterDataset(dpf.ParticleFilterDataset):
 
         # Post-process subsequences; differentiate between active ones and
         # inactive ones
-        active_subsequences = []
-        inactive_subsequences = []
-
-        for subsequence in self.subsequences:
-            start_state = subsequence[0][0]
-            end_state = subsequence[0][-1]
-            if np.linalg.norm(start_state - end_state) > 1e-5:
-                active_subsequences.append(subsequence)
-            else:
-                inactive_subsequences.append(subsequence)
+        states = utils.to_numpy(self.subsequences.states)
+        starts = self.subsequences.starts()
+        ends = starts + self.subsequences.subsequence_length - 1
+        active = np.linalg.norm(states[starts] - states[ends], axis=1) > 1e-5
+        active_indices = np.nonzero(active)[0]
+        inactive_indices = np.nonzero(~active)[0]
 
         print("Parsed data: {} active, {} inactive".format(
-            len(active_subsequences), len(inactive_subsequences)))
+            len(active_indices), len(inactive_indices)))
         keep_count = min(
-            len(active_subsequences) // 2,
-            len(inactive_subsequences)
+            len(active_indices) // 2,
+            len(inactive_indices)
         )
         print("Keeping (inactive):", keep_count)
 
-        np.random.shuffle(inactive_subsequences)
-        self.subsequences = active_subsequences + \
-            inactive_subsequences[:keep_count]
+        np.random.shuffle(inactive_indices)
+        self.subsequences = self.subsequences.select(np.concatenate([
+            active_indices, inactive_indices[:keep_count]]))
+
+    def __getitem__(self, index):
+        """ Get a set of initial particles + associated subsequence from our
+        dataset, with observation masks applied.
+        """
+        output = super().__getitem__(index)
+        return output[:-2] + (
+            utility.apply_observation_masks(output[-2]), output[-1])
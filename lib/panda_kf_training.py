@@ -156,23 +156,41 @@ def train_e2e(buddy, ekf_model, dataloader,
               log_interval=2, optim_name="ekf",
               measurement_init=True,
               checkpoint_interval=1000,
-              init_state_noise=0.2, loss_type="mse"
+              init_state_noise=0.2, loss_type="mse",
+              pre_encode=False
               ):
     # Train for 1 epoch
     for batch_idx, batch in enumerate(dataloader):
+        utility.reset_image_dedup_counts(ekf_model)
+
         # Transfer to GPU and pull out batch data
         batch_gpu = utils.to_device(batch, buddy._device)
-        _, batch_states, batch_obs, batch_controls = batch_gpu
+        batch_states, batch_obs, batch_controls = batch_gpu[-3:]
         # N = batch size, M = particle count
         N, timesteps, control_dim = batch_controls.shape
         N, timesteps, state_dim = batch_states.shape
         assert batch_controls.shape == (N, timesteps, control_dim)
 
+        # Observation encodings don't depend on the filter state, so we can
+        # optionally compute them for the whole sequence in one batch; this
+        # is also the only way that repeated camera frames are deduplicated
+        def features_at(t):
+            if not pre_encode:
+                return None
+            return utility.map_nested(lambda x: x[:, t], observation_features)
+
+        if pre_encode:
+            observation_features = utility.encode_sequence(
+                ekf_model, batch_obs)
+
         state = batch_states[:, 0, :]
         state_sigma = torch.eye(state.shape[-1], device=buddy._device) * init_state_noise**2
         state_sigma = state_sigma.unsqueeze(0).repeat(N, 1, 1)
 
-        if measurement_init:
+        if measurement_init and pre_encode:
+            state, state_sigma = ekf_model.measurement_model.score(
+                features_at(0), batch_states[:, 0, :])
+        elif measurement_init:
             state, state_sigma = ekf_model.measurement_model.forward(
                 utils.DictIterator(batch_obs)[:, 0, :],
                 batch_states[:, 0, :])
@@ -193,6 +211,7 @@ def train_e2e(buddy, ekf_model, dataloader,
                 prev_state_sigma,
                 utils.DictIterator(batch_obs)[:, t, :],
                 batch_controls[:, t, :],
+                observation_features=features_at(t),
             )
 
             assert state.shape == batch_states[:, t, :].shape
@@ -223,6 +242,10 @@ def train_e2e(buddy, ekf_model, dataloader,
         if buddy.optimizer_steps % log_interval == 0:
             with buddy.log_scope(optim_name):
                 buddy.log("Training loss", loss.item())
+                if pre_encode:
+                    for name, ratio in utility.image_dedup_ratios(
+                            ekf_model).items():
+                        buddy.log(f"Image dedup ratio ({name})", ratio)
                 buddy.log_model_grad_norm()
                 # buddy.log_model_grad_hist()
                 # buddy.log_model_weights_hist()
@@ -232,24 +255,40 @@ def train_fusion(buddy, fusion_model, dataloader, log_interval=2,
                  measurement_init=True,
                  init_state_noise=0.2,
                  one_loss=True,
-                 nll=False):
+                 nll=False,
+                 pre_encode=False):
     # todo: change loss to selection/mixed
     for batch_idx, batch in enumerate(dataloader):
+        utility.reset_image_dedup_counts(fusion_model)
+
         # Transfer to GPU and pull out batch data
         batch_gpu = utils.to_device(batch, buddy._device)
-        _, batch_states, batch_obs, batch_controls = batch_gpu
+        batch_states, batch_obs, batch_controls = batch_gpu[-3:]
         # N = batch size
         N, timesteps, control_dim = batch_controls.shape
         N, timesteps, state_dim = batch_states.shape
         assert batch_controls.shape == (N, timesteps, control_dim)
 
+        # Observation encodings don't depend on the filter state, so we can
+        # optionally compute them for the whole sequence in one batch; this
+        # is also the only way that repeated camera frames are deduplicated
+        def features_at(t):
+            if not pre_encode:
+                return None
+            return utility.map_nested(lambda x: x[:, t], observation_features)
+
+        if pre_encode:
+            observation_features = utility.encode_sequence(
+                fusion_model, batch_obs)
+
         state = batch_states[:, 0, :]
         state_sigma = torch.eye(state.shape[-1], device=buddy._device) * init_state_noise**2
         state_sigma = state_sigma.unsqueeze(0).repeat(N, 1, 1)
 
         if measurement_init:
             state, state_sigma = fusion_model.measurement_only(
-                utils.DictIterator(batch_obs)[:, 0, :], state)
+                utils.DictIterator(batch_obs)[:, 0, :], state,
+                observation_features=features_at(0))
 
         else:
             dist = torch.distributions.Normal(
@@ -272,6 +311,7 @@ def train_fusion(buddy, fusion_model, dataloader, log_interval=2,
                 prev_state_sigma,
                 utils.DictIterator(batch_obs)[:, t, :],
                 batch_controls[:, t, :],
+                observation_features=features_at(t),
             )
 
             loss_image = torch.mean((image_state - batch_states[:, t, :]) ** 2)
@@ -305,5 +345,9 @@ def train_fusion(buddy, fusion_model, dataloader, log_interval=2,
                 buddy.log("Image loss",  np.mean(np.array(losses_image)))
                 buddy.log("Force loss",  np.mean(np.array(losses_force)))
                 buddy.log("Fused loss",  np.mean(np.array(losses_fused)))
+                if pre_encode:
+                    for name, ratio in utility.image_dedup_ratios(
+                            fusion_model).items():
+                        buddy.log(f"Image dedup ratio ({name})", ratio)
                 buddy.log_model_grad_norm()
 
@@ -5,7 +5,7 @@ import torch.nn.functional as F
 
 from fannypack.nn import resblocks
 
-from . import dpf
+from . import dpf, utility
 
 from utils import spatial_softmax
 
@@ -119,11 +119,15 @@ class PandaDynamicsModel(dpf.DynamicsModel):
         self.learnable_Q = learnable_Q
         self.Q_l = torch.nn.Parameter(Q_l, requires_grad=self.learnable_Q)
 
+    @property
+    def Q(self):
+        # (state_dim, state_dim) process noise covariance
+        return torch.diag(self.Q_l**2)
+
     def forward(self, states_prev, controls, noisy=False):
         # states_prev:  (N, M, state_dim)
         # controls: (N, control_dim)
 
-        self.jacobian = False
         if self.use_particles:
             assert len(states_prev.shape) == 3  # (N, M, state_dim)
             N, M, state_dim = states_prev.shape
@@ -133,7 +137,6 @@ class PandaDynamicsModel(dpf.DynamicsModel):
                 #this is due to mask for jacobian
                 N, X, state_dim = states_prev.shape
                 dimensions = (N, X)
-                self.jacobian = True
             else:
                 assert len(states_prev.shape) == 2  # (N, M, state_dim)
                 N, state_dim = states_prev.shape
@@ -144,7 +147,7 @@ class PandaDynamicsModel(dpf.DynamicsModel):
         # M := particle count
 
         # (N, control_dim) => (N, units // 2)
-        control_features = self.control_layers(controls)
+        control_features = self.encode_controls(controls)
 
         # (N, units // 2) => (N, M, units // 2)
         if self.use_particles:
@@ -152,27 +155,71 @@ class PandaDynamicsModel(dpf.DynamicsModel):
                 N, M, self.units)
             assert control_features.shape == (N, M, self.units)
 
-        # (N, M, state_dim) => (N, M, units // 2)
+        states_new = self.predict(states_prev, control_features)
+        assert states_new.shape == dimensions + (state_dim,)
+
+        # print("q: ", self.Q)
+        # Add noise if desired
+        if noisy:
+            dist = torch.distributions.MultivariateNormal(
+                torch.zeros(self.state_dim, dtype=torch.float32).to(states_new.device),
+                self.Q,)
+            # Taking sqrt of the covariance matrix since it is diagonal...
+            # Normal takes in std instead of variance
+            if self.learnable_Q:
+                noise = dist.rsample(dimensions)
+            else:
+                noise = dist.sample(dimensions)
+            assert noise.shape == dimensions + (state_dim,)
+            states_new = states_new + noise
+
+        # Return (N, M, state_dim)
+        return states_new
+
+    def encode_controls(self, controls):
+        """
+        Computes the state-independent part of the dynamics model.
+
+        Args:
+            controls (torch.Tensor): (N, control_dim) controls.
+        Returns:
+            torch.Tensor: (N, units) control features.
+        """
+        return self.control_layers(controls)
+
+    def predict(self, states_prev, control_features):
+        """
+        Noise-free state prediction from encoded controls.
+
+        Args:
+            states_prev (torch.Tensor): (*, state_dim) states.
+            control_features (torch.Tensor): (*, units) outputs of
+                `encode_controls()`, with the same leading dimensions as
+                `states_prev`.
+        Returns:
+            torch.Tensor: (*, state_dim) predicted states.
+        """
+        dimensions = states_prev.shape[:-1]
+        state_dim = states_prev.shape[-1]
+        assert control_features.shape == dimensions + (self.units, )
+
+        # (*, state_dim) => (*, units // 2)
         state_features = self.state_layers(states_prev)
         assert state_features.shape == dimensions + (self.units, )
 
-        # (N, M, units)
+        # (*, units)
         merged_features = torch.cat(
             (control_features, state_features),
             dim=-1)
         assert merged_features.shape == dimensions + (self.units * 2, )
 
-        # (N, M, units * 2) => (N, M, state_dim + 1)
+        # (*, units * 2) => (*, state_dim + 1)
         output_features = self.shared_layers(merged_features)
 
         # We separately compute a direction for our network and a "gate"
         # These are multiplied to produce our final state output
-        if self.use_particles or self.jacobian:
-            state_update_direction = output_features[:, :, :state_dim]
-            state_update_gate = torch.sigmoid(output_features[:, :, -1:])
-        else:
-            state_update_direction = output_features[:, :state_dim]
-            state_update_gate = torch.sigmoid(output_features[:, -1:])
+        state_update_direction = output_features[..., :state_dim]
+        state_update_gate = torch.sigmoid(output_features[..., -1:])
         state_update = state_update_direction * state_update_gate
         assert state_update.shape == dimensions + (state_dim,)
 
@@ -186,28 +233,7 @@ class PandaDynamicsModel(dpf.DynamicsModel):
         # states_new = states_prev.clone()
         # states_new[update_dims] += state_update
 
-        states_new = states_prev + state_update
-        assert states_new.shape == dimensions + (state_dim,)
-
-        self.Q = torch.diag(self.Q_l**2)
-
-        # print("q: ", self.Q)
-        # Add noise if desired
-        if noisy:
-            dist = torch.distributions.MultivariateNormal(
-                torch.zeros(self.state_dim, dtype=torch.float32).to(states_new.device),
-                self.Q,)
-            # Taking sqrt of the covariance matrix since it is diagonal...
-            # Normal takes in std instead of variance
-            if self.learnable_Q:
-                noise = dist.rsample(dimensions)
-            else:
-                noise = dist.sample(dimensions)
-            assert noise.shape == dimensions + (state_dim,)
-            states_new = states_new + noise
-
-        # Return (N, M, state_dim)
-        return states_new
+        return states_prev + state_update
 
 
 class PandaSimpleMeasurementModel(dpf.MeasurementModel):
@@ -296,21 +322,24 @@ class PandaMeasurementModel(dpf.MeasurementModel):
 
         self.units = units
 
+        # Image features from the last timestep with an `image_fresh` flag
+        self._cached_image_features = None
+
+        # (# of images, # of frames encoded) since the last
+        # `utility.reset_image_dedup_counts()`
+        self.image_dedup_counts = None
+
     def forward(self, observations, states):
-        assert type(observations) == dict
-        assert len(states.shape) == 3  # (N, M, state_dim)
-        assert states.shape[2] == self.state_dim
+        return self.score(self.encode(observations), states)
 
-        # N := distinct trajectory count
-        # M := particle count
-        N, M, _ = states.shape
+    def encode(self, observations):
+        assert type(observations) == dict
 
         # Construct observations feature vector
         # (N, obs_dim)
         obs = []
         if "image" in self.modalities:
-            obs.append(self.observation_image_layers(
-                observations['image'][:, np.newaxis, :, :]))
+            obs.append(self._encode_fresh_image(observations))
 
         if "gripper_pos" in self.modalities:
             obs.append(self.observation_pos_layers(
@@ -320,32 +349,84 @@ class PandaMeasurementModel(dpf.MeasurementModel):
             obs.append(self.observation_sensors_layers(
                 observations['gripper_sensors']))
 
+        # N := distinct trajectory count
         observation_features = torch.cat(obs, dim=1)
-
-        # (N, obs_features) => (N, M, obs_features)
-        observation_features = observation_features[:, np.newaxis, :].expand(
-            N, M, self.units * len(self.modalities))
+        N = observation_features.shape[0]
         assert observation_features.shape == (
-            N, M, self.units * len(self.modalities))
+            N, self.units * len(self.modalities))
+
+        # The first shared layer acts on [observation features, state
+        # features]; we apply the observation half here, once per
+        # observation instead of once per particle
+        #
+        # (N, obs_features) => (N, units)
+        obs_dim = self.units * len(self.modalities)
+        first_layer = self.shared_layers[0]
+        observation_features = F.linear(
+            observation_features,
+            first_layer.weight[:, :obs_dim],
+            first_layer.bias)
+        assert observation_features.shape == (N, self.units)
+
+        return observation_features
+
+    def score(self, observation_features, states):
+        assert len(states.shape) == 3  # (N, M, state_dim)
+        assert states.shape[2] == self.state_dim
+
+        # N := distinct trajectory count
+        # M := particle count
+        N, M, _ = states.shape
+        assert observation_features.shape == (N, self.units)
 
+        # The state half of the first shared layer directly follows the
+        # (linear) state layer, so we fold the two into one matrix
+        #
         # (N, M, state_dim) => (N, M, units)
-        state_features = self.state_layers(states)
-        # state_features = self.state_layers(states * torch.tensor([[[1., 0.]]], device=states.device))
+        obs_dim = self.units * len(self.modalities)
+        shared_state_weight = self.shared_layers[0].weight[:, obs_dim:]
+        state_layer = self.state_layers[0]
+        state_features = F.linear(
+            states,
+            shared_state_weight @ state_layer.weight,
+            shared_state_weight @ state_layer.bias)
         assert state_features.shape == (N, M, self.units)
 
-        merged_features = torch.cat(
-            (observation_features, state_features),
-            dim=2)
-        assert merged_features.shape == (
-            N, M, self.units * (len(self.modalities) + 1))
+        # Sum instead of concatenating features
+        merged_features = observation_features[:, np.newaxis, :] + \
+            state_features
+        assert merged_features.shape == (N, M, self.units)
 
-        # (N, M, merged_dim) => (N, M, 1)
-        log_likelihoods = self.shared_layers(merged_features)
+        # (N, M, units) => (N, M, 1)
+        log_likelihoods = self.shared_layers[1:](merged_features)
         assert log_likelihoods.shape == (N, M, 1)
 
         # Return (N, M)
         return torch.squeeze(log_likelihoods, dim=2)
 
+    def _encode_fresh_image(self, observations):
+        # If observations come with an `image_fresh` flag, features are only
+        # recomputed for new frames
+        # (N, 32, 32) => (N, units)
+        fresh = observations.get('image_fresh')
+        features = utility.encode_fresh(
+            self._encode_unique_images,
+            observations['image'],
+            fresh,
+            self._cached_image_features)
+        if fresh is not None:
+            self._cached_image_features = features
+        return features
+
+    def _encode_unique_images(self, images):
+        # Repeated frames are only encoded once
+        # (N, 32, 32) => (N, units)
+        features, unique_count = utility.encode_unique(
+            lambda x: self.observation_image_layers(x[:, np.newaxis, :, :]),
+            images)
+        utility.record_image_dedup(self, len(images), unique_count)
+        return features
+
 
 class PandaEKFMeasurementModel(dpf.MeasurementModel):
     """
@@ -452,20 +533,30 @@ class PandaEKFMeasurementModel(dpf.MeasurementModel):
 
         self.add_R_noise = torch.ones(state_dim) * add_R_noise
 
+        # Image features from the last timestep with an `image_fresh` flag
+        self._cached_image_features = None
+
+        # (# of images, # of frames encoded) since the last
+        # `utility.reset_image_dedup_counts()`
+        self.image_dedup_counts = None
+
     def forward(self, observations, states):
+        return self.score(self.encode(observations), states)
+
+    def encode(self, observations):
+        # Our measurements don't depend on the input states, so we compute z
+        # and R here and just pass them through in `score()`
         assert type(observations) == dict
 
         # N := distinct trajectory count (batch size)
 
         N = observations['image'].shape[0]
-        assert states.shape == (N, self.state_dim)
 
         # Construct observations feature vector
         # (N, obs_dim)
         obs = []
         if "image" in self.modalities:
-            obs.append(self.observation_image_layers(
-                observations['image'][:, np.newaxis, :, :]))
+            obs.append(self._encode_fresh_image(observations))
         if "gripper_pos" in self.modalities:
             obs.append(
                 self.observation_pose_layers(
@@ -497,6 +588,38 @@ class PandaEKFMeasurementModel(dpf.MeasurementModel):
 
         return z, R
 
+    def score(self, observation_features, states):
+        z, R = observation_features
+
+        N = z.shape[0]
+        assert states.shape == (N, self.state_dim)
+
+        return z, R
+
+    def _encode_image(self, images):
+        # (N, 32, 32) => (N, units)
+        return self.observation_image_layers(images[:, np.newaxis, :, :])
+
+    def _encode_fresh_image(self, observations):
+        # If observations come with an `image_fresh` flag, features are only
+        # recomputed for new frames
+        fresh = observations.get('image_fresh')
+        features = utility.encode_fresh(
+            self._encode_unique_images,
+            observations['image'],
+            fresh,
+            self._cached_image_features)
+        if fresh is not None:
+            self._cached_image_features = features
+        return features
+
+    def _encode_unique_images(self, images):
+        # Repeated frames are only encoded once
+        features, unique_count = utility.encode_unique(
+            self._encode_image, images)
+        utility.record_image_dedup(self, len(images), unique_count)
+        return features
+
 
 class PandaEKFMeasurementModelSpatial(PandaEKFMeasurementModel):
     """
@@ -631,51 +754,12 @@ class PandaEKFMeasurementModel2GAP(PandaEKFMeasurementModel):
             resblocks.Linear(units),
         )
 
-    def forward(self, observations, states):
-        assert type(observations) == dict
-
-        # N := distinct trajectory count (batch size)
-
-        N = observations['image'].shape[0]
-        assert states.shape == (N, self.state_dim)
-        # Construct observations feature vector
-        # (N, obs_dim)
-        obs = []
-        if "image" in self.modalities:
-            x = self.observation_image_layers(
-                observations['image'][:, np.newaxis, :, :])
-            x1 = self.gap_h(x).flatten(1,-1)
-            x2 = self.gap_w(x).flatten(1,-1)
+    def _encode_image(self, images):
+        # (N, 32, 32) => (N, 2, 32, 32)
+        x = self.observation_image_layers(images[:, np.newaxis, :, :])
 
-            out = self.gap_layers(torch.cat((x1, x2),-1))
-            obs.append(out)
-        if "gripper_pos" in self.modalities:
-            obs.append(
-                self.observation_pose_layers(
-                    observations['gripper_pos']))
-        if "gripper_sensors" in self.modalities:
-            obs.append(self.observation_sensors_layers(
-                observations['gripper_sensors']))
-
-        observation_features = torch.cat(obs, dim=1)
-        # missing modalities
-        assert observation_features.shape == (
-            N, self.units * len(self.modalities))
-
-        shared_features = self.shared_layers(observation_features)
-        assert shared_features.shape == (N, self.units * 2)
-
-        shared_features_z = shared_features[:, :self.units].clone()
-        z = self.z_layer(shared_features_z)
-        assert z.shape == (N, self.state_dim)
-
-        lt_hat = self.r_layer(shared_features[:, self.units:].clone())
-        lt = torch.diag_embed(lt_hat, offset=0, dim1=-2, dim2=-1)
-        assert lt.shape == (N, self.state_dim, self.state_dim)
-
-        R = lt ** 2
-
-        if self.add_R_noise[0] > 0:
-            R += torch.diag(self.add_R_noise).to(R.device)
+        # Pool across rows and columns separately
+        x1 = self.gap_h(x).flatten(1, -1)
+        x2 = self.gap_w(x).flatten(1, -1)
 
-        return z, R
\ No newline at end of file
+        return self.gap_layers(torch.cat((x1, x2), -1))
@@ -9,7 +9,13 @@ from . import dpf
 
 
 class StateEstimator(abc.ABC):
-    def __init__(self):
+    def __init__(self, vision_interval=10):
+        # New camera frames arrive every `vision_interval` steps, as in
+        # `panda_datasets.load_trajectories()`; each observation gets an
+        # `image_fresh` flag, which fusion models built with `multirate=True`
+        # use to skip image updates in between
+        assert vision_interval >= 1
+        self.vision_interval = vision_interval
         self.counter = 0
         self.prev_image = None
 
@@ -27,7 +33,11 @@ class StateEstimator(abc.ABC):
         ), axis=0)[np.newaxis, :]
         observations['image'] = obs['image'][np.newaxis,:,:]
 
-        if self.counter % 10 != 0:
+        # Models can reuse image features between new frames
+        image_fresh = self.counter % self.vision_interval == 0
+        observations['image_fresh'] = np.array(
+            [image_fresh], dtype=np.float32)
+        if not image_fresh:
             observations['image'] = self.prev_image
         self.prev_image = observations['image']
         self.counter += 1
@@ -57,8 +67,8 @@ class StateEstimator(abc.ABC):
 
 
 class GroundTruthStateEstimator(StateEstimator):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, vision_interval=10):
+        super().__init__(vision_interval)
         pass
 
     def update(self, obs):
@@ -67,8 +77,8 @@ class GroundTruthStateEstimator(StateEstimator):
 
 
 class BaselineStateEstimator(StateEstimator):
-    def __init__(self, experiment_name, initial_obs):
-        super().__init__()
+    def __init__(self, experiment_name, initial_obs, vision_interval=10):
+        super().__init__(vision_interval)
 
         # Create model
         self.model = panda_baseline_models.PandaBaselineModel(
@@ -100,8 +110,9 @@ class BaselineStateEstimator(StateEstimator):
         return utils.to_numpy(estimate)
 
 class DPFStateEstimator(StateEstimator):
-    def __init__(self, experiment_name, initial_obs, e2e=True):
-        super().__init__()
+    def __init__(self, experiment_name, initial_obs, e2e=True,
+                 vision_interval=10):
+        super().__init__(vision_interval)
 
         door_pos = initial_obs['object-state'][1]
 
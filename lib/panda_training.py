@@ -6,7 +6,7 @@ from tqdm.auto import tqdm
 
 from fannypack import utils
 
-from . import dpf
+from . import dpf, rollouts, utility
 
 
 def train_dynamics_recurrent(buddy, pf_model, dataloader, log_interval=10,
@@ -192,11 +192,14 @@ def train_measurement(buddy, pf_model, dataloader,
         batch_gpu = utils.to_device(batch, buddy._device)
         noisy_states, observations, log_likelihoods, _ = batch_gpu
 
-        noisy_states = noisy_states[:, np.newaxis, :]
+        # Noisy states are either (N, state_dim), or (N, K, state_dim) when
+        # several are scored against each observation
+        if len(noisy_states.shape) == 2:
+            noisy_states = noisy_states[:, np.newaxis, :]
+            log_likelihoods = log_likelihoods[:, np.newaxis]
         pred_likelihoods = pf_model.measurement_model(
             observations, noisy_states)
-        assert len(pred_likelihoods.shape) == 2
-        pred_likelihoods = pred_likelihoods.squeeze(dim=1)
+        assert pred_likelihoods.shape == log_likelihoods.shape
 
         loss = torch.mean((pred_likelihoods - log_likelihoods) ** 2)
         losses.append(utils.to_numpy(loss))
@@ -220,12 +223,35 @@ def train_measurement(buddy, pf_model, dataloader,
 
 
 def train_e2e(buddy, pf_model, dataloader, log_interval=2,
-              loss_type="mse", optim_name="e2e", resample=False, know_image_blackout=False):
+              loss_type="mse", optim_name="e2e", resample=False,
+              know_image_blackout=False, ess_threshold=None,
+              kld_sampling=False, pre_encode=False, particle_count=None,
+              particle_stddev=None, generator=None):
+    # ESS-triggered resampling decides which trajectories to resample, so it
+    # implies `resample`
+    if ess_threshold is not None:
+        resample = True
+
     # Train for 1 epoch
     for batch_idx, batch in enumerate(tqdm(dataloader)):
+        utility.reset_image_dedup_counts(pf_model)
+
         # Transfer to GPU and pull out batch data
         batch_gpu = utils.to_device(batch, buddy._device)
-        batch_particles, batch_states, batch_obs, batch_controls = batch_gpu
+        if len(batch_gpu) == 4:
+            batch_particles, batch_states, batch_obs, batch_controls = \
+                batch_gpu
+        else:
+            # Datasets built with `sample_particles=False` leave initial
+            # particles to us; draw them on-device, for the whole batch
+            batch_states, batch_obs, batch_controls = batch_gpu
+            batch_particles = dpf.sample_initial_particles(
+                batch_states[:, 0],
+                particle_count=dataloader.dataset.particle_count
+                if particle_count is None else particle_count,
+                particle_stddev=dataloader.dataset.particle_stddev
+                if particle_stddev is None else particle_stddev,
+                generator=generator)
 
         # N = batch size, M = particle count
         N, timesteps, control_dim = batch_controls.shape
@@ -237,31 +263,44 @@ def train_e2e(buddy, pf_model, dataloader, log_interval=2,
         particles = batch_particles
         log_weights = torch.ones((N, M), device=buddy._device) * (-np.log(M))
 
+        # Optional forward arguments; these aren't supported by every filter
+        forward_kwargs = {}
+        if know_image_blackout:
+            forward_kwargs['know_image_blackout'] = True
+        if ess_threshold is not None:
+            forward_kwargs['ess_threshold'] = ess_threshold
+        if kld_sampling:
+            # The initial particle count is an upper bound for every step;
+            # otherwise, particle sets could only ever shrink
+            forward_kwargs['kld_sampling'] = True
+            forward_kwargs['output_particles'] = M
+
+        # Observation encodings don't depend on the particles, so we can
+        # optionally compute them for the whole sequence in one batch; this
+        # is also the only way that repeated camera frames are deduplicated
+        if pre_encode:
+            observation_features = utility.encode_sequence(pf_model, batch_obs)
+
         # Accumulate losses from each timestep
         losses = []
+        particle_counts = []
         for t in range(1, timesteps):
             prev_particles = particles
             prev_log_weights = log_weights
 
-            if know_image_blackout:
-                state_estimates, new_particles, new_log_weights = pf_model.forward(
-                    prev_particles,
-                    prev_log_weights,
-                    utils.DictIterator(batch_obs)[:, t - 1, :],
-                    batch_controls[:, t, :],
-                    resample=resample,
-                    noisy_dynamics=True,
-                    know_image_blackout=True
-                )
-            else:
-                state_estimates, new_particles, new_log_weights = pf_model.forward(
-                    prev_particles,
-                    prev_log_weights,
-                    utils.DictIterator(batch_obs)[:, t - 1, :],
-                    batch_controls[:, t, :],
-                    resample=resample,
-                    noisy_dynamics=True,
-                )
+            if pre_encode:
+                forward_kwargs['observation_features'] = utility.map_nested(
+                    lambda x: x[:, t - 1], observation_features)
+
+            state_estimates, new_particles, new_log_weights = pf_model.forward(
+                prev_particles,
+                prev_log_weights,
+                utils.DictIterator(batch_obs)[:, t - 1, :],
+                batch_controls[:, t, :],
+                resample=resample,
+                noisy_dynamics=True,
+                **forward_kwargs
+            )
 
             if loss_type == "gmm":
                 loss = dpf.gmm_loss(
@@ -277,6 +316,8 @@ def train_e2e(buddy, pf_model, dataloader, log_interval=2,
                 assert False, "Invalid loss"
 
             losses.append(loss)
+            particle_counts.append(
+                dpf.active_particle_counts(new_log_weights).float().mean())
 
             # Enable backprop through time
             particles = new_particles
@@ -298,14 +339,24 @@ def train_e2e(buddy, pf_model, dataloader, log_interval=2,
                 buddy.log("Training loss", np.mean(utils.to_numpy(losses)))
                 buddy.log("Log weights mean", log_weights.mean())
                 buddy.log("Log weights std", log_weights.std())
+                buddy.log("Effective sample size mean",
+                          dpf.effective_sample_size(log_weights).mean())
+                buddy.log("Particle count mean",
+                          torch.stack(particle_counts).mean())
                 buddy.log("Particle states mean", particles.mean())
                 buddy.log("particle states std", particles.std())
+                if pre_encode:
+                    for name, ratio in utility.image_dedup_ratios(
+                            pf_model).items():
+                        buddy.log(f"Image dedup ratio ({name})", ratio)
 
     print("Epoch loss:", np.mean(utils.to_numpy(losses)))
 
 
 def rollout(pf_model, trajectories, start_time=0, max_timesteps=300,
-            particle_count=100, noisy_dynamics=True, true_initial=False):
+            particle_count=100, noisy_dynamics=True, true_initial=False,
+            ess_threshold=None, kld_sampling=False, pre_encode=False,
+            encode_chunk_size=1024):
     # To make things easier, we're going to cut all our trajectories to the
     # same length :)
     end_time = np.min([len(s) for s, _, _ in trajectories] +
@@ -313,64 +364,33 @@ def rollout(pf_model, trajectories, start_time=0, max_timesteps=300,
     actual_states = [states[start_time:end_time]
                      for states, _, _ in trajectories]
 
-    state_dim = len(actual_states[0][0])
-    N = len(trajectories)
     M = particle_count
-
     device = next(pf_model.parameters()).device
 
-    particles = np.zeros((N, M, state_dim))
-    if true_initial:
-        for i in range(N):
-            particles[i, :] = trajectories[i][0][0]
-        particles += np.random.normal(0, 0.1, size=particles.shape)
-    else:
-        # Distribute initial particles randomly
-        particles += np.random.normal(0, 1.0, size=particles.shape)
-
-    # Populate the initial state estimate as just the estimate of our particles
-    # This is a little hacky
-    predicted_states = [[np.mean(particles[i], axis=0)]
-                        for i in range(len(trajectories))]
-
-    particles = utils.to_torch(particles, device=device)
-    log_weights = torch.ones((N, M), device=device) * (-np.log(M))
-
-    for t in tqdm(range(start_time + 1, end_time)):
-        s = []
-        o = {}
-        c = []
-        for i, traj in enumerate(trajectories):
-            states, observations, controls = traj
-
-            s.append(predicted_states[i][t - start_time - 1])
-            o_t = utils.DictIterator(observations)[t]
-            utils.DictIterator(o).append(o_t)
-            c.append(controls[t])
-
-        s = np.array(s)
-        utils.DictIterator(o).convert_to_numpy()
-        c = np.array(c)
-        (s, o, c) = utils.to_torch((s, o, c), device=device)
-
-        state_estimates, new_particles, new_log_weights = pf_model.forward(
-            particles,
-            log_weights,
-            o,
-            c,
-            resample=True,
-            noisy_dynamics=noisy_dynamics
-        )
-
-        particles = new_particles
-        log_weights = new_log_weights
-
-        for i in range(len(trajectories)):
-            predicted_states[i].append(
-                utils.to_numpy(
-                    state_estimates[i]))
-
-    predicted_states = np.array(predicted_states)
+    batch = rollouts.TrajectoryBatch(trajectories, end_time, device)
+    adapter = rollouts.ParticleFilterAdapter(
+        pf_model,
+        particle_count=particle_count,
+        noisy_dynamics=noisy_dynamics,
+        true_initial=true_initial,
+        initial_particle_std=0.1,
+        ess_threshold=ess_threshold,
+        kld_sampling=kld_sampling,
+        pre_encode=pre_encode,
+        encode_chunk_size=encode_chunk_size)
+    results = rollouts.run_rollout(
+        adapter, batch, start_time, end_time, progress=True)
+
+    # Track weight degeneracy, particle counts; the first timestep is just
+    # our initial particles
+    if ess_threshold is not None:
+        resample_rate = np.mean(results['ess'][:, 1:] < ess_threshold * M)
+        print("Resampled trajectories per step: {:.1%}".format(resample_rate))
+    if kld_sampling:
+        print("Average particles per step:",
+              np.mean(results['particle_counts'][:, 1:]))
+
+    predicted_states = results['states']
     actual_states = np.array(actual_states)
     return predicted_states, actual_states
 
@@ -435,79 +455,28 @@ def rollout_and_eval(pf_model, trajectories, start_time=0, max_timesteps=300,
     actual_states = [states[start_time:end_time]
                      for states, _, _ in trajectories]
 
-    state_dim = len(actual_states[0][0])
-    N = len(trajectories)
-    M = particle_count
-
     device = next(pf_model.parameters()).device
 
-    particles = np.zeros((N, M, state_dim))
-    if true_initial:
-        for i in range(N):
-            particles[i, :] = trajectories[i][0][0]
-        particles += np.random.normal(0, 0.2, size=[N, 1, state_dim])
-        particles += np.random.normal(0, 0.2, size=particles.shape)
-    else:
-        # Distribute initial particles randomly
-        particles += np.random.normal(0, 1.0, size=particles.shape)
-
-    # Populate the initial state estimate as just the estimate of our particles
-    # This is a little hacky
-    # (N, t, state_dim)
-    predicted_states = [[np.mean(particles[i], axis=0)]
-                        for i in range(len(trajectories))]
+    batch = rollouts.TrajectoryBatch(trajectories, end_time, device)
+    adapter = rollouts.ParticleFilterAdapter(
+        pf_model,
+        particle_count=particle_count,
+        noisy_dynamics=noisy_dynamics,
+        true_initial=true_initial,
+        initial_offset_std=0.2,
+        initial_particle_std=0.2,
+        record_particles=True)
+    results = rollouts.run_rollout(
+        adapter, batch, start_time, end_time, progress=True)
 
-    particles = utils.to_torch(particles, device=device)
-    log_weights = torch.ones((N, M), device=device) * (-np.log(M))
+    # (N, t, state_dim)
+    predicted_states = results['states']
+    actual_states = np.array(actual_states)
 
     # (N, t, M, state_dim)
-    particles_history = []
+    particles_history = results['particles']
     # (N, t, M)
-    weights_history = []
-
-    for i in range(N):
-        particles_history.append([utils.to_numpy(particles[i])])
-        weights_history.append([utils.to_numpy(log_weights[i])])
-
-    for t in tqdm(range(start_time + 1, end_time)):
-        s = []
-        o = {}
-        c = []
-        for i, traj in enumerate(trajectories):
-            states, observations, controls = traj
-
-            s.append(predicted_states[i][t - start_time - 1])
-            o_t = utils.DictIterator(observations)[t]
-            utils.DictIterator(o).append(o_t)
-            c.append(controls[t])
-
-        s = np.array(s)
-        utils.DictIterator(o).convert_to_numpy()
-        c = np.array(c)
-        (s, o, c) = utils.to_torch((s, o, c), device=device)
-
-        state_estimates, new_particles, new_log_weights = pf_model.forward(
-            particles,
-            log_weights,
-            o,
-            c,
-            resample=True,
-            noisy_dynamics=noisy_dynamics
-        )
-
-        particles = new_particles
-        log_weights = new_log_weights
-
-        for i in range(len(trajectories)):
-            predicted_states[i].append(
-                utils.to_numpy(
-                    state_estimates[i]))
-
-            particles_history[i].append(utils.to_numpy(particles[i]))
-            weights_history[i].append(np.exp(utils.to_numpy(log_weights[i])))
-
-    predicted_states = np.array(predicted_states)
-    actual_states = np.array(actual_states)
+    weights_history = results['weights']
 
     ### Eval
     timesteps = len(actual_states[0])
@@ -0,0 +1,589 @@
+import abc
+
+import numpy as np
+import torch
+from tqdm.auto import tqdm
+
+from fannypack import utils
+
+from . import dpf, utility
+
+
+class TrajectoryBatch:
+    """Stacked states, observations, and controls from a list of trajectories.
+
+    Everything is converted to contiguous (N, T, *) tensors once, so rollouts
+    can pull out per-timestep (N, *) views instead of rebuilding batches from
+    each trajectory at every step.
+
+    Args:
+        trajectories (list): list of (states, observations, controls)
+            tuples, each with T or more timesteps.
+        end_time (int): # of timesteps to keep from each trajectory; this
+            should be no longer than the shortest trajectory.
+        device (torch.device): device to store tensors on.
+        image_range (tuple): (low, high) values of images stored as uint8
+            codes; see `utility.dequantize_images()`.
+    """
+
+    def __init__(self, trajectories, end_time, device,
+                 image_range=(-1., 1.)):
+        assert len(trajectories) > 0
+        assert np.min([len(s) for s, _, _ in trajectories]) >= end_time
+
+        # (N, T, state_dim)
+        states = np.stack([s[:end_time] for s, _, _ in trajectories])
+
+        # key->(N, T, *)
+        observations = utility.apply_observation_masks({
+            key: np.stack([o[key][:end_time] for _, o, _ in trajectories])
+            for key in trajectories[0][1].keys()
+        }, image_range=image_range)
+
+        # (N, T, control_dim)
+        controls = np.stack([c[:end_time] for _, _, c in trajectories])
+
+        (self.states, self.observations, self.controls) = utils.to_torch(
+            (states, observations, controls), device=device)
+
+        self.N = len(trajectories)
+        self.T = end_time
+        self.device = device
+
+        # (N, T) flags for whether each image is a new frame; see
+        # `observations_at()`
+        if 'image' in self.observations:
+            self.image_fresh = utility.fresh_flags(self.observations['image'])
+        else:
+            self.image_fresh = torch.ones((self.N, self.T), device=device)
+
+    def states_at(self, t):
+        """Ground-truth states at timestep `t`, as an (N, state_dim) view."""
+        return self.states[:, t]
+
+    def observations_at(self, t, multirate=False):
+        """Observations at timestep `t`, as a dict of (N, *) views.
+
+        With `multirate=True`, observations also get an (N,) `image_fresh`
+        flag, which is 0 wherever the image is unchanged from timestep
+        `t - 1`; models can reuse image features from the last timestep
+        there.
+        """
+        observations = {
+            key: value[:, t] for key, value in self.observations.items()}
+        if multirate:
+            observations['image_fresh'] = self.image_fresh[:, t]
+        return observations
+
+    def controls_at(self, t):
+        """Controls at timestep `t`, as an (N, control_dim) view."""
+        return self.controls[:, t]
+
+    def encode(self, model, start_time, end_time, chunk_size=None):
+        """Encode observations for timesteps in [start_time, end_time) with
+        `model.encode()`.
+
+        Returns features with leading dimensions (N, end_time - start_time).
+        """
+        observations = {
+            key: value[:, start_time:end_time]
+            for key, value in self.observations.items()
+        }
+
+        # Observation features are only used as inputs during rollouts, so we
+        # don't need to build a graph here
+        with torch.no_grad():
+            return utility.encode_sequence(
+                model, observations, chunk_size=chunk_size)
+
+
+class FilterAdapter(abc.ABC):
+    """Interface between a filter and the rollout engine.
+
+    Adapters hold all filter state between timesteps. Outputs are dicts of
+    (N, *) tensors or arrays, and must have the same keys & shapes at every
+    timestep.
+    """
+
+    @abc.abstractmethod
+    def initialize(self, batch, start_time, end_time):
+        """
+        Set up filter state for a rollout over [start_time, end_time), and
+        return outputs for `start_time`.
+        """
+        pass
+
+    @abc.abstractmethod
+    def step(self, batch, t):
+        """
+        Advance the filter to timestep `t`, and return outputs for it.
+        """
+        pass
+
+
+class ParticleFilterAdapter(FilterAdapter):
+    """Rollout adapter for `dpf.ParticleFilterNetwork` and
+    `fusion_pf.ParticleFusionModel`.
+
+    With `multirate=True`, observations come with `image_fresh` flags (see
+    `TrajectoryBatch.observations_at()`), so image features are only
+    recomputed for new frames.
+
+    Outputs:
+        states: (N, state_dim) state estimates.
+        particle_counts: (N,) # of active particles.
+        ess: (N,) effective sample sizes; only if `ess_threshold` is set.
+        particles, weights: (N, M, state_dim) particles and (N, M) particle
+            weights; only if `record_particles`.
+    """
+
+    def __init__(self, pf_model, particle_count=100, noisy_dynamics=True,
+                 true_initial=False, initial_offset_std=0.,
+                 initial_particle_std=0.1, ess_threshold=None,
+                 kld_sampling=False, pre_encode=False, encode_chunk_size=1024,
+                 record_particles=False, multirate=False):
+        # Recorded particles need a fixed particle count
+        assert not (kld_sampling and record_particles)
+
+        self.pf_model = pf_model
+        self.particle_count = particle_count
+        self.noisy_dynamics = noisy_dynamics
+        self.true_initial = true_initial
+        self.initial_offset_std = initial_offset_std
+        self.initial_particle_std = initial_particle_std
+        self.ess_threshold = ess_threshold
+        self.kld_sampling = kld_sampling
+        self.pre_encode = pre_encode
+        self.encode_chunk_size = encode_chunk_size
+        self.record_particles = record_particles
+        self.multirate = multirate
+
+        # Optional forward arguments; these aren't supported by every filter
+        self.forward_kwargs = {}
+        if ess_threshold is not None:
+            self.forward_kwargs['ess_threshold'] = ess_threshold
+            self.forward_kwargs['return_ess'] = True
+        if kld_sampling:
+            # `particle_count` becomes an upper bound; we pass it in at every
+            # step, so that particle sets can grow again after shrinking
+            self.forward_kwargs['kld_sampling'] = True
+            self.forward_kwargs['output_particles'] = particle_count
+
+    def initialize(self, batch, start_time, end_time):
+        N = batch.N
+        M = self.particle_count
+        state_dim = batch.states.shape[-1]
+
+        particles = np.zeros((N, M, state_dim))
+        if self.true_initial:
+            particles[:] = utils.to_numpy(batch.states_at(0))[:, np.newaxis]
+            if self.initial_offset_std > 0.:
+                particles += np.random.normal(
+                    0, self.initial_offset_std, size=[N, 1, state_dim])
+            particles += np.random.normal(
+                0, self.initial_particle_std, size=particles.shape)
+        else:
+            # Distribute initial particles randomly
+            particles += np.random.normal(0, 1.0, size=particles.shape)
+
+        self.particles = utils.to_torch(particles, device=batch.device)
+        self.log_weights = torch.ones(
+            (N, M), device=batch.device) * (-np.log(M))
+
+        # Encode all observations up front
+        self.start_time = start_time
+        if self.pre_encode:
+            self.observation_features = batch.encode(
+                self.pf_model, start_time + 1, end_time,
+                chunk_size=self.encode_chunk_size)
+        utility.clear_feature_caches(self.pf_model)
+
+        # Populate the initial state estimate as just the estimate of our
+        # particles
+        outputs = {
+            'states': np.mean(particles, axis=1),
+            'particle_counts': np.full(N, M),
+        }
+        if self.ess_threshold is not None:
+            outputs['ess'] = np.full(N, float(M))
+        if self.record_particles:
+            outputs['particles'] = particles
+            outputs['weights'] = np.full((N, M), 1. / M)
+        return outputs
+
+    def step(self, batch, t):
+        forward_kwargs = dict(self.forward_kwargs)
+        if self.pre_encode:
+            forward_kwargs['observation_features'] = utility.map_nested(
+                lambda x: x[:, t - self.start_time - 1],
+                self.observation_features)
+
+        # Nothing to backprop through, and keeping the graph would grow
+        # memory with rollout length
+        with torch.no_grad():
+            forward_outputs = self.pf_model.forward(
+                self.particles,
+                self.log_weights,
+                batch.observations_at(t, self.multirate),
+                batch.controls_at(t),
+                resample=True,
+                noisy_dynamics=self.noisy_dynamics,
+                **forward_kwargs
+            )
+        state_estimates, self.particles, self.log_weights = \
+            forward_outputs[:3]
+
+        outputs = {
+            'states': state_estimates,
+            'particle_counts': dpf.active_particle_counts(self.log_weights),
+        }
+        if self.ess_threshold is not None:
+            outputs['ess'] = forward_outputs[3]
+        if self.record_particles:
+            outputs['particles'] = self.particles
+            outputs['weights'] = torch.exp(self.log_weights)
+        return outputs
+
+
+class KalmanFilterAdapter(FilterAdapter):
+    """Rollout adapter for `ekf.KalmanFilterNetwork`.
+
+    If `true_initial` isn't set, initial estimates come from the
+    observations at timestep 0: from a full filter update with
+    `measurement_init=False`, or directly from the measurement model with
+    `measurement_init=True`.
+
+    With `multirate=True`, observations come with `image_fresh` flags (see
+    `TrajectoryBatch.observations_at()`), so image features are only
+    recomputed for new frames.
+
+    Outputs:
+        states: (N, state_dim) state estimates.
+        sigmas: (N, state_dim, state_dim) state covariances.
+        dyn_states, dyn_sigmas, meas_states, meas_sigmas, dyn_jac: dynamics &
+            measurement model predictions; only if `record_internals`. These
+            are copies of the initial estimate at the first timestep, and
+            `dyn_jac` is zero.
+    """
+
+    def __init__(self, kf_model, true_initial=False, init_state_noise=0.2,
+                 measurement_init=False, pre_encode=False,
+                 encode_chunk_size=1024, record_internals=False,
+                 multirate=False):
+        self.kf_model = kf_model
+        self.true_initial = true_initial
+        self.init_state_noise = init_state_noise
+        self.measurement_init = measurement_init
+        self.pre_encode = pre_encode
+        self.encode_chunk_size = encode_chunk_size
+        self.record_internals = record_internals
+        self.multirate = multirate
+
+    def initialize(self, batch, start_time, end_time):
+        N = batch.N
+        state_dim = batch.states.shape[-1]
+
+        if self.true_initial:
+            initial_states = utils.to_numpy(batch.states_at(0)) + \
+                np.random.normal(0.0, scale=self.init_state_noise,
+                                 size=(N, state_dim))
+            initial_sigmas = np.tile(
+                np.eye(state_dim) * self.init_state_noise ** 2, (N, 1, 1))
+            (self.states, self.sigmas) = utils.to_torch(
+                (initial_states, initial_sigmas), device=batch.device)
+        else:
+            self.states, self.sigmas = self._initialize_from_observations(
+                batch)
+
+        # Encode all observations up front
+        self.start_time = start_time
+        if self.pre_encode:
+            self.observation_features = batch.encode(
+                self.kf_model, start_time + 1, end_time,
+                chunk_size=self.encode_chunk_size)
+        utility.clear_feature_caches(self.kf_model)
+
+        outputs = {
+            'states': self.states,
+            'sigmas': self.sigmas,
+        }
+        if self.record_internals:
+            outputs.update({
+                'dyn_states': self.states,
+                'dyn_sigmas': self.sigmas,
+                'meas_states': self.states,
+                'meas_sigmas': self.sigmas,
+                'dyn_jac': torch.zeros_like(self.sigmas),
+            })
+        return outputs
+
+    def step(self, batch, t):
+        estimates = self.kf_model.forward(
+            self.states,
+            self.sigmas,
+            batch.observations_at(t, self.multirate),
+            batch.controls_at(t),
+            observation_features=self._features_at(t),
+        )
+        self.states = estimates[0].detach()
+        self.sigmas = estimates[1].detach()
+
+        outputs = {
+            'states': self.states,
+            'sigmas': self.sigmas,
+        }
+        if self.record_internals:
+            N = batch.N
+            kf_model = self.kf_model
+            outputs.update({
+                'dyn_states': kf_model.dynamics_states.detach(),
+                'dyn_sigmas': kf_model.dynamics_sigma.detach().expand(
+                    (N,) + kf_model.dynamics_sigma.shape),
+                'meas_states': kf_model.measurement_states.detach(),
+                'meas_sigmas': kf_model.measurement_sigma.detach(),
+                'dyn_jac': kf_model.dynamics_jac.detach(),
+            })
+        return outputs
+
+    def _initialize_from_observations(self, batch):
+        N = batch.N
+        state_dim = batch.states.shape[-1]
+        device = batch.device
+
+        initial_obs = batch.observations_at(0)
+        initial_states = torch.zeros((N, state_dim), device=device)
+        initial_sigmas = torch.zeros((N, state_dim, state_dim), device=device)
+
+        if self.measurement_init:
+            # Put into measurement model!
+            states, sigmas = self.kf_model.measurement_model.forward(
+                initial_obs, initial_states)
+        else:
+            # Put through a full filter update, with dummy controls
+            dummy_controls = torch.ones_like(batch.controls_at(0))
+            states, sigmas = self.kf_model.forward(
+                initial_states,
+                initial_sigmas,
+                initial_obs,
+                dummy_controls,
+            )
+        return states.detach(), sigmas.detach()
+
+    def _features_at(self, t):
+        if not self.pre_encode:
+            return None
+        return utility.map_nested(
+            lambda x: x[:, t - self.start_time - 1], self.observation_features)
+
+
+class KalmanFusionAdapter(KalmanFilterAdapter):
+    """Rollout adapter for `fusion.KalmanFusionModel`.
+
+    Initial covariances are filled with `init_state_noise ** 2`, and initial
+    estimates without `true_initial` come from `measurement_only()`.
+
+    Outputs:
+        states, sigmas: fused state estimates & covariances.
+        force_states, image_states: (N, state_dim) unimodal estimates.
+        force_betas, image_betas: fusion weights; zero at the first timestep.
+    """
+
+    def __init__(self, kf_model, true_initial=False, init_state_noise=0.2,
+                 pre_encode=False, encode_chunk_size=1024, multirate=False):
+        super().__init__(
+            kf_model,
+            true_initial=true_initial,
+            init_state_noise=init_state_noise,
+            pre_encode=pre_encode,
+            encode_chunk_size=encode_chunk_size,
+            multirate=multirate)
+
+    def initialize(self, batch, start_time, end_time):
+        N = batch.N
+        state_dim = batch.states.shape[-1]
+        device = batch.device
+
+        initial_states = torch.zeros((N, state_dim), device=device)
+        initial_sigmas = torch.ones(
+            (N, state_dim, state_dim), device=device) \
+            * self.init_state_noise ** 2
+
+        if self.true_initial:
+            initial_states = batch.states_at(0) + utils.to_torch(
+                np.random.normal(0.0, scale=self.init_state_noise,
+                                 size=(N, state_dim)),
+                device=device)
+            self.states, self.sigmas = initial_states, initial_sigmas
+        else:
+            # Put into measurement model!
+            states_tuple = self.kf_model.measurement_only(
+                batch.observations_at(0), initial_states)
+            self.states = states_tuple[0].detach()
+            self.sigmas = states_tuple[1].detach()
+
+        # Encode all observations up front
+        self.start_time = start_time
+        if self.pre_encode:
+            self.observation_features = batch.encode(
+                self.kf_model, start_time + 1, end_time,
+                chunk_size=self.encode_chunk_size)
+        utility.clear_feature_caches(self.kf_model)
+
+        return {
+            'states': self.states,
+            'sigmas': self.sigmas,
+            'force_states': self.states,
+            'image_states': self.states,
+            'force_betas': torch.zeros_like(self.states),
+            'image_betas': torch.zeros_like(self.states),
+        }
+
+    def step(self, batch, t):
+        estimates = self.kf_model.forward(
+            self.states,
+            self.sigmas,
+            batch.observations_at(t, self.multirate),
+            batch.controls_at(t),
+            return_all=True,
+            observation_features=self._features_at(t),
+        )
+        estimates = [estimate.detach() for estimate in estimates]
+        self.states, self.sigmas = estimates[:2]
+
+        return {
+            'states': estimates[0],
+            'sigmas': estimates[1],
+            'force_states': estimates[2],
+            'image_states': estimates[3],
+            'force_betas': estimates[4],
+            'image_betas': estimates[5],
+        }
+
+
+class BaselineAdapter(FilterAdapter):
+    """Rollout adapter for `panda_baseline_models.PandaBaselineModel`, which
+    predicts each state from the previous prediction. Starts from the true
+    initial state.
+
+    Outputs:
+        states: (N, state_dim) state estimates.
+    """
+
+    def __init__(self, model):
+        self.model = model
+
+    def initialize(self, batch, start_time, end_time):
+        self.states = batch.states_at(start_time)
+        return {'states': self.states}
+
+    def step(self, batch, t):
+        with torch.no_grad():
+            self.states = self.model(
+                self.states,
+                batch.observations_at(t),
+                batch.controls_at(t))
+        return {'states': self.states}
+
+
+class LSTMAdapter(FilterAdapter):
+    """Rollout adapter for `panda_baseline_models.PandaLSTMModel`. Steps the
+    LSTM one timestep at a time, carrying its hidden state. The initial
+    output is the true initial state.
+
+    Outputs:
+        states: (N, state_dim) state estimates.
+    """
+
+    def __init__(self, model):
+        self.model = model
+
+    def initialize(self, batch, start_time, end_time):
+        self.hidden = None
+        return {'states': batch.states_at(start_time)}
+
+    def step(self, batch, t):
+        # (N, 1, *) sequences of length 1
+        observations = {
+            key: value[:, t:t + 1]
+            for key, value in batch.observations.items()
+        }
+        controls = batch.controls[:, t:t + 1]
+
+        with torch.no_grad():
+            states, self.hidden = self.model(
+                observations, controls, self.hidden, return_hidden=True)
+        return {'states': states[:, 0]}
+
+
+def rollout_steps(adapter, batch, start_time, end_time, progress=False):
+    """Run a filter over a batch of trajectories, one timestep at a time.
+
+    Args:
+        adapter (FilterAdapter): filter to run.
+        batch (TrajectoryBatch): trajectories to run on.
+        start_time (int): first timestep; the filter is initialized here.
+        end_time (int): timestep to stop before.
+        progress (bool): whether to show a progress bar.
+    Yields:
+        (t, outputs) tuples for each timestep in [start_time, end_time), where
+        `outputs` is a dict of (N, *) numpy arrays.
+    """
+    assert end_time <= batch.T
+
+    outputs = adapter.initialize(batch, start_time, end_time)
+    yield start_time, _outputs_to_numpy(outputs)
+
+    timesteps = range(start_time + 1, end_time)
+    if progress:
+        timesteps = tqdm(timesteps)
+    for t in timesteps:
+        outputs = adapter.step(batch, t)
+        yield t, _outputs_to_numpy(outputs)
+
+
+def run_rollout(adapter, batch, start_time, end_time, stop_condition=None,
+                progress=False):
+    """Run a filter over a batch of trajectories, and collect its outputs.
+
+    Args:
+        adapter (FilterAdapter): filter to run.
+        batch (TrajectoryBatch): trajectories to run on.
+        start_time (int): first timestep; the filter is initialized here.
+        end_time (int): timestep to stop before.
+        stop_condition (callable, optional): called as
+            `stop_condition(t, outputs)` after each timestep; the rollout
+            ends early if it returns True.
+        progress (bool): whether to show a progress bar.
+    Returns:
+        dict: key->(N, T, *) array of outputs, where T is the number of
+        timesteps actually run.
+    """
+    timesteps = end_time - start_time
+    results = None
+    steps = 0
+
+    for t, outputs in rollout_steps(
+            adapter, batch, start_time, end_time, progress=progress):
+        # Allocate results once we know output shapes
+        if results is None:
+            results = {
+                key: np.zeros(
+                    (batch.N, timesteps) + value.shape[1:], dtype=value.dtype)
+                for key, value in outputs.items()
+            }
+
+        for key, value in outputs.items():
+            results[key][:, steps] = value
+        steps += 1
+
+        if stop_condition is not None and stop_condition(t, outputs):
+            break
+
+    return {key: value[:, :steps] for key, value in results.items()}
+
+
+def _outputs_to_numpy(outputs):
+    return {
+        key: value if isinstance(value, np.ndarray) else utils.to_numpy(value)
+        for key, value in outputs.items()
+    }
@@ -0,0 +1,273 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+# Bump this whenever cached loader outputs change
+cache_version = 5
+
+
+def cache_directory():
+    """Directory to store cached trajectories in. Can be set with the
+    `TRAJECTORY_CACHE_DIR` environment variable.
+    """
+    return os.environ.get(
+        "TRAJECTORY_CACHE_DIR", os.path.join("data", ".trajectory_cache"))
+
+
+def cache_key(path, loader_name, **loader_kwargs):
+    """Compute a cache key from a source file's fingerprint and the
+    arguments used to load it.
+
+    Args:
+        path (str): path to the source file.
+        loader_name (str): name of the loader; distinguishes loaders that
+            read the same file.
+        **loader_kwargs: any loader arguments that affect its output. These
+            must be JSON-serializable.
+    Returns:
+        str: hex digest.
+    """
+    stat = os.stat(path)
+    fingerprint = {
+        'path': os.path.abspath(path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'loader': loader_name,
+        'version': cache_version,
+        'kwargs': loader_kwargs,
+    }
+    return hashlib.sha1(json.dumps(
+        fingerprint, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def load(path, loader_name, load_fn, **loader_kwargs):
+    """Load trajectories through the on-disk cache.
+
+    On a cache miss, trajectories are produced by `load_fn()` and written to
+    the cache. Cached arrays are returned as read-only memory maps, so they
+    can be shared across processes.
+
+    Args:
+        path (str): path to the source file.
+        loader_name (str): name of the loader.
+        load_fn (callable): produces a list of (states, observations,
+            controls) trajectories; observations should be a key->(T, *) dict.
+        **loader_kwargs: loader arguments that affect its output.
+    Returns:
+        list: (states, observations, controls) trajectories.
+    """
+    return _read(_build(path, loader_name, load_fn, **loader_kwargs))
+
+
+def load_all(jobs, workers=None, use_cache=False):
+    """Load trajectories from several files, optionally through the on-disk
+    cache.
+
+    Files are loaded in parallel, with one process per file, and outputs are
+    sent back to the main process as regular (writable) arrays. With
+    `use_cache=True`, missing cache entries are built in parallel instead,
+    and entries are read as read-only memory maps in the main process.
+    Results are in the same order as `jobs`.
+
+    Args:
+        jobs (list): (path, loader_name, load_fn, loader_kwargs) tuples, with
+            arguments as in `load()`. `load_fn` must be picklable, e.g. a
+            `functools.partial` of a module-level function.
+        workers (int, optional): max # of processes; see `map_parallel()`.
+        use_cache (bool): whether to read and write cache entries.
+    Returns:
+        list: for each job, a list of (states, observations, controls)
+            trajectories.
+    """
+    if not use_cache:
+        return map_parallel(_run_job, jobs, workers)
+
+    missing = [
+        job for job in jobs
+        if not os.path.isdir(_entry_path(job[0], job[1], **job[3]))
+    ]
+    map_parallel(_build_job, missing, workers)
+    return [load(*job[:3], **job[3]) for job in jobs]
+
+
+def map_parallel(fn, items, workers=None):
+    """Apply a function to each item in a process pool, and return results in
+    input order. Runs in the current process for fewer than two items.
+
+    Args:
+        fn (callable): picklable function.
+        items (list): picklable inputs.
+        workers (int, optional): max # of processes. Defaults to one per item,
+            up to the CPU count.
+    Returns:
+        list: outputs.
+    """
+    if workers is None:
+        workers = min(len(items), os.cpu_count() or 1)
+    if workers <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(fn, items))
+
+
+def _entry_path(path, loader_name, **loader_kwargs):
+    """Path of the cache entry for a source file and loader arguments.
+    """
+    return os.path.join(
+        cache_directory(), cache_key(path, loader_name, **loader_kwargs))
+
+
+def _build(path, loader_name, load_fn, **loader_kwargs):
+    """Make sure that a cache entry exists, and return its path.
+    """
+    entry_path = _entry_path(path, loader_name, **loader_kwargs)
+    if not os.path.isdir(entry_path):
+        _write(entry_path, load_fn())
+    return entry_path
+
+
+def _run_job(job):
+    """Call the `load_fn` of a (path, loader_name, load_fn, loader_kwargs)
+    tuple.
+    """
+    return job[2]()
+
+
+def _build_job(job):
+    """`_build()` for a (path, loader_name, load_fn, loader_kwargs) tuple.
+    """
+    path, loader_name, load_fn, loader_kwargs = job
+    return _build(path, loader_name, load_fn, **loader_kwargs)
+
+
+def load_metadata(path, loader_name, build_fn):
+    """Load a per-file metadata index through the on-disk cache.
+
+    Metadata indices are small, and let loaders pick trajectories before
+    parsing (or reading images from) a file. They only depend on the source
+    file, so each is built once.
+
+    Args:
+        path (str): path to the source file.
+        loader_name (str): name of the loader.
+        build_fn (callable): produces a name->array dict of metadata; arrays
+            must not be object arrays.
+    Returns:
+        dict: name->array metadata.
+    """
+    key = cache_key(path, loader_name + ".metadata")
+    entry_path = os.path.join(cache_directory(), key + ".npz")
+
+    if not os.path.isfile(entry_path):
+        metadata = build_fn()
+        os.makedirs(cache_directory(), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(
+            dir=cache_directory(), prefix=".tmp-", suffix=".npz")
+        replaced = False
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **metadata)
+            os.replace(temp_path, entry_path)
+            replaced = True
+        finally:
+            # Never leave partial entries behind, whatever went wrong
+            if not replaced and os.path.exists(temp_path):
+                os.unlink(temp_path)
+
+    with np.load(entry_path) as f:
+        return {name: f[name] for name in f.files}
+
+
+def _write(entry_path, trajectories):
+    """Write trajectories to a cache entry. Each array is concatenated over
+    all trajectories along its first axis, and stored with the trajectory
+    boundaries. float64 arrays are stored as float32, so that they can be
+    wrapped by tensors without a copy.
+    """
+    parent = os.path.dirname(entry_path)
+    os.makedirs(parent, exist_ok=True)
+
+    # Write to a temporary directory, then rename, so that other processes
+    # never see partial entries
+    temp_path = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    renamed = False
+    try:
+        lengths = [len(states) for states, _, _ in trajectories]
+        observation_keys = \
+            sorted(trajectories[0][1].keys()) if trajectories else []
+
+        with open(os.path.join(temp_path, "meta.json"), "w") as f:
+            json.dump({'observation_keys': observation_keys}, f)
+        np.save(
+            os.path.join(temp_path, "offsets.npy"),
+            np.cumsum([0] + lengths))
+
+        if trajectories:
+            np.save(
+                os.path.join(temp_path, "states.npy"),
+                _to_float32(np.concatenate(
+                    [states for states, _, _ in trajectories])))
+            np.save(
+                os.path.join(temp_path, "controls.npy"),
+                _to_float32(np.concatenate(
+                    [controls for _, _, controls in trajectories])))
+            for key in observation_keys:
+                np.save(
+                    os.path.join(temp_path, f"observations.{key}.npy"),
+                    _to_float32(np.concatenate(
+                        [o[key] for _, o, _ in trajectories])))
+
+        os.rename(temp_path, entry_path)
+        renamed = True
+    except OSError:
+        # Another process finished writing the same entry first
+        if not os.path.isdir(entry_path):
+            raise
+    finally:
+        # Never leave partial entries behind, whatever went wrong
+        if not renamed:
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+
+def _to_float32(array):
+    """Downcast float64 arrays to float32; other arrays are unchanged.
+    """
+    if array.dtype == np.float64:
+        return array.astype(np.float32)
+    return array
+
+
+def _read(entry_path):
+    """Read trajectories from a cache entry, as memory-mapped views.
+    """
+    with open(os.path.join(entry_path, "meta.json")) as f:
+        observation_keys = json.load(f)['observation_keys']
+    offsets = np.load(os.path.join(entry_path, "offsets.npy"))
+    if len(offsets) == 1:
+        return []
+
+    def load_array(name):
+        return np.load(
+            os.path.join(entry_path, f"{name}.npy"), mmap_mode='r')
+
+    states = load_array("states")
+    controls = load_array("controls")
+    observations = {
+        key: load_array(f"observations.{key}") for key in observation_keys
+    }
+
+    trajectories = []
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        trajectories.append((
+            states[start:end],
+            {key: value[start:end] for key, value in observations.items()},
+            controls[start:end],
+        ))
+    return trajectories
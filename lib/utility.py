@@ -9,12 +9,320 @@ def diag_to_vector(m):
 def gaussian_log_likelihood(x, mu, sigma):
     k = x.shape[-1]
     diff = x-mu
-    mse = 0.5 * (diff.unsqueeze(1).bmm(torch.inverse(sigma)).bmm(diff.unsqueeze(-1))).squeeze()
+
+    # With sigma = L L^T: diff^T sigma^-1 diff = |L^-1 diff|^2, and
+    # log det(sigma) = 2 * sum(log(diag(L)))
+    sigma_cholesky = torch.linalg.cholesky(sigma)
+    whitened = torch.linalg.solve_triangular(
+        sigma_cholesky, diff.unsqueeze(-1), upper=False).squeeze(-1)
+    mse = 0.5 * torch.sum(whitened ** 2, dim=-1)
     const = (k*torch.log(torch.ones(1)*2*np.pi)).to(x.device)
-    sigma_det = 0.5 * torch.log(torch.det(sigma))
+    sigma_det = torch.sum(torch.log(
+        torch.diagonal(sigma_cholesky, dim1=-2, dim2=-1)), dim=-1)
 
     return -(mse+const+sigma_det)
 
+def map_nested(fn, x):
+    """Apply a function to each tensor in a nested dict/tuple/list."""
+    if type(x) == dict:
+        return {key: map_nested(fn, value) for key, value in x.items()}
+    elif type(x) in (tuple, list):
+        return type(x)(map_nested(fn, value) for value in x)
+    else:
+        return fn(x)
+
+def encode_sequence(model, observations, chunk_size=None):
+    """Encode a batch of observation sequences in large batched passes.
+
+    Args:
+        model: any model with an `encode(observations)` method, which maps
+            (B, *) observations to (B, *) features.
+        observations (dict): key->(N, T, *) observation tensors.
+        chunk_size (int, optional): max # of observations to encode at once.
+    Returns:
+        Features with leading dimensions (N, T); index with
+        `map_nested(lambda x: x[:, t], features)` to get the features for
+        timestep `t`.
+    """
+    N, T = next(iter(observations.values())).shape[:2]
+    flat_observations = map_nested(
+        lambda x: x.reshape((N * T,) + x.shape[2:]), observations)
+
+    if chunk_size is None or chunk_size >= N * T:
+        features = model.encode(flat_observations)
+    else:
+        chunks = [
+            model.encode(map_nested(
+                lambda x: x[start:start + chunk_size], flat_observations))
+            for start in range(0, N * T, chunk_size)
+        ]
+        features = _concatenate_nested(chunks)
+
+    return map_nested(lambda x: x.reshape((N, T) + x.shape[1:]), features)
+
+def fresh_flags(values):
+    """Per-timestep flags for whether a sequence of observations changed
+    since the previous timestep, e.g. when a camera frame is held for several
+    timesteps. The first timestep is always fresh.
+
+    Args:
+        values (torch.Tensor): (N, T, *) observations.
+    Returns:
+        torch.Tensor: (N, T) float flags.
+    """
+    N, T = values.shape[:2]
+    flags = torch.ones((N, T), device=values.device)
+    if T > 1:
+        changed = values[:, 1:] != values[:, :-1]
+        flags[:, 1:] = torch.any(
+            changed.reshape((N, T - 1, -1)), dim=2).float()
+    return flags
+
+def encode_fresh(encoder, inputs, fresh, cached_features):
+    """Encode a batch of inputs, reusing features from the previous timestep
+    for rows that haven't changed.
+
+    Args:
+        encoder (callable): maps (N, *) inputs to (N, *) features.
+        inputs (torch.Tensor): (N, *) inputs.
+        fresh (torch.Tensor, optional): (N,) flags; rows where this is 0 are
+            taken from `cached_features`. If None, everything is encoded.
+        cached_features (torch.Tensor, optional): (N, *) features from the
+            previous timestep.
+    Returns:
+        torch.Tensor: (N, *) features.
+    """
+    N = inputs.shape[0]
+    if fresh is None or cached_features is None \
+            or cached_features.shape[0] != N:
+        return encoder(inputs)
+
+    fresh = fresh.reshape(N) > 0
+    if not torch.any(fresh):
+        return cached_features
+    if torch.all(fresh):
+        return encoder(inputs)
+
+    indices = torch.nonzero(fresh)[:, 0]
+    return cached_features.index_copy(0, indices, encoder(inputs[indices]))
+
+def encode_unique(encoder, inputs):
+    """Encode a batch of inputs, running the encoder once for each run of
+    identical consecutive inputs. Flattened (N, T) batches of held camera
+    frames contain long runs like this.
+
+    Features are gathered back for every input, so gradients from repeated
+    inputs are summed into a single encoder pass.
+
+    Args:
+        encoder (callable): maps (B, *) inputs to (B, *) features.
+        inputs (torch.Tensor): (B, *) inputs.
+    Returns:
+        torch.Tensor: (B, *) features.
+        int: # of inputs actually encoded.
+    """
+    B = inputs.shape[0]
+    if B <= 1:
+        return encoder(inputs), B
+
+    # Each run starts wherever an input differs from the one before it
+    flat_inputs = inputs.reshape((B, -1))
+    run_starts = torch.ones(B, dtype=torch.bool, device=inputs.device)
+    run_starts[1:] = torch.any(flat_inputs[1:] != flat_inputs[:-1], dim=1)
+
+    unique_count = int(torch.sum(run_starts))
+    if unique_count == B:
+        return encoder(inputs), B
+
+    # (B,) index of each input's run
+    run_indices = torch.cumsum(run_starts.long(), dim=0) - 1
+    return encoder(inputs[run_starts])[run_indices], unique_count
+
+def record_image_dedup(module, image_count, unique_count):
+    """Add the outputs of an `encode_unique()` call to a module's
+    `image_dedup_counts`."""
+    images, encoded = module.image_dedup_counts or (0, 0)
+    module.image_dedup_counts = (images + image_count, encoded + unique_count)
+
+def image_dedup_ratios(model):
+    """Collect image dedup ratios from each submodule that encodes images
+    with `encode_unique()`: the # of images passed to its encoder since the
+    last `reset_image_dedup_counts()`, divided by the # of frames actually
+    encoded.
+
+    Repeated frames are only found within a single encoder call, so ratios
+    are only above 1 when whole (N, T) sequences are encoded at once, e.g.
+    with `encode_sequence()`.
+
+    Returns:
+        dict: module name->ratio.
+    """
+    return {
+        name: module.image_dedup_counts[0]
+        / max(module.image_dedup_counts[1], 1)
+        for name, module in model.named_modules()
+        if getattr(module, "image_dedup_counts", None) is not None
+    }
+
+def reset_image_dedup_counts(model):
+    """Reset the counts behind `image_dedup_ratios()`; call this at the start
+    of each batch."""
+    for module in model.modules():
+        if hasattr(module, "image_dedup_counts"):
+            module.image_dedup_counts = None
+
+def clear_feature_caches(model):
+    """Drop image features cached by `encode_fresh()` callers in a model and
+    its submodules; call this before starting a new sequence."""
+    for module in model.modules():
+        if hasattr(module, "_cached_image_features"):
+            module._cached_image_features = None
+
+def vmap_modules(modules, fn, *args, stacked_args=()):
+    """Evaluate `fn(module, *args)` for several modules with identical
+    architectures in one vectorized call, by running `torch.func.vmap` over
+    their stacked parameters. Gradients flow back to each module.
+
+    Args:
+        modules (list): modules with the same parameter & buffer names and
+            shapes.
+        fn (callable): called as `fn(module, *stacked_args, *args)`; can use
+            any of the module's methods, but must be vmap-compatible (e.g. no
+            random sampling).
+        *args: inputs, shared by every module.
+        stacked_args (tuple): per-module inputs, stacked along a leading
+            dimension of size `len(modules)`.
+    Returns:
+        Outputs of `fn`, stacked along a new leading dimension.
+    """
+    def stack(named_tensors):
+        tensors = [dict(named) for named in named_tensors]
+        return {
+            "module." + name: torch.stack([t[name] for t in tensors])
+            for name in tensors[0].keys()
+        }
+
+    params = stack([module.named_parameters() for module in modules])
+    buffers = stack([module.named_buffers() for module in modules])
+    bound = _BoundModule(modules[0], fn)
+    return torch.func.vmap(
+        lambda params, buffers, stacked_args: torch.func.functional_call(
+            bound, (params, buffers), tuple(stacked_args) + args)
+    )(params, buffers, tuple(stacked_args))
+
+class _BoundModule(torch.nn.Module):
+    """Module whose forward pass is `fn(module, *args)`; lets
+    `torch.func.functional_call()` swap parameters for any method."""
+
+    def __init__(self, module, fn):
+        super().__init__()
+        self.module = module
+        self.fn = fn
+
+    def forward(self, *args):
+        return self.fn(self.module, *args)
+
+def _concatenate_nested(chunks):
+    """Concatenate a list of identically structured nested dicts/tuples/lists
+    of tensors along their first dimension."""
+    first = chunks[0]
+    if type(first) == dict:
+        return {key: _concatenate_nested([chunk[key] for chunk in chunks])
+                for key in first.keys()}
+    elif type(first) in (tuple, list):
+        return type(first)(
+            _concatenate_nested([chunk[i] for chunk in chunks])
+            for i in range(len(first)))
+    else:
+        return torch.cat(chunks, dim=0)
+
+def quantize_images(images, image_range=(-1., 1.)):
+    """Quantize images to compact uint8 codes. The 256 codes are evenly spaced
+    over `image_range`, so 8-bit pixels mapped onto it affinely (e.g.
+    `p / 127.5 - 1` for [-1, 1], or `p / 255` for [0, 1]) round-trip exactly;
+    see `dequantize_images()`.
+
+    Args:
+        images (np.ndarray): images with values in `image_range`.
+        image_range (tuple): (low, high) image values.
+    Returns:
+        np.ndarray: uint8 codes.
+    """
+    low, high = image_range
+    codes = (np.clip(images, low, high) - low) * (255. / (high - low))
+    return np.round(codes).astype(np.uint8)
+
+def dequantize_images(codes, image_range=(-1., 1.)):
+    """Decode uint8 image codes to float32 values in `image_range`, with the
+    affine map `code / (255 / (high - low)) + low`.
+
+    Args:
+        codes (np.ndarray or torch.Tensor): uint8 codes.
+        image_range (tuple): (low, high) image values.
+    Returns:
+        np.ndarray or torch.Tensor: float32 images.
+    """
+    low, high = image_range
+    scale = 255. / (high - low)
+    if isinstance(codes, torch.Tensor):
+        return codes.float() / scale + low
+    return (codes.astype(np.float32) / np.float32(scale)
+            + np.float32(low))
+
+def apply_observation_masks(observations, materialize=True,
+                            image_range=(-1., 1.)):
+    """Apply per-timestep availability flags to a dict of observations.
+
+    Any `<key>_available` entry is treated as a mask for `<key>`: observations
+    are zeroed out wherever the flag is 0. Flags have the observations'
+    leading dimensions, e.g. (T,) for a trajectory or (N, T) for a batch.
+    uint8 `image` codes are decoded with `dequantize_images()`, to values in
+    `image_range`.
+
+    Numpy observations are only copied when masking changes them: arrays
+    with all flags set, and zero-stride placeholders of zeros, are passed
+    through. Placeholders (constant views for disabled modalities) are then
+    materialized, unless `materialize=False`.
+
+    Args:
+        observations (dict): key->(*, ...) numpy arrays or torch tensors.
+        materialize (bool): whether to copy zero-stride numpy views.
+        image_range (tuple): (low, high) values of decoded images.
+    Returns:
+        dict: masked observations; flags are kept.
+    """
+    output = {}
+    for key, value in observations.items():
+        if key == "image":
+            if isinstance(value, torch.Tensor):
+                is_codes = value.dtype == torch.uint8
+            else:
+                is_codes = value.dtype == np.uint8
+            if is_codes:
+                value = dequantize_images(value, image_range)
+
+        flags = observations.get(key + "_available")
+        if flags is not None and not _masking_is_noop(value, flags):
+            value = value * flags.reshape(
+                flags.shape + (1,) * (len(value.shape) - len(flags.shape)))
+        elif materialize and isinstance(value, np.ndarray) \
+                and 0 in value.strides:
+            value = np.array(value)
+        output[key] = value
+    return output
+
+def _masking_is_noop(value, flags):
+    """Whether applying availability flags to numpy observations would leave
+    them unchanged: every flag is set, or the observations are a zero-stride
+    placeholder of zeros."""
+    if not isinstance(value, np.ndarray) or isinstance(flags, torch.Tensor):
+        return False
+    if np.all(flags != 0):
+        return True
+    if 0 in value.strides[:len(flags.shape)]:
+        return not np.any(value[(slice(0, 1),) * len(flags.shape)])
+    return False
+
 # def gaussian_log_likelihood(x, mu, sigma):
 #
 #     prob = torch.distributions.multivariate_normal.MultivariateNormal(mu,
@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from lib import dpf
+from lib.dpf import _dpf_datasets
+
+
+def _write_memmap(path, array):
+    np.save(path, array)
+    return np.load(path, mmap_mode='r')
+
+
+def _split(array, lengths):
+    return np.split(array, np.cumsum(lengths)[:-1])
+
+
+def _memmap_trajectories(tmp_path, lengths, state_dim=2):
+    total = sum(lengths)
+    states = _write_memmap(
+        tmp_path / "states.npy",
+        np.random.randn(total, state_dim).astype(np.float32))
+    images = _write_memmap(
+        tmp_path / "images.npy",
+        np.random.randint(0, 256, (total, 32, 32), dtype=np.uint8))
+    controls = _write_memmap(
+        tmp_path / "controls.npy",
+        np.random.randn(total, 7).astype(np.float32))
+    trajectories = [
+        (s, {'image': o}, c) for s, o, c in zip(
+            _split(states, lengths),
+            _split(images, lengths),
+            _split(controls, lengths))
+    ]
+    return trajectories, (states, images, controls)
+
+
+def test_consecutive_memmap_views_are_not_copied(tmp_path):
+    trajectories, (states, images, controls) = _memmap_trajectories(
+        tmp_path, [20, 30, 25])
+    index = dpf.SubsequenceIndex(trajectories, subsequence_length=10)
+
+    # Tensors wrap the memory-mapped files directly
+    assert index.states.data_ptr() == _dpf_datasets._address(states)
+    assert index.observations['image'].data_ptr() == \
+        _dpf_datasets._address(images)
+    assert index.controls.data_ptr() == _dpf_datasets._address(controls)
+
+    # Windows are views into the same buffers
+    window_states, window_observations, _ = index[3]
+    assert window_states.data_ptr() == index.states[
+        index.starts()[3]:].data_ptr()
+    assert torch.equal(window_states, torch.from_numpy(
+        np.array(states[index.starts()[3]:][:10])))
+    assert window_observations['image'].dtype == torch.uint8
+
+
+def test_copied_arrays_are_moved_to_shared_memory():
+    lengths = [20, 30]
+
+    # Separately allocated arrays need to be concatenated
+    trajectories = [
+        (np.random.randn(T, 2).astype(np.float32),
+         {'image': np.zeros((T, 32, 32), dtype=np.uint8)},
+         np.random.randn(T, 7).astype(np.float32))
+        for T in lengths
+    ]
+    index = dpf.SubsequenceIndex(trajectories, subsequence_length=10)
+    assert index.states.is_shared()
+    assert index.observations['image'].is_shared()
+    assert index.controls.is_shared()
+
+    # float64 arrays are copied while converting to float32
+    array = np.random.randn(50, 2)
+    tensor = _dpf_datasets._to_shared_tensor(
+        _dpf_datasets._concatenate(_split(array, lengths)))
+    assert tensor.is_shared()
+
+
+def _private_kib(pid):
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return fields["Private_Clean"] + fields["Private_Dirty"]
+
+
+def _child_pids():
+    pids = []
+    for tid in os.listdir("/proc/self/task"):
+        with open(f"/proc/self/task/{tid}/children") as f:
+            pids.extend(int(pid) for pid in f.read().split())
+    return pids
+
+
+@pytest.mark.skipif(
+    not os.path.exists("/proc/self/smaps_rollup"),
+    reason="needs /proc/<pid>/smaps_rollup")
+def test_dataloader_workers_do_not_copy_data(tmp_path):
+    # ~128 MiB of images
+    lengths = [256] * 512
+    trajectories, (_, images, _) = _memmap_trajectories(tmp_path, lengths)
+    index = dpf.SubsequenceIndex(trajectories, subsequence_length=16)
+
+    dataloader = torch.utils.data.DataLoader(
+        index, batch_size=32, shuffle=True, num_workers=2)
+    iterator = iter(dataloader)
+    for _ in range(len(dataloader) - 1):
+        next(iterator)
+
+    # Between them, workers have read (nearly) the full dataset; none of it
+    # should have been copied into their private memory
+    pids = _child_pids()
+    assert len(pids) > 0
+    for pid in pids:
+        assert _private_kib(pid) * 1024 < images.nbytes / 2
+    del iterator
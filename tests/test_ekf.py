@@ -0,0 +1,59 @@
+import torch
+import torch.nn as nn
+
+from lib import ekf
+
+
+class _StaticDynamicsModel(nn.Module):
+    use_particles = False
+
+    def forward(self, states_prev, controls, noisy=False):
+        return states_prev
+
+
+class _FixedMeasurementModel(ekf.KFMeasurementModel):
+    """Returns the same observation & noise for any state."""
+
+    def __init__(self, z, R):
+        super().__init__()
+        self.z = z
+        self.R = R
+
+    def forward(self, observations, states):
+        return self.z, self.R
+
+
+def _random_covariances(N, state_dim):
+    A = torch.randn((N, state_dim, state_dim), dtype=torch.float64)
+    return A @ A.transpose(-1, -2) + 0.1 * torch.eye(
+        state_dim, dtype=torch.float64)
+
+
+def test_update_matches_explicit_inverse_form():
+    torch.manual_seed(0)
+
+    N, state_dim = 8, 3
+    states_pred = torch.randn((N, state_dim), dtype=torch.float64)
+    states_sigma_pred = _random_covariances(N, state_dim)
+    z = torch.randn((N, state_dim), dtype=torch.float64)
+    R = _random_covariances(N, state_dim)
+
+    kf_model = ekf.KalmanFilterNetwork(
+        _StaticDynamicsModel(), _FixedMeasurementModel(z, R))
+    states_update, states_sigma_update = kf_model.update(
+        states_pred, states_sigma_pred, observations=None)
+
+    # Textbook form: K = P (P + R)^-1, x' = x + K (z - x), P' = (I - K) P
+    K = states_sigma_pred @ torch.inverse(states_sigma_pred + R)
+    expected_states = states_pred + \
+        (K @ (z - states_pred)[:, :, None])[:, :, 0]
+    expected_sigma = (torch.eye(state_dim, dtype=torch.float64) - K) \
+        @ states_sigma_pred
+
+    assert torch.allclose(states_update, expected_states)
+    assert torch.allclose(states_sigma_update, expected_sigma)
+
+    # Updated covariances stay symmetric positive definite
+    assert torch.equal(
+        states_sigma_update, states_sigma_update.transpose(-1, -2))
+    assert torch.all(torch.linalg.eigvalsh(states_sigma_update) > 0)
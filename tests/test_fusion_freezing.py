@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+import torch
+
+from lib import fusion, fusion_pf, panda_models
+
+
+def _make_model():
+    torch.manual_seed(0)
+    image_model = panda_models.PandaParticleFilterNetwork(
+        panda_models.PandaDynamicsModel(),
+        panda_models.PandaMeasurementModel(
+            units=16, missing_modalities=['gripper_sensors']))
+    force_model = panda_models.PandaParticleFilterNetwork(
+        panda_models.PandaDynamicsModel(),
+        panda_models.PandaMeasurementModel(
+            units=16, missing_modalities=['image']))
+    weight_model = fusion.CrossModalWeights(
+        state_dim=1, units=16, use_softmax=True, use_log_softmax=True)
+    return fusion_pf.ParticleFusionModel(
+        image_model, force_model, weight_model)
+
+
+def _run_window(model, N=3, M=8, T=4):
+    """Runs a short BPTT window, and backpropagates the estimate loss."""
+    observations = {
+        'image': torch.randn((N, T, 32, 32)),
+        'gripper_pos': torch.randn((N, T, 3)),
+        'gripper_sensors': torch.randn((N, T, 7)),
+    }
+    controls = torch.randn((N, T, 7))
+    states_label = torch.randn((N, T, 2))
+
+    states = states_label[:, 0, np.newaxis, :].expand(N, M, 2)
+    log_weights = torch.zeros((N, M)) - np.log(M)
+
+    losses = []
+    for t in range(1, T):
+        estimates, states, log_weights = model(
+            states,
+            log_weights,
+            {key: value[:, t] for key, value in observations.items()},
+            controls[:, t])
+        losses.append(torch.mean((estimates - states_label[:, t]) ** 2))
+    torch.mean(torch.stack(losses)).backward()
+
+
+def _has_gradients(module):
+    # Layers for missing modalities are never used, so only some parameters
+    # need gradients
+    grads = [p.grad for p in module.parameters() if p.grad is not None]
+    return len(grads) > 0 and \
+        sum(torch.sum(torch.abs(grad)) for grad in grads) > 0.
+
+
+def _has_no_gradients(module):
+    return all(p.grad is None for p in module.parameters())
+
+
+def test_weight_model_trains_with_frozen_filters():
+    model = _make_model()
+    model.freeze_image_model = True
+    model.freeze_force_model = True
+    model.freeze_weight_model = False
+
+    _run_window(model)
+    assert _has_gradients(model.weight_model)
+    assert _has_no_gradients(model.image_model)
+    assert _has_no_gradients(model.force_model)
+
+
+@pytest.mark.parametrize("trained", ["image", "force"])
+def test_unfrozen_filter_trains_next_to_frozen_filter(trained):
+    model = _make_model()
+    model.freeze_image_model = trained != "image"
+    model.freeze_force_model = trained != "force"
+    model.freeze_weight_model = True
+
+    _run_window(model)
+    frozen = "force" if trained == "image" else "image"
+    assert _has_gradients(
+        getattr(model, trained + "_model").measurement_model)
+    assert _has_no_gradients(getattr(model, frozen + "_model"))
+    assert _has_no_gradients(model.weight_model)
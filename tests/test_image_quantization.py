@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import torch
+
+from lib import utility
+
+
+# 8-bit pixels p, and how each dataset maps them to floats
+_IMAGE_RANGES = [
+    ((-1., 1.), lambda p: p / 127.5 - 1.),
+    ((0., 1.), lambda p: p / 255.),
+]
+
+
+@pytest.mark.parametrize("image_range,normalize", _IMAGE_RANGES)
+def test_quantized_pixels_round_trip(image_range, normalize):
+    pixels = np.arange(256, dtype=np.uint8).reshape((16, 16))
+    images = normalize(pixels.astype(np.float64))
+
+    # Every pixel value gets its own code...
+    codes = utility.quantize_images(images, image_range)
+    assert codes.dtype == np.uint8
+    assert np.array_equal(codes, pixels)
+
+    # ...which decodes back to the normalized pixel
+    decoded = utility.dequantize_images(codes, image_range)
+    assert decoded.dtype == np.float32
+    assert np.allclose(decoded, images, rtol=0., atol=1e-6)
+
+    # Decoding is the same for tensors
+    decoded_tensor = utility.dequantize_images(
+        torch.from_numpy(codes), image_range)
+    assert decoded_tensor.dtype == torch.float32
+    assert np.allclose(decoded_tensor.numpy(), decoded, rtol=0., atol=1e-6)
+
+    # float32 images round-trip too
+    assert np.array_equal(
+        utility.quantize_images(images.astype(np.float32), image_range),
+        pixels)
+
+
+@pytest.mark.parametrize("image_range", [r for r, _ in _IMAGE_RANGES])
+def test_out_of_range_values_are_clipped(image_range):
+    low, high = image_range
+    codes = utility.quantize_images(
+        np.array([low - 1., low, high, high + 1.]), image_range)
+    assert np.array_equal(codes, [0, 0, 255, 255])
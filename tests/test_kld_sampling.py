@@ -0,0 +1,54 @@
+import numpy as np
+import torch
+
+from lib import dpf
+
+
+class _NoisyDynamicsModel(dpf.DynamicsModel):
+    """Random walk with a settable noise scale."""
+
+    def __init__(self):
+        super().__init__()
+        self.stddev = 0.
+
+    def forward(self, states_prev, controls, noisy=False):
+        return states_prev + torch.randn_like(states_prev) * self.stddev
+
+
+class _UniformMeasurementModel(dpf.MeasurementModel):
+    """Gives every particle the same likelihood."""
+
+    def forward(self, observations, states):
+        return torch.zeros(states.shape[:2])
+
+
+def test_kld_particle_sets_grow_after_shrinking():
+    torch.manual_seed(0)
+
+    N, M, state_dim = 4, 100, 2
+    dynamics_model = _NoisyDynamicsModel()
+    pf_model = dpf.ParticleFilterNetwork(
+        dynamics_model, _UniformMeasurementModel(), kld_bin_size=0.1,
+        kld_min_particles=10)
+
+    particles = torch.zeros((N, M, state_dim))
+    log_weights = torch.zeros((N, M)) - np.log(M)
+    observations = torch.zeros((N, 1))
+    controls = torch.zeros((N, 1))
+
+    def step(particles, log_weights):
+        _, particles, log_weights = pf_model(
+            particles, log_weights, observations, controls,
+            kld_sampling=True, output_particles=M)
+        return particles, log_weights
+
+    # Posterior collapsed to a single bin: particle sets contract
+    particles, log_weights = step(particles, log_weights)
+    assert particles.shape[1] < M
+    assert torch.all(dpf.active_particle_counts(log_weights) == 10)
+
+    # Posterior spread over many bins: particle sets grow back to the bound
+    dynamics_model.stddev = 10.
+    particles, log_weights = step(particles, log_weights)
+    assert particles.shape == (N, M, state_dim)
+    assert torch.all(dpf.active_particle_counts(log_weights) > 10)
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+import torch
+
+from lib import dpf
+
+
+class _IdentityDynamicsModel(dpf.DynamicsModel):
+    def forward(self, states_prev, controls, noisy=False):
+        return states_prev
+
+
+class _UniformMeasurementModel(dpf.MeasurementModel):
+    """Gives every particle the same likelihood."""
+
+    def forward(self, observations, states):
+        return torch.zeros(states.shape[:2])
+
+
+@pytest.mark.parametrize("method", dpf.resampling_methods)
+def test_resampled_indices_follow_weights(method):
+    torch.manual_seed(0)
+
+    weights = torch.tensor([
+        [0.5, 0.25, 0.125, 0.125, 0.],
+        [0.05, 0.15, 0.2, 0.3, 0.3],
+    ])
+    num_samples = 20000
+    indices = dpf.resample_indices(
+        torch.log(weights), num_samples=num_samples, method=method)
+    assert indices.shape == (2, num_samples)
+    assert indices.dtype == torch.long
+    assert torch.all((indices >= 0) & (indices < 5))
+
+    # Empirical frequencies match the (normalized) weights
+    counts = torch.stack([
+        torch.bincount(row, minlength=5) for row in indices
+    ]).float()
+    assert torch.allclose(counts / num_samples, weights, atol=0.02)
+
+    # Zero-weight particles are never drawn
+    assert counts[0, 4] == 0
+
+
+@pytest.mark.parametrize("method", ("systematic", "stratified", "residual"))
+def test_low_variance_resampling_copies_expected_counts(method):
+    torch.manual_seed(0)
+
+    # Each particle's expected count is an integer, so low-variance schemes
+    # draw it exactly
+    weights = torch.tensor([[0.5, 0.25, 0.125, 0.125]])
+    indices = dpf.resample_indices(
+        torch.log(weights), num_samples=8, method=method)
+    assert torch.equal(
+        torch.bincount(indices[0], minlength=4), torch.tensor([4, 2, 1, 1]))
+
+
+def test_effective_sample_size():
+    M = 10
+    log_weights = torch.stack([
+        # Uniform weights
+        torch.zeros(M),
+        # All weight on one particle
+        torch.tensor([0.] + [-np.inf] * (M - 1)),
+        # Unnormalized weights, split evenly over two particles
+        torch.tensor([3., 3.] + [-np.inf] * (M - 2)),
+    ])
+    ess = dpf.effective_sample_size(log_weights)
+    assert torch.allclose(ess, torch.tensor([10., 1., 2.]))
+
+
+def test_ess_gated_resampling_only_resamples_degenerate_sets():
+    torch.manual_seed(0)
+
+    N, M, state_dim = 2, 50, 2
+    pf_model = dpf.ParticleFilterNetwork(
+        _IdentityDynamicsModel(), _UniformMeasurementModel())
+
+    particles = torch.randn((N, M, state_dim))
+    log_weights = torch.zeros((N, M)) - np.log(M)
+
+    # The second set puts almost all of its weight on its first particle
+    log_weights[1] = -50.
+    log_weights[1, 0] = 0.
+    log_weights = log_weights - \
+        torch.logsumexp(log_weights, dim=1, keepdim=True)
+
+    _, states, log_weights_out, ess = pf_model(
+        particles,
+        log_weights,
+        torch.zeros((N, 1)),
+        torch.zeros((N, 1)),
+        ess_threshold=0.5,
+        return_ess=True)
+    assert ess[0] > 0.5 * M
+    assert ess[1] < 0.5 * M
+
+    # Healthy sets carry their particles & weights forward...
+    assert torch.equal(states[0], particles[0])
+    assert torch.allclose(log_weights_out[0], log_weights[0])
+
+    # ...while degenerate sets are resampled to uniform weights
+    assert torch.allclose(
+        log_weights_out[1], torch.full((M,), -np.log(M)))
+    assert torch.equal(states[1], particles[1, 0].expand(M, state_dim))
@@ -28,6 +28,11 @@ parser.add_argument(
 parser.add_argument("--hidden_units", type=int, default=64)
 parser.add_argument("--epochs_multiplier", type=int, default=1)
 parser.add_argument("--start_timestep", type=int, default=0)
+parser.add_argument(
+    "--dynamics_mode",
+    type=str,
+    choices=["separate", "shared", "batched"],
+    default="separate")
 args = parser.parse_args()
 
 # Some constants
@@ -69,7 +74,8 @@ weight_model = fusion.CrossModalWeights(state_dim=1, use_softmax=True, use_log_s
 pf_fusion_model = fusion_pf.ParticleFusionModel(
     pf_image_model,
     pf_force_model,
-    weight_model
+    weight_model,
+    dynamics_mode=args.dynamics_mode
 )
 
 buddy = fannypack.utils.Buddy(